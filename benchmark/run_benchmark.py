@@ -0,0 +1,184 @@
+"""
+Offline throughput benchmark of HyperRAG against the fake OpenAI-compatible provider.
+
+    python benchmark/run_benchmark.py --num-docs 50 --latency 0.3 --tokens-per-second 80 \
+        --llm-max-async 16 --query-concurrency 8 --num-queries 100
+
+--transport inprocess calls FakeOpenAI directly, --transport http serves it on a local port
+and goes through openai_complete_if_cache / openai_embedding, including the HTTP client.
+Reports the end-to-end docs/s of ainsert and the p50 / p99 latency and QPS of aquery.
+"""
+
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+import argparse
+import asyncio
+import random
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from hyperrag import HyperRAG, QueryParam
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.llm import close_api_clients, openai_complete_if_cache, openai_embedding
+from hyperrag.utils import EmbeddingFunc
+
+
+def load_docs(path: Path, num_docs: int, doc_words: int, seed: int = 0) -> list[str]:
+    """Documents of doc_words words, sampled from the paragraphs of the text file"""
+    words = path.read_text(encoding="utf-8").split()
+    rng = random.Random(seed)
+    docs = []
+    for i in range(num_docs):
+        start = rng.randrange(max(1, len(words) - doc_words))
+        # a unique header, so that documents are not deduplicated
+        docs.append(f"Document {i}\n" + " ".join(words[start : start + doc_words]))
+    return docs
+
+
+def make_queries(docs: list[str], num_queries: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(num_queries):
+        words = re.findall(r"[A-Za-z]{5,}", rng.choice(docs))
+        picked = rng.sample(words, min(3, len(words))) if words else ["story"]
+        queries.append(f"What does the text say about {', '.join(picked)}?")
+    return queries
+
+
+def make_funcs(fake: FakeOpenAI, transport: str, base_url: str):
+    if transport == "inprocess":
+        return fake.complete_func(), fake.embedding_func()
+
+    async def llm_model_func(prompt, system_prompt=None, history_messages=[], **kwargs):
+        return await openai_complete_if_cache(
+            "fake-llm",
+            prompt,
+            system_prompt=system_prompt,
+            history_messages=history_messages,
+            base_url=base_url,
+            api_key="fake",
+            **kwargs,
+        )
+
+    async def embedding_func(texts: list[str]) -> np.ndarray:
+        return await openai_embedding(texts, model="fake-embedding", base_url=base_url, api_key="fake")
+
+    return llm_model_func, EmbeddingFunc(
+        embedding_dim=fake.embedding_dim, max_token_size=8192, func=embedding_func
+    )
+
+
+async def run_queries(rag: HyperRAG, queries: list[str], mode: str, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one_query(query):
+        async with semaphore:
+            start = time.perf_counter()
+            await rag.aquery(query, QueryParam(mode=mode))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one_query(q) for q in queries])
+    return np.array(latencies), time.perf_counter() - start
+
+
+async def main(args):
+    fake = FakeOpenAI(
+        latency=args.latency,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        rate_429=args.rate_429,
+        embedding_dim=args.embedding_dim,
+        seed=args.seed,
+    )
+    runner = None
+    if args.transport == "http":
+        runner = await fake.start_server(port=args.port)
+    llm_model_func, embedding_func = make_funcs(
+        fake, args.transport, f"http://127.0.0.1:{args.port}/v1"
+    )
+
+    working_dir = Path(args.working_dir or tempfile.mkdtemp(prefix="hyperrag_bench_"))
+    if args.working_dir and working_dir.exists() and any(working_dir.iterdir()):
+        shutil.rmtree(working_dir)
+    working_dir.mkdir(parents=True, exist_ok=True)
+    rag = HyperRAG(
+        working_dir=str(working_dir),
+        llm_model_func=llm_model_func,
+        embedding_func=embedding_func,
+        llm_model_max_async=args.llm_max_async,
+        embedding_func_max_async=args.embedding_max_async,
+        enable_llm_cache=False,
+        enable_extraction_checkpoint=False,
+        enable_insert_pipeline=args.pipeline,
+        llm_model_requests_per_minute=args.requests_per_minute,
+        # the injected 429s are retried by the rate limiter
+        enable_adaptive_concurrency=args.adaptive_concurrency or args.rate_429 > 0,
+    )
+
+    docs = load_docs(Path(args.docs), args.num_docs, args.doc_words, args.seed)
+    start = time.perf_counter()
+    await rag.ainsert(docs)
+    insert_seconds = time.perf_counter() - start
+    insert_calls = rag.llm_model_func.num_calls
+
+    queries = make_queries(docs, args.num_queries, args.seed)
+    latencies, query_seconds = await run_queries(
+        rag, queries, args.mode, args.query_concurrency
+    )
+
+    print("=" * 60)
+    print(f"transport={args.transport} latency={args.latency}s tokens/s={args.tokens_per_second} "
+          f"rate_429={args.rate_429} llm_max_async={args.llm_max_async}")
+    print(f"insert: {len(docs)} docs in {insert_seconds:.2f}s, "
+          f"{len(docs) / insert_seconds:.2f} docs/s, {insert_calls} llm calls")
+    print(f"query ({args.mode}, concurrency {args.query_concurrency}): {len(queries)} queries, "
+          f"p50 {np.percentile(latencies, 50) * 1000:.0f} ms, "
+          f"p99 {np.percentile(latencies, 99) * 1000:.0f} ms, "
+          f"{len(queries) / query_seconds:.2f} queries/s")
+    print(f"provider: {fake.stats}")
+
+    await close_api_clients()
+    if runner is not None:
+        await runner.cleanup()
+    if not args.working_dir:
+        shutil.rmtree(working_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HyperRAG offline throughput benchmark")
+    parser.add_argument("--docs", default=str(Path(__file__).resolve().parent.parent / "examples" / "mock_data.txt"))
+    parser.add_argument("--num-docs", type=int, default=20)
+    parser.add_argument("--doc-words", type=int, default=2000)
+    parser.add_argument("--num-queries", type=int, default=50)
+    parser.add_argument("--mode", default="hyper")
+    parser.add_argument("--query-concurrency", type=int, default=8)
+    parser.add_argument("--llm-max-async", type=int, default=16)
+    parser.add_argument("--embedding-max-async", type=int, default=16)
+    parser.add_argument("--requests-per-minute", type=int, default=0)
+    parser.add_argument("--adaptive-concurrency", action="store_true")
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument("--transport", choices=["inprocess", "http"], default="inprocess")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--latency-sigma", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--embedding-dim", type=int, default=256)
+    parser.add_argument("--working-dir", default=None)
+    parser.add_argument("--overwrite", action="store_true", help="clear a non-empty --working-dir")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    if args.working_dir and not args.overwrite:
+        working_dir = Path(args.working_dir)
+        if working_dir.exists() and (not working_dir.is_dir() or any(working_dir.iterdir())):
+            parser.error(f"--working-dir {working_dir} is not empty, pass --overwrite to clear it")
+    asyncio.run(main(args))
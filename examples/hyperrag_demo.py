@@ -60,6 +60,8 @@ if __name__ == "__main__":
         embedding_func=EmbeddingFunc(
             embedding_dim=EMB_DIM, max_token_size=8192, func=embedding_func
         ),
+        enable_embedding_cache=True,
+        embedding_model_name=EMB_MODEL,
     )
 
     # read the text file
@@ -5,7 +5,13 @@ from .utils import EmbeddingFunc
 
 TextChunkSchema = TypedDict(
     "TextChunkSchema",
-    {"tokens": int, "content": str, "full_doc_id": str, "chunk_order_index": int},
+    {
+        "tokens": int,
+        "content": str,
+        "full_doc_id": str,
+        "full_doc_ids": list[str],
+        "chunk_order_index": int,
+    },
 )
 
 T = TypeVar("T")
@@ -26,6 +32,9 @@ class QueryParam:
     max_token_for_relation_context: int = 1600
     # return type
     return_type: Literal["json", "text"] = "text"
+    # return the retrieval results with an async iterator of the answer tokens in "response",
+    # see HyperRAG.aquery_stream
+    stream: bool = False
 
 
 @dataclass
@@ -46,6 +55,8 @@ class StorageNameSpace:
 class BaseVectorStorage(StorageNameSpace):
     embedding_func: EmbeddingFunc
     meta_fields: set = field(default_factory=set)
+    # embeds the queries, embedding_func if None
+    query_embedding_func: EmbeddingFunc = None
 
     async def query(self, query: str, top_k: int) -> list[dict]:
         raise NotImplementedError
@@ -56,6 +67,13 @@ class BaseVectorStorage(StorageNameSpace):
         """
         raise NotImplementedError
 
+    async def delete(self, ids: list[str]):
+        raise NotImplementedError
+
+    async def get_by_ids(self, ids: list[str]) -> list[Union[dict, None]]:
+        """The stored meta fields of the ids, None for the missing ones"""
+        raise NotImplementedError
+
 
 @dataclass
 class BaseKVStorage(Generic[T], StorageNameSpace):
@@ -77,6 +95,9 @@ class BaseKVStorage(Generic[T], StorageNameSpace):
     async def upsert(self, data: dict[str, T]):
         raise NotImplementedError
 
+    async def delete(self, ids: list[str]):
+        raise NotImplementedError
+
     async def drop(self):
         raise NotImplementedError
 
@@ -0,0 +1,393 @@
+"""
+A local stand-in for an OpenAI-compatible provider, for offline tests and throughput benchmarks.
+
+FakeOpenAI answers chat completions and embeddings deterministically:
+    - entity_extraction prompts get well-formed entity / hyperedge records of the words of the text
+    - keywords_extraction prompts get a JSON object of the words of the query
+    - batch summary prompts get a JSON object with a summary of every item
+    - embeddings are hash-based bag-of-words vectors, so that texts sharing words are similar
+with a configurable latency distribution, output tokens per second and 429 injection.
+
+It can be used in-process, through `fake_complete` / `fake_embedding` as llm_model_func and
+embedding_func, or served over HTTP for openai_complete_if_cache / openai_embedding:
+
+    python -m hyperrag.fake_openai --port 8000 --latency 0.5 --tokens-per-second 50 --rate-429 0.05
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import time
+
+import numpy as np
+
+from .prompt import GRAPH_FIELD_SEP, PROMPTS
+
+
+class FakeRateLimitError(Exception):
+    """429 of the in-process transport, recognized by RateLimiter and MultiModel"""
+
+    status_code = 429
+
+    def __init__(self, retry_after: float = 1.0):
+        super().__init__("Rate limit reached (fake)")
+        self.headers = {"retry-after": str(retry_after)}
+
+
+def _prompt_markers(prompt: str, placeholder: str):
+    # the fixed text around the placeholder, after the last other placeholder
+    before, after = prompt.split(placeholder)
+    before = before.split("}")[-1]
+    after = after.split("{")[0]
+    return before.replace("{{", "{").replace("}}", "}"), after
+
+
+_EXTRACTION_BEFORE, _EXTRACTION_AFTER = _prompt_markers(
+    PROMPTS["entity_extraction"], "{input_text}"
+)
+_KEYWORDS_BEFORE, _KEYWORDS_AFTER = _prompt_markers(
+    PROMPTS["keywords_extraction"], "{query}"
+)
+_BATCH_ITEM_RE = re.compile(
+    "^" + re.escape(PROMPTS["summarize_batch_item"].split("{item_id}")[0]) + r"(\S+)\s*$",
+    re.M,
+)
+_BATCH_MARKER = _prompt_markers(PROMPTS["summarize_batch"], "{items}")[1].strip()
+
+
+def _words(text: str) -> list[str]:
+    return list(dict.fromkeys(re.findall(r"[A-Za-z][A-Za-z0-9_.-]{3,}", text)))
+
+
+def _between(text: str, before: str, after: str) -> str:
+    text = text.split(before)[-1] if before else text
+    return text.split(after)[0] if after else text
+
+
+def count_tokens(text: str) -> int:
+    """Whitespace tokens, used for the usage and the generation time"""
+    return len(text.split())
+
+
+class FakeOpenAI:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        latency_sigma: float = 0.0,
+        tokens_per_second: float = 0.0,
+        rate_429: float = 0.0,
+        requests_per_minute: float = 0.0,
+        embedding_dim: int = 1536,
+        max_entities: int = 8,
+        seed: int = 0,
+    ):
+        """
+        latency: median seconds before the first token, log-normal with latency_sigma
+        tokens_per_second: generation speed of the completion, 0 for instant
+        rate_429: probability of a 429 response
+        requests_per_minute: 429 beyond this many requests in the last minute, 0 for no limit
+        """
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.rate_429 = rate_429
+        self.requests_per_minute = requests_per_minute
+        self.embedding_dim = embedding_dim
+        self.max_entities = max_entities
+        self._random = random.Random(seed)
+        self._request_times = []
+        self.stats = {"chat": 0, "embeddings": 0, "rate_limited": 0, "prompt_tokens": 0}
+
+    # ---------------- responses ----------------
+
+    def _extraction_response(self, text: str) -> str:
+        tuple_delimiter = PROMPTS["DEFAULT_TUPLE_DELIMITER"]
+        record_delimiter = PROMPTS["DEFAULT_RECORD_DELIMITER"]
+        names = _words(text)[: self.max_entities]
+        records = []
+        for name in names:
+            records.append(
+                tuple_delimiter.join(
+                    ['("Entity"', name, "Concept", f"{name} in the text", f"mentions: {text.count(name)})"]
+                )
+            )
+        for a, b in zip(names, names[1:]):
+            records.append(
+                tuple_delimiter.join(
+                    ['("Low-order Hyperedge"', a, b, f"{a} appears with {b}", "RELATES", "5)"]
+                )
+            )
+        if len(names) >= 3:
+            records.append(
+                tuple_delimiter.join(['("High-level keywords"', ", ".join(names[:3]) + ")"])
+            )
+            records.append(
+                tuple_delimiter.join(
+                    ['("High-order Hyperedge"', *names[:3]]
+                    + [f"{', '.join(names[:3])} appear together", "Co-occurrence", "CONTEXT", "7)"]
+                )
+            )
+        return record_delimiter.join(records) + PROMPTS["DEFAULT_COMPLETION_DELIMITER"]
+
+    def _keywords_response(self, query: str) -> str:
+        words = _words(query)
+        return json.dumps(
+            {"high_level_keywords": words[:3], "low_level_keywords": words},
+            ensure_ascii=False,
+        )
+
+    def _batch_summary_response(self, prompt: str) -> str:
+        items = prompt.split(_BATCH_MARKER)[0]
+        return json.dumps(
+            {item_id: f"Summary of item {item_id}" for item_id in _BATCH_ITEM_RE.findall(items)}
+        )
+
+    def completion_text(self, messages: list[dict]) -> str:
+        prompt = messages[-1]["content"] if messages else ""
+        has_system = any(m["role"] == "system" for m in messages)
+        if _EXTRACTION_BEFORE in prompt:
+            return self._extraction_response(
+                _between(prompt, _EXTRACTION_BEFORE, _EXTRACTION_AFTER)
+            )
+        if prompt == PROMPTS["entity_continue_extraction"]:
+            return PROMPTS["DEFAULT_COMPLETION_DELIMITER"]
+        if prompt == PROMPTS["entity_if_loop_extraction"]:
+            return "NO"
+        if _KEYWORDS_BEFORE in prompt:
+            return self._keywords_response(_between(prompt, _KEYWORDS_BEFORE, _KEYWORDS_AFTER))
+        if _BATCH_MARKER and _BATCH_MARKER in prompt:
+            return self._batch_summary_response(prompt)
+        if has_system:
+            words = _words(prompt)
+            return " ".join(
+                ["The", "answer", "is", "based", "on"] + words[:20] + ["and", "related", "sources."]
+            )
+        # a description summary, keep the first description
+        return prompt.split(GRAPH_FIELD_SEP)[0][-400:].strip() or "summary"
+
+    def embedding(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.embedding_dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()) or [text]:
+            h = int.from_bytes(hashlib.md5(word.encode()).digest()[:8], "little")
+            vector[h % self.embedding_dim] += 1.0 if (h >> 63) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # ---------------- timing ----------------
+
+    def _check_rate_limit(self):
+        now = time.monotonic()
+        if self.requests_per_minute:
+            self._request_times = [t for t in self._request_times if now - t < 60.0]
+            if len(self._request_times) >= self.requests_per_minute:
+                self.stats["rate_limited"] += 1
+                raise FakeRateLimitError(60.0 - (now - self._request_times[0]))
+        if self.rate_429 and self._random.random() < self.rate_429:
+            self.stats["rate_limited"] += 1
+            raise FakeRateLimitError(1.0)
+        self._request_times.append(now)
+
+    async def _first_token_delay(self):
+        if self.latency <= 0:
+            return
+        delay = self.latency
+        if self.latency_sigma > 0:
+            delay *= self._random.lognormvariate(0.0, self.latency_sigma)
+        await asyncio.sleep(delay)
+
+    async def chat(self, messages: list[dict]) -> str:
+        self._check_rate_limit()
+        self.stats["chat"] += 1
+        self.stats["prompt_tokens"] += sum(count_tokens(m["content"]) for m in messages)
+        await self._first_token_delay()
+        text = self.completion_text(messages)
+        if self.tokens_per_second > 0:
+            await asyncio.sleep(count_tokens(text) / self.tokens_per_second)
+        return text
+
+    async def chat_stream(self, messages: list[dict]):
+        self._check_rate_limit()
+        self.stats["chat"] += 1
+        self.stats["prompt_tokens"] += sum(count_tokens(m["content"]) for m in messages)
+        await self._first_token_delay()
+        for i, token in enumerate(re.split(r"(?<=\s)", self.completion_text(messages))):
+            if i and self.tokens_per_second > 0:
+                await asyncio.sleep(1.0 / self.tokens_per_second)
+            yield token
+
+    async def embeddings(self, texts: list[str]) -> np.ndarray:
+        self._check_rate_limit()
+        self.stats["embeddings"] += 1
+        self.stats["prompt_tokens"] += sum(count_tokens(t) for t in texts)
+        await self._first_token_delay()
+        return np.array([self.embedding(t) for t in texts])
+
+    # ---------------- in-process transport ----------------
+
+    def complete_func(self):
+        """llm_model_func of HyperRAG answered in-process"""
+        from .utils import streamable
+
+
+        @streamable
+        async def fake_complete(prompt, system_prompt=None, history_messages=[], **kwargs):
+            messages = []
+            if system_prompt:
+                messages.append({"role": "system", "content": system_prompt})
+            messages.extend(history_messages)
+            messages.append({"role": "user", "content": prompt})
+            if kwargs.get("stream"):
+                return self.chat_stream(messages)
+            return await self.chat(messages)
+
+        return fake_complete
+
+    def embedding_func(self):
+        """EmbeddingFunc of HyperRAG answered in-process"""
+        from .utils import EmbeddingFunc
+
+        return EmbeddingFunc(
+            embedding_dim=self.embedding_dim, max_token_size=8192, func=self.embeddings
+        )
+
+    # ---------------- HTTP server ----------------
+
+    def make_app(self):
+        from aiohttp import web
+
+        def rate_limited_response(e: FakeRateLimitError):
+            return web.json_response(
+                {"error": {"message": str(e), "type": "rate_limit_exceeded", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers=e.headers,
+            )
+
+        async def chat_completions(request):
+            body = await request.json()
+            model = body.get("model", "fake")
+            created = int(time.time())
+            completion_id = f"chatcmpl-{created}{self._random.randrange(10**6)}"
+            try:
+                if not body.get("stream"):
+                    text = await self.chat(body["messages"])
+                    prompt_tokens = sum(count_tokens(m["content"]) for m in body["messages"])
+                    return web.json_response(
+                        {
+                            "id": completion_id,
+                            "object": "chat.completion",
+                            "created": created,
+                            "model": model,
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {"role": "assistant", "content": text},
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                            "usage": {
+                                "prompt_tokens": prompt_tokens,
+                                "completion_tokens": count_tokens(text),
+                                "total_tokens": prompt_tokens + count_tokens(text),
+                            },
+                        }
+                    )
+                tokens = self.chat_stream(body["messages"])
+                first = await tokens.__anext__()
+            except FakeRateLimitError as e:
+                return rate_limited_response(e)
+
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+
+            def chunk(delta: dict, finish_reason=None) -> bytes:
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode()
+
+            await response.write(chunk({"role": "assistant", "content": first}))
+            async for token in tokens:
+                await response.write(chunk({"content": token}))
+            await response.write(chunk({}, "stop"))
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+            return response
+
+        async def embeddings(request):
+            body = await request.json()
+            texts = body["input"]
+            texts = [texts] if isinstance(texts, str) else texts
+            try:
+                vectors = await self.embeddings(texts)
+            except FakeRateLimitError as e:
+                return rate_limited_response(e)
+            if body.get("encoding_format") == "base64":
+                data = [base64.b64encode(v.astype(np.float32).tobytes()).decode() for v in vectors]
+            else:
+                data = [v.tolist() for v in vectors]
+            num_tokens = sum(count_tokens(t) for t in texts)
+            return web.json_response(
+                {
+                    "object": "list",
+                    "data": [
+                        {"object": "embedding", "index": i, "embedding": d} for i, d in enumerate(data)
+                    ],
+                    "model": body.get("model", "fake"),
+                    "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens},
+                }
+            )
+
+        async def stats(request):
+            return web.json_response(self.stats)
+
+        app = web.Application(client_max_size=64 * 1024**2)
+        app.router.add_post("/v1/chat/completions", chat_completions)
+        app.router.add_post("/v1/embeddings", embeddings)
+        app.router.add_get("/v1/stats", stats)
+        return app
+
+    async def start_server(self, host: str = "127.0.0.1", port: int = 8000):
+        """Serve in the running event loop, returns the runner to clean up"""
+        from aiohttp import web
+
+        runner = web.AppRunner(self.make_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--requests-per-minute", type=float, default=0.0)
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    args = parser.parse_args()
+
+    from aiohttp import web
+
+    fake = FakeOpenAI(
+        latency=args.latency,
+        latency_sigma=args.latency_sigma,
+        tokens_per_second=args.tokens_per_second,
+        rate_429=args.rate_429,
+        requests_per_minute=args.requests_per_minute,
+        embedding_dim=args.embedding_dim,
+    )
+    web.run_app(fake.make_app(), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,28 @@
 import os
+import json
+import time
 import asyncio
-from dataclasses import asdict, dataclass, field
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field, replace
 from datetime import datetime
 from functools import partial
-from typing import Type, cast
+from pathlib import Path
+from typing import AsyncIterable, Iterable, Type, Union, cast
+
+import numpy as np
 
 from .operate import (
+    chunking_by_content_defined,
+    chunking_by_content_defined_stream,
     chunking_by_token_size,
+    chunking_by_token_size_stream,
+    delete_chunks_from_hypergraph,
     extract_entities,
+    extract_entities_pipeline,
+    link_duplicate_chunks,
+    advance_deferred_extraction,
+    deferred_extraction_state,
+    merge_deferred_extractions,
     hyper_query_lite,
     hyper_query,
     naive_query,
@@ -15,21 +30,37 @@ from .operate import (
     llm_query,
 )
 from .llm import (
+    close_api_clients,
     gpt_4o_mini_complete,
     openai_embedding,
+    set_api_client_limits,
 )
 
+from .prompt import PROMPTS
 from .storage import (
     JsonKVStorage,
+    JsonlKVStorage,
     NanoVectorDBStorage,
     HypergraphStorage,
+    MemmapEmbeddingCache,
 )
 
 
 from .utils import (
     EmbeddingFunc,
+    EmbeddingMicroBatcher,
+    MinHashLSH,
+    compute_args_hash,
     compute_mdhash_id,
+    compute_mdhash_id_by_stream,
+    count_async_func_call,
+    count_embedding_call_tokens,
+    count_llm_call_tokens,
     limit_async_func_call,
+    single_flight_func_call,
+    RateLimiter,
+    call_priority,
+    CALL_PRIORITY_QUERY,
     convert_response_to_json,
     logger,
     set_logger,
@@ -40,9 +71,28 @@ from .base import (
     StorageNameSpace,
     QueryParam,
     BaseHypergraphStorage,
+    TextChunkSchema,
 )
 
 
+def _chunk_document(
+    doc_key: str, content: str, chunking_func: callable
+) -> dict[str, TextChunkSchema]:
+    return {
+        compute_mdhash_id(dp["content"], prefix="chunk-"): {
+            **dp,
+            "full_doc_id": doc_key,
+            "full_doc_ids": [doc_key],
+        }
+        for dp in chunking_func(content)
+    }
+
+
+def _chunk_doc_ids(chunk_dp: TextChunkSchema) -> list[str]:
+    """The docs containing the chunk, only `full_doc_id` is stored by older versions"""
+    return chunk_dp.get("full_doc_ids") or [chunk_dp["full_doc_id"]]
+
+
 def always_get_an_event_loop() -> asyncio.AbstractEventLoop:
     try:
         return asyncio.get_event_loop()
@@ -69,6 +119,23 @@ class HyperRAG:
     chunk_token_size: int = 1200
     chunk_overlap_token_size: int = 100
     tiktoken_model_name: str = "gpt-4o-mini"
+    # "token_size": fixed windows of chunk_token_size with overlap
+    # "content_defined": rolling hash boundaries between chunk_min_token_size and chunk_token_size
+    # tokens, without overlap, so that an edit of a document only changes the chunks around it
+    chunking_mode: str = "token_size"
+    chunk_min_token_size: int = 256
+    chunk_avg_token_size: int = 768
+    # file paths and text streams are read and chunked lazily, and extracted in batches
+    chunk_stream_read_size: int = 65536
+    chunk_stream_batch_size: int = 64
+    # chunk multiple documents in a process pool, 0 to chunk on the event loop
+    chunk_process_pool_workers: int = 0
+    # skip the extraction of near-duplicate chunks (MinHash LSH over word shingles),
+    # they are added to the source_id of their canonical chunk instead
+    enable_chunk_dedup: bool = False
+    chunk_dedup_threshold: float = 0.9
+    chunk_dedup_num_perm: int = 128
+    chunk_dedup_shingle_size: int = 5
 
     # entity extraction
     entity_extract_max_gleaning: int = 1
@@ -76,10 +143,35 @@ class HyperRAG:
     entity_additional_properties_to_max_tokens: int = 250
     relation_summary_to_max_tokens: int = 750
     relation_keywords_to_max_tokens: int = 100
+    # pack the summaries of many entities / hyperedges into one prompt when merging, at
+    # most summary_batch_max_items items whose max summary tokens add up to at most
+    # summary_batch_max_output_tokens
+    enable_batch_summary: bool = False
+    summary_batch_max_items: int = 16
+    summary_batch_max_output_tokens: int = 4096
+    # overlap chunk embedding, extraction, merge and vdb upsert through bounded queues
+    enable_insert_pipeline: bool = False
+    insert_pipeline_queue_size: int = 64
 
     embedding_func: EmbeddingFunc = field(default_factory=lambda: openai_embedding)
+    # the vdb upserts pack the texts into embedding requests of at most embedding_batch_num
+    # texts and embedding_batch_max_tokens tokens (0 for no limit and no token counting),
+    # with a limit texts beyond the max_token_size of the embedding_func are cut
+    # ("truncate") or embedded in pieces which are averaged ("split")
     embedding_batch_num: int = 32
+    embedding_batch_max_tokens: int = 0
+    embedding_over_length: str = "truncate"
+    # concurrent query embeddings of the vdbs are sent as one request after waiting at
+    # most embedding_micro_batch_wait seconds (0 to disable) or once
+    # embedding_micro_batch_size texts are waiting
+    embedding_micro_batch_wait: float = 0
+    embedding_micro_batch_size: int = 64
     embedding_func_max_async: int = 16
+    # embeddings are cached on disk by (model, dimension, text), shared by all the vector
+    # dbs, embedding_model_name is required to enable the cache
+    enable_embedding_cache: bool = False
+    embedding_model_name: str = ""
+    embedding_cache_max_entries: int = 1_000_000
 
     # LLM
     llm_model_func: callable = gpt_4o_mini_complete  # hf_model_complete#
@@ -88,6 +180,20 @@ class HyperRAG:
     llm_model_max_token_size: int = 32768
     llm_model_max_async: int = 16
     llm_model_kwargs: dict = field(default_factory=dict)
+    # connection pool of the long-lived API clients shared by the llm and embedding calls,
+    # process-wide: only the first HyperRAG instance sets it
+    api_max_connections: int = 100
+    api_max_keepalive_connections: int = 20
+    # requests / tokens per minute budgets of the llm and embedding calls, 0 for unlimited
+    llm_model_requests_per_minute: int = 0
+    llm_model_tokens_per_minute: int = 0
+    embedding_requests_per_minute: int = 0
+    embedding_tokens_per_minute: int = 0
+    # shrink the concurrency below *_max_async on rate limit errors and latencies above
+    # rate_limit_target_latency seconds (0 to ignore latency), and grow it back on success
+    enable_adaptive_concurrency: bool = False
+    rate_limit_target_latency: float = 0
+    rate_limit_max_retries: int = 5
 
     # storage
     key_string_value_json_storage_cls: Type[BaseKVStorage] = JsonKVStorage
@@ -95,6 +201,24 @@ class HyperRAG:
     vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
     hypergraph_storage_cls: Type[BaseHypergraphStorage] = HypergraphStorage
     enable_llm_cache: bool = True
+    # storage of the llm response cache, SqliteCacheKVStorage keeps it in SQLite with LRU
+    # eviction beyond the entries / bytes limits and expiry after llm_cache_ttl seconds,
+    # 0 for no limit, the limits only apply to it
+    llm_response_cache_storage_cls: Type[BaseKVStorage] = JsonKVStorage
+    llm_cache_max_entries: int = 0
+    llm_cache_max_bytes: int = 0
+    llm_cache_ttl: float = 0
+    # checkpoint the extraction of every chunk, so that an interrupted insert can resume
+    extraction_checkpoint_storage_cls: Type[BaseKVStorage] = JsonlKVStorage
+    enable_extraction_checkpoint: bool = False
+
+    # answer paraphrases of earlier queries with the same QueryParam from a cache keyed on
+    # the query embedding, the cache is cleared whenever the hypergraph changes
+    enable_query_cache: bool = False
+    query_cache_similarity_threshold: float = 0.95
+    query_cache_top_k: int = 10
+    # new entries are saved by the first query done this many seconds after the last save
+    query_cache_save_interval: float = 10.0
 
     # extension
     addon_params: dict = field(default_factory=dict)
@@ -114,6 +238,8 @@ class HyperRAG:
             logger.info(f"Creating working directory {self.working_dir}")
             os.makedirs(self.working_dir)
 
+        set_api_client_limits(self.api_max_connections, self.api_max_keepalive_connections)
+
         self.full_docs = self.key_string_value_json_storage_cls(
             namespace="full_docs", global_config=asdict(self)
         )
@@ -123,12 +249,43 @@ class HyperRAG:
         )
 
         self.llm_response_cache = (
-            self.key_string_value_json_storage_cls(
+            self.llm_response_cache_storage_cls(
                 namespace="llm_response_cache", global_config=asdict(self)
             )
             if self.enable_llm_cache
             else None
         )
+
+        self.extraction_checkpoint = (
+            self.extraction_checkpoint_storage_cls(
+                namespace="extraction_checkpoint", global_config=asdict(self)
+            )
+            if self.enable_extraction_checkpoint
+            else None
+        )
+        # state of the chunks exported by aexport_extraction_requests, until their
+        # completions are ingested
+        self.deferred_extraction = self.extraction_checkpoint_storage_cls(
+            namespace="deferred_extraction", global_config=asdict(self)
+        )
+        # set while exporting, the request file the extraction requests are written to
+        self._deferred_extraction_file = None
+        self._deferred_extraction_model = None
+        self._deferred_extraction_count = 0
+        # the parsed extraction of every inserted chunk, deleting a doc merges the
+        # remaining chunks of the affected entities again from it
+        self.chunk_extractions = self.key_string_value_json_storage_cls(
+            namespace="chunk_extractions", global_config=asdict(self)
+        )
+        self.chunk_signatures = (
+            self.key_string_value_json_storage_cls(
+                namespace="chunk_minhash", global_config=asdict(self)
+            )
+            if self.enable_chunk_dedup
+            else None
+        )
+        # loaded from chunk_signatures on first use
+        self._chunk_dedup = None
         """
             download from hgdb_path
         """
@@ -136,85 +293,528 @@ class HyperRAG:
             namespace="chunk_entity_relation", global_config=asdict(self)
         )
 
-        self.embedding_func = limit_async_func_call(self.embedding_func_max_async)(
-            self.embedding_func
+        self.embedding_rate_limiter = self._rate_limiter(
+            "embedding",
+            self.embedding_func_max_async,
+            self.embedding_requests_per_minute,
+            self.embedding_tokens_per_minute,
+            count_embedding_call_tokens,
+        )
+        if self.enable_embedding_cache and not self.embedding_model_name:
+            logger.warning(
+                "The embedding cache needs embedding_model_name, it is disabled"
+            )
+        self.embedding_cache = (
+            MemmapEmbeddingCache(
+                namespace="embedding_cache",
+                global_config=asdict(self),
+                embedding_dim=self.embedding_func.embedding_dim,
+                model_name=self.embedding_model_name,
+            )
+            if self.enable_embedding_cache and self.embedding_model_name
+            else None
         )
+        self.embedding_func = limit_async_func_call(
+            self.embedding_func_max_async, self.embedding_rate_limiter
+        )(self.embedding_func)
+        # the query embeddings of the vdbs, the upserts are packed by the vdbs themselves
+        self.query_embedding_func = self.embedding_func
+        self.embedding_micro_batcher = None
+        if self.embedding_micro_batch_wait > 0:
+            self.embedding_micro_batcher = EmbeddingMicroBatcher(
+                self.embedding_func,
+                max_wait=self.embedding_micro_batch_wait,
+                max_batch_size=self.embedding_micro_batch_size,
+            )
+            self.query_embedding_func = EmbeddingFunc(
+                embedding_dim=self.embedding_func.embedding_dim,
+                max_token_size=self.embedding_func.max_token_size,
+                func=self.embedding_micro_batcher,
+            )
+        if self.embedding_cache is not None:
+            # hits are served without taking a slot of the limiter
+            self.embedding_func = self.embedding_cache.wrap(self.embedding_func)
+            self.query_embedding_func = self.embedding_cache.wrap(self.query_embedding_func)
 
         self.entities_vdb = self.vector_db_storage_cls(
             namespace="entities",
             global_config=asdict(self),
             embedding_func=self.embedding_func,
-            meta_fields={"entity_name"},
+            query_embedding_func=self.query_embedding_func,
+            meta_fields={"entity_name", "content_hash"},
         )
         self.relationships_vdb = self.vector_db_storage_cls(
             namespace="relationships",
             global_config=asdict(self),
             embedding_func=self.embedding_func,
-            meta_fields={"id_set"},
+            query_embedding_func=self.query_embedding_func,
+            meta_fields={"id_set", "content_hash"},
         )
         self.chunks_vdb = self.vector_db_storage_cls(
             namespace="chunks",
             global_config=asdict(self),
             embedding_func=self.embedding_func,
+            query_embedding_func=self.query_embedding_func,
+        )
+        self.query_cache = (
+            self.key_string_value_json_storage_cls(
+                namespace="query_cache", global_config=asdict(self)
+            )
+            if self.enable_query_cache
+            else None
         )
+        self.query_cache_vdb = (
+            self.vector_db_storage_cls(
+                namespace="query_cache",
+                global_config=asdict(self),
+                embedding_func=self.embedding_func,
+                query_embedding_func=self.query_embedding_func,
+                meta_fields={"params_key"},
+            )
+            if self.enable_query_cache
+            else None
+        )
+        # bumped when the query cache is cleared, answers of queries that ran across a
+        # change of the hypergraph are not cached
+        self._query_cache_generation = 0
+        # set when chunks are inserted or deleted, the query cache is cleared by _insert_done
+        self._hypergraph_changed = False
+        # entries stored since the last save, and its time
+        self._query_cache_unsaved = 0
+        self._query_cache_saved_at = time.time()
 
-        self.llm_model_func = limit_async_func_call(self.llm_model_max_async)(
-            partial(
-                self.llm_model_func,
-                hashing_kv=self.llm_response_cache,
-                **self.llm_model_kwargs,
+        self.llm_rate_limiter = self._rate_limiter(
+            "llm",
+            self.llm_model_max_async,
+            self.llm_model_requests_per_minute,
+            self.llm_model_tokens_per_minute,
+            count_llm_call_tokens,
+        )
+        # identical calls in flight share one call, and one slot of the limiter
+        self.llm_model_func = count_async_func_call(
+            single_flight_func_call(
+                limit_async_func_call(self.llm_model_max_async, self.llm_rate_limiter)(
+                    partial(
+                        self.llm_model_func,
+                        hashing_kv=self.llm_response_cache,
+                        **self.llm_model_kwargs,
+                    )
+                )
             )
         )
+        # serializes the hypergraph merges of concurrent inserts and deletes
+        self._merge_lock = asyncio.Lock()
+        # process pool of the chunking, created on first use
+        self._chunk_executor = None
 
-    def insert(self, string_or_strings):
+    def _rate_limiter(
+        self, name, max_concurrency, requests_per_minute, tokens_per_minute, count_tokens
+    ):
+        if not (
+            requests_per_minute or tokens_per_minute or self.enable_adaptive_concurrency
+        ):
+            return None
+        return RateLimiter(
+            max_concurrency,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            count_tokens=partial(count_tokens, model_name=self.tiktoken_model_name),
+            adaptive_concurrency=self.enable_adaptive_concurrency,
+            target_latency=self.rate_limit_target_latency,
+            max_retries=self.rate_limit_max_retries,
+            name=name,
+        )
+
+    def insert(self, string_or_strings=None, resume: bool = False):
         loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.ainsert(string_or_strings))
+        return loop.run_until_complete(self.ainsert(string_or_strings, resume=resume))
+
+    async def ainsert(self, string_or_strings=None, resume: bool = False):
+        """Insert documents. A document is either a string holding its content, or a
+        file path (os.PathLike) / seekable text stream which is chunked lazily.
 
-    async def ainsert(self, string_or_strings):
+        With enable_extraction_checkpoint, the extraction result of every chunk is
+        checkpointed until its document is saved. With resume=True the file documents of
+        interrupted inserts are inserted again first, the documents passed as strings are
+        only recorded by id and have to be passed again. Their chunks reuse the
+        checkpointed extraction results.
+        """
+        done_keys = []
         try:
-            if isinstance(string_or_strings, str):
+            if string_or_strings is None:
+                string_or_strings = []
+            elif isinstance(string_or_strings, (str, os.PathLike)) or hasattr(
+                string_or_strings, "read"
+            ):
                 string_or_strings = [string_or_strings]
+            if resume:
+                string_or_strings = await self._checkpointed_docs() + list(
+                    string_or_strings
+                )
 
-            new_docs = {
-                compute_mdhash_id(c.strip(), prefix="doc-"): {"content": c.strip()}
-                for c in string_or_strings
-            }
-            _add_doc_keys = await self.full_docs.filter_keys(list(new_docs.keys()))
-            new_docs = {k: v for k, v in new_docs.items() if k in _add_doc_keys}
-            if not len(new_docs):
-                logger.warning("All docs are already in the storage")
+            for source in string_or_strings:
+                if not isinstance(source, str):
+                    done_keys += await self._insert_stream_doc(source)
+            done_keys += await self._insert_docs(
+                [s for s in string_or_strings if isinstance(s, str)]
+            )
+        finally:
+            await self._insert_done()
+            # only once the inserted docs are saved
+            await self._clear_checkpoint(done_keys)
+
+    def insert_stream(self, sources, **kwargs):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.ainsert_stream(sources, **kwargs))
+
+    async def ainsert_stream(
+        self,
+        sources: Union[str, os.PathLike, Iterable, AsyncIterable],
+        max_in_flight_docs: int = 16,
+        pattern: str = "*",
+        save_every_docs: int = 1000,
+        report_interval: float = 10.0,
+    ) -> dict:
+        """Bulk insert documents pulled lazily from `sources`: a directory (its files matching
+        `pattern`, recursively), a file, or a sync / async iterable of document strings,
+        file or directory paths and seekable text streams. A string naming an existing
+        file or directory is read as its path, at the top level and in the iterables.
+
+        At most `max_in_flight_docs` documents are inserted at a time. Every document is
+        hashed (streamed for files) and skipped if it is already stored before it is chunked,
+        documents from which nothing new is extracted are counted as skipped too.
+        The storages are saved every `save_every_docs` inserted documents, and the
+        throughput is logged every `report_interval` seconds. Returns the final statistics.
+        """
+        stats = dict(docs=0, skipped=0, failed=0, chunks=0, llm_calls=0)
+        start_time = last_report = time.time()
+        start_llm_calls = self.llm_model_func.num_calls
+        in_flight_keys = set()
+        pending_keys = []
+        docs_since_save = 0
+
+        def _report():
+            elapsed = max(time.time() - start_time, 1e-6)
+            stats["llm_calls"] = self.llm_model_func.num_calls - start_llm_calls
+            stats["docs_per_second"] = stats["docs"] / elapsed
+            stats["chunks_per_second"] = stats["chunks"] / elapsed
+            stats["llm_calls_per_second"] = stats["llm_calls"] / elapsed
+            logger.info(
+                f"[Insert Stream] {stats['docs']} docs ({stats['skipped']} skipped, {stats['failed']} failed), "
+                f"{stats['chunks']} chunks, {stats['llm_calls']} LLM calls in {elapsed:.1f}s | "
+                f"{stats['docs_per_second']:.2f} docs/s, {stats['chunks_per_second']:.2f} chunks/s, "
+                f"{stats['llm_calls_per_second']:.2f} LLM calls/s"
+            )
+
+        async def _insert_one(source):
+            nonlocal docs_since_save, pending_keys, last_report
+            try:
+                if isinstance(source, str):
+                    doc_key = compute_mdhash_id(source.strip(), prefix="doc-")
+                elif isinstance(source, os.PathLike):
+                    doc_key = await asyncio.to_thread(self._hash_file, source)
+                else:
+                    doc_key = await asyncio.to_thread(
+                        compute_mdhash_id_by_stream,
+                        source,
+                        prefix="doc-",
+                        read_size=self.chunk_stream_read_size,
+                    )
+                if doc_key in in_flight_keys or not len(
+                    await self.full_docs.filter_keys([doc_key])
+                ):
+                    stats["skipped"] += 1
+                    return
+                in_flight_keys.add(doc_key)
+                try:
+                    if isinstance(source, str):
+                        done_keys = await self._insert_docs([source])
+                    else:
+                        done_keys = await self._insert_stream_doc(source, doc_key=doc_key)
+                finally:
+                    in_flight_keys.discard(doc_key)
+            except Exception as e:
+                # the doc stays in the extraction checkpoint, insert(resume=True) retries it
+                stats["failed"] += 1
+                logger.error(f"Failed to insert {getattr(source, 'name', source)!s:.100}: {e}")
                 return
-            # ----------------------------------------------------------------------------
-            logger.info(f"[New Docs] inserting {len(new_docs)} docs")
+            if not len(done_keys):
+                # nothing new was extracted from it, the warning is logged by the insert
+                stats["skipped"] += 1
+                return
+            stats["docs"] += 1
+            stats["chunks"] += sum(1 for k in done_keys if k.startswith("chunk-"))
+            pending_keys += done_keys
+            docs_since_save += 1
+            if docs_since_save >= save_every_docs:
+                docs_since_save = 0
+                saving_keys, pending_keys = pending_keys, []
+                await self._insert_done()
+                await self._clear_checkpoint(saving_keys)
+            if time.time() - last_report >= report_interval:
+                last_report = time.time()
+                _report()
+
+        semaphore = asyncio.Semaphore(max_in_flight_docs)
+        tasks = set()
+
+        async def _run(source):
+            try:
+                await _insert_one(source)
+            finally:
+                semaphore.release()
+
+        try:
+            async for source in self._iter_stream_sources(sources, pattern):
+                await semaphore.acquire()
+                task = asyncio.create_task(_run(source))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks):
+                await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            await self._insert_done()
+            await self._clear_checkpoint(pending_keys)
+        _report()
+        return stats
+
+    def _hash_file(self, file_path: os.PathLike) -> str:
+        with open(file_path, "r", encoding="utf-8") as f:
+            return compute_mdhash_id_by_stream(
+                f, prefix="doc-", read_size=self.chunk_stream_read_size
+            )
+
+    @staticmethod
+    async def _iter_stream_sources(sources, pattern: str = "*"):
+        """Yield the documents of ainsert_stream one by one, directories are walked lazily"""
+        if isinstance(sources, (str, os.PathLike)):
+            sources = [sources]
+
+        async def _sources():
+            if hasattr(sources, "__aiter__"):
+                async for source in sources:
+                    yield source
+            else:
+                for source in sources:
+                    yield source
+
+        async for source in _sources():
+            # a string is a path if it names an existing file or directory
+            if isinstance(source, str) and os.path.exists(source):
+                source = Path(source)
+            if isinstance(source, os.PathLike) and os.path.isdir(source):
+                for file_path in Path(source).rglob(pattern):
+                    if file_path.is_file():
+                        yield file_path
+            else:
+                yield source
+
+    async def _insert_docs(self, string_or_strings: list[str]) -> list[str]:
+        """Insert documents held in memory, returns the keys of the inserted docs and chunks"""
+        if not len(string_or_strings):
+            return []
+        new_docs = {
+            compute_mdhash_id(c.strip(), prefix="doc-"): {"content": c.strip()}
+            for c in string_or_strings
+        }
+        _add_doc_keys = await self.full_docs.filter_keys(list(new_docs.keys()))
+        await self._extract_deferred_chunks(set(new_docs) - set(_add_doc_keys))
+        new_docs = {k: v for k, v in new_docs.items() if k in _add_doc_keys}
+        if not len(new_docs):
+            logger.warning("All docs are already in the storage")
+            return []
+        # ----------------------------------------------------------------------------
+        logger.info(f"[New Docs] inserting {len(new_docs)} docs")
+        if self.extraction_checkpoint is not None:
+            # only the ids, the content is passed again to resume
+            await self.extraction_checkpoint.upsert({k: {} for k in new_docs})
+
+        chunking_func = self._chunking_func()
+        chunking_args = [
+            (doc_key, doc["content"], chunking_func) for doc_key, doc in new_docs.items()
+        ]
+        if self.chunk_process_pool_workers > 0 and len(chunking_args) > 1:
+            # tokenization is pure CPU, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            executor = self._get_chunk_executor()
+            chunks_list = await asyncio.gather(
+                *[
+                    loop.run_in_executor(executor, _chunk_document, *args)
+                    for args in chunking_args
+                ]
+            )
+        else:
+            chunks_list = [_chunk_document(*args) for args in chunking_args]
 
+        inserting_chunks = {}
+        for chunks in chunks_list:
+            inserting_chunks.update(chunks)
+        if not await self._insert_chunks(inserting_chunks):
+            # nothing was extracted, resuming would not do better
+            await self._clear_checkpoint(list(new_docs) + list(inserting_chunks))
+            return []
+        await self._add_chunk_doc_ids(
+            {doc_key: list(chunks) for doc_key, chunks in zip(new_docs, chunks_list)}
+        )
+        await self.full_docs.upsert(new_docs)
+        return list(new_docs) + list(inserting_chunks)
+
+    async def _add_chunk_doc_ids(self, doc_chunk_keys: dict[str, list[str]]):
+        """Add the docs to the `full_doc_ids` of their chunks, the chunks already stored
+        for another doc are not inserted again and only get the doc added here.
+        """
+        chunk_keys = list(set(k for keys in doc_chunk_keys.values() for k in keys))
+        chunks = dict(zip(chunk_keys, await self.text_chunks.get_by_ids(chunk_keys)))
+        updated = {}
+        for doc_key, keys in doc_chunk_keys.items():
+            for k in keys:
+                chunk_dp = updated.get(k) or chunks[k]
+                if chunk_dp is None or doc_key in _chunk_doc_ids(chunk_dp):
+                    continue
+                updated[k] = {**chunk_dp, "full_doc_ids": _chunk_doc_ids(chunk_dp) + [doc_key]}
+        if len(updated):
+            await self.text_chunks.delete(list(updated))
+            await self.text_chunks.upsert(updated)
+
+    def _get_chunk_executor(self) -> ProcessPoolExecutor:
+        # one pool for the lifetime of the instance, shut down by aclose
+        if self._chunk_executor is None:
+            self._chunk_executor = ProcessPoolExecutor(
+                max_workers=self.chunk_process_pool_workers
+            )
+        return self._chunk_executor
+
+    async def _insert_stream_doc(self, source, doc_key: str = None) -> list[str]:
+        """Insert a file path or seekable text stream, returns the keys of the inserted doc and chunks"""
+        if isinstance(source, os.PathLike):
+            with open(source, "r", encoding="utf-8") as f:
+                return await self._insert_stream_doc(f, doc_key=doc_key)
+        if not source.seekable():
+            raise ValueError("Only file paths and seekable text streams can be inserted")
+
+        if doc_key is None:
+            # hash the whole document first, without holding it in memory
+            doc_key = compute_mdhash_id_by_stream(
+                source, prefix="doc-", read_size=self.chunk_stream_read_size
+            )
+            if not len(await self.full_docs.filter_keys([doc_key])):
+                await self._extract_deferred_chunks({doc_key})
+                logger.warning(f"Doc {doc_key} is already in the storage")
+                return []
+        source.seek(0)
+        doc_name = getattr(source, "name", None)
+        logger.info(f"[New Docs] inserting {doc_key} ({doc_name}) in streaming mode")
+        if self.extraction_checkpoint is not None:
+            await self.extraction_checkpoint.upsert({doc_key: {"file_path": doc_name}})
+
+        chunk_keys = []
+
+        def _chunks():
+            for dp in self._chunking_func(stream=True)(source):
+                chunk_key = compute_mdhash_id(dp["content"], prefix="chunk-")
+                chunk_keys.append(chunk_key)
+                yield chunk_key, {**dp, "full_doc_id": doc_key, "full_doc_ids": [doc_key]}
+
+        chunks = _chunks()
+        if self.enable_insert_pipeline and self._deferred_extraction_file is None:
+            all_inserted = await self._insert_chunks_pipeline(chunks)
+        else:
+            all_inserted = True
             inserting_chunks = {}
-            for doc_key, doc in new_docs.items():
-                chunks = {
-                    compute_mdhash_id(dp["content"], prefix="chunk-"): {
-                        **dp,
-                        "full_doc_id": doc_key,
-                    }
-                    for dp in chunking_by_token_size(
-                        doc["content"],
-                        overlap_token_size=self.chunk_overlap_token_size,
-                        max_token_size=self.chunk_token_size,
-                        tiktoken_model=self.tiktoken_model_name,
-                    )
-                }
-                inserting_chunks.update(chunks)
-            _add_chunk_keys = await self.text_chunks.filter_keys(
-                list(inserting_chunks.keys())
+            for chunk_key, chunk_dp in chunks:
+                inserting_chunks[chunk_key] = chunk_dp
+                if len(inserting_chunks) >= self.chunk_stream_batch_size:
+                    all_inserted &= await self._insert_chunks(inserting_chunks)
+                    inserting_chunks = {}
+            if len(inserting_chunks):
+                all_inserted &= await self._insert_chunks(inserting_chunks)
+        if not all_inserted:
+            await self._clear_checkpoint([doc_key] + chunk_keys)
+            return []
+        await self._add_chunk_doc_ids({doc_key: chunk_keys})
+        await self.full_docs.upsert({doc_key: {"file_path": doc_name}})
+        return [doc_key] + chunk_keys
+
+    def _chunking_func(self, stream: bool = False) -> callable:
+        """The chunking function of `chunking_mode`, a partial which can go to a process pool"""
+        if self.chunking_mode == "token_size":
+            return partial(
+                chunking_by_token_size_stream if stream else chunking_by_token_size,
+                overlap_token_size=self.chunk_overlap_token_size,
+                max_token_size=self.chunk_token_size,
+                tiktoken_model=self.tiktoken_model_name,
+                **({"read_size": self.chunk_stream_read_size} if stream else {}),
             )
-            inserting_chunks = {
-                k: v for k, v in inserting_chunks.items() if k in _add_chunk_keys
-            }
-            if not len(inserting_chunks):
-                logger.warning("All chunks are already in the storage")
-                return
-            # ----------------------------------------------------------------------------
+        if self.chunking_mode == "content_defined":
+            return partial(
+                chunking_by_content_defined_stream if stream else chunking_by_content_defined,
+                min_token_size=self.chunk_min_token_size,
+                avg_token_size=self.chunk_avg_token_size,
+                max_token_size=self.chunk_token_size,
+                tiktoken_model=self.tiktoken_model_name,
+                **({"read_size": self.chunk_stream_read_size} if stream else {}),
+            )
+        raise ValueError(f"Unknown chunking mode {self.chunking_mode}")
+
+    async def _checkpointed_docs(self) -> list:
+        """The documents whose insert was interrupted, as recorded in the checkpoint"""
+        if self.extraction_checkpoint is None:
+            return []
+        docs, passed_keys = [], []
+        for key in await self.extraction_checkpoint.all_keys():
+            if not key.startswith("doc-"):
+                continue
+            doc = await self.extraction_checkpoint.get_by_id(key)
+            if doc.get("file_path") is not None:
+                docs.append(Path(doc["file_path"]))
+            elif "file_path" in doc:
+                logger.warning(f"Can not resume {key}, it was inserted from an unnamed stream")
+            else:
+                passed_keys.append(key)
+        if len(passed_keys):
+            logger.warning(
+                f"[Resume] {len(passed_keys)} interrupted docs were passed as strings, "
+                f"insert them again to resume: {passed_keys}"
+            )
+        logger.info(f"[Resume] {len(docs)} interrupted docs")
+        return docs
+
+    async def _clear_checkpoint(self, keys: list[str]):
+        if self.extraction_checkpoint is not None:
+            await self.extraction_checkpoint.delete(keys)
+
+    async def _insert_chunks(self, inserting_chunks: dict[str, TextChunkSchema]) -> bool:
+        if self.enable_insert_pipeline and self._deferred_extraction_file is None:
+            return await self._insert_chunks_pipeline(inserting_chunks.items())
+        _add_chunk_keys = await self.text_chunks.filter_keys(
+            list(inserting_chunks.keys())
+        )
+        inserting_chunks = {
+            k: v for k, v in inserting_chunks.items() if k in _add_chunk_keys
+        }
+        if not len(inserting_chunks):
+            logger.warning("All chunks are already in the storage")
+            return True
+        duplicate_chunks, signatures = {}, {}
+        if self.enable_chunk_dedup:
+            dedup = await self._get_chunk_dedup()
+            inserting_chunks = dict(
+                self._iter_canonical_chunks(
+                    inserting_chunks.items(), dedup, duplicate_chunks, signatures
+                )
+            )
+        if self._deferred_extraction_file is not None:
+            return await self._defer_extraction(inserting_chunks, duplicate_chunks, signatures)
+        # ----------------------------------------------------------------------------
+        if len(inserting_chunks):
             logger.info(f"[New Chunks] inserting {len(inserting_chunks)} chunks")
 
             await self.chunks_vdb.upsert(inserting_chunks)
+            self._hypergraph_changed = True
             # ----------------------------------------------------------------------------
             logger.info("[Entity Extraction]...")
             maybe_new_kg = await extract_entities(
@@ -223,16 +823,334 @@ class HyperRAG:
                 entity_vdb=self.entities_vdb,
                 relationships_vdb=self.relationships_vdb,
                 global_config=asdict(self),
+                extraction_checkpoint=self.extraction_checkpoint,
+                merge_lock=self._merge_lock,
+                chunk_extractions=self.chunk_extractions,
             )
             if maybe_new_kg is None:
                 logger.warning("No new entities and relationships found")
-                return
+                return False
             # ----------------------------------------------------------------------------
             self.chunk_entity_relation_hypergraph = maybe_new_kg
-            await self.full_docs.upsert(new_docs)
             await self.text_chunks.upsert(inserting_chunks)
+        await self._insert_duplicate_chunks(duplicate_chunks, signatures)
+        return True
+
+    def _new_chunk_dedup(self) -> MinHashLSH:
+        return MinHashLSH(
+            threshold=self.chunk_dedup_threshold,
+            num_perm=self.chunk_dedup_num_perm,
+            shingle_size=self.chunk_dedup_shingle_size,
+        )
+
+    async def _get_chunk_dedup(self) -> MinHashLSH:
+        if self._chunk_dedup is None:
+            self._chunk_dedup = self._new_chunk_dedup()
+            keys = await self.chunk_signatures.all_keys()
+            for key, dp in zip(keys, await self.chunk_signatures.get_by_ids(keys)):
+                if dp is not None:
+                    self._chunk_dedup.insert(key, np.array(dp["signature"], dtype=np.uint32))
+            logger.info(f"[Chunk Dedup] loaded {len(keys)} chunk signatures")
+        return self._chunk_dedup
+
+    def _iter_canonical_chunks(self, chunks, dedup: MinHashLSH, duplicate_chunks: dict, signatures: dict):
+        """Yield the chunks that are not near-duplicates of a known chunk, and collect the
+        others into `duplicate_chunks` with a `canonical_chunk_id`. The signatures of the
+        yielded chunks are collected into `signatures`, and only indexed in `dedup` by
+        _insert_duplicate_chunks once their extraction is merged. Until then they are
+        only matched against the other chunks of the same insert.
+        """
+        batch_dedup = self._new_chunk_dedup()
+        for chunk_key, chunk_dp in chunks:
+            signature = dedup.signature(chunk_dp["content"])
+            canonical_key = dedup.query(signature) or batch_dedup.query(signature)
+            if canonical_key is not None and canonical_key != chunk_key:
+                duplicate_chunks[chunk_key] = {**chunk_dp, "canonical_chunk_id": canonical_key}
+                continue
+            batch_dedup.insert(chunk_key, signature)
+            signatures[chunk_key] = {"signature": signature.tolist()}
+            yield chunk_key, chunk_dp
+
+    async def _insert_duplicate_chunks(self, duplicate_chunks: dict, signatures: dict):
+        """Index and store the signatures of the merged canonical chunks, then store the
+        near-duplicate chunks with the provenance of their canonical chunks.
+        """
+        if self.chunk_signatures is not None and len(signatures):
+            dedup = await self._get_chunk_dedup()
+            for k, dp in signatures.items():
+                dedup.insert(k, np.array(dp["signature"], dtype=np.uint32))
+            await self.chunk_signatures.upsert(signatures)
+        if not len(duplicate_chunks):
+            return
+        self._hypergraph_changed = True
+        async with self._merge_lock:
+            await link_duplicate_chunks(
+                {k: v["canonical_chunk_id"] for k, v in duplicate_chunks.items()},
+                self.chunk_entity_relation_hypergraph,
+                self.chunk_extractions,
+            )
+        await self.text_chunks.upsert(duplicate_chunks)
+
+    async def _insert_chunks_pipeline(self, chunks) -> bool:
+        logger.info("[Entity Extraction] pipelined insert...")
+        duplicate_chunks, signatures = {}, {}
+        if self.enable_chunk_dedup:
+            chunks = self._iter_canonical_chunks(
+                chunks, await self._get_chunk_dedup(), duplicate_chunks, signatures
+            )
+        self._hypergraph_changed = True
+        maybe_new_kg = await extract_entities_pipeline(
+            chunks,
+            knowledge_hypergraph_inst=self.chunk_entity_relation_hypergraph,
+            entity_vdb=self.entities_vdb,
+            relationships_vdb=self.relationships_vdb,
+            chunks_vdb=self.chunks_vdb,
+            text_chunks_db=self.text_chunks,
+            global_config=asdict(self),
+            extraction_checkpoint=self.extraction_checkpoint,
+            merge_lock=self._merge_lock,
+            chunk_extractions=self.chunk_extractions,
+        )
+        if maybe_new_kg is None:
+            logger.warning("No new entities and relationships found")
+            return False
+        self.chunk_entity_relation_hypergraph = maybe_new_kg
+        await self._insert_duplicate_chunks(duplicate_chunks, signatures)
+        return True
+
+    async def _defer_extraction(
+        self, inserting_chunks: dict, duplicate_chunks: dict, signatures: dict
+    ) -> bool:
+        """Store the chunks and their deferred extraction state instead of extracting them"""
+        if len(inserting_chunks):
+            logger.info(f"[New Chunks] deferring the extraction of {len(inserting_chunks)} chunks")
+            await self.chunks_vdb.upsert(inserting_chunks)
+            self._hypergraph_changed = True
+        states = {k: deferred_extraction_state(v) for k, v in inserting_chunks.items()}
+        # near-duplicates of deferred chunks are linked once their canonical chunk is merged
+        deferred_duplicates = {}
+        for k, v in list(duplicate_chunks.items()):
+            canonical_key = v["canonical_chunk_id"]
+            if canonical_key in states or await self.deferred_extraction.get_by_id(canonical_key):
+                deferred_duplicates[k] = {"canonical_chunk_id": canonical_key}
+                await self.text_chunks.upsert({k: duplicate_chunks.pop(k)})
+        await self.deferred_extraction.upsert({**states, **deferred_duplicates})
+        await self.text_chunks.upsert(inserting_chunks)
+        await self._insert_duplicate_chunks(duplicate_chunks, signatures)
+        self._deferred_extraction_count += self._write_extraction_requests(
+            self._deferred_extraction_file,
+            {k: state["messages"] for k, state in states.items()},
+            self._deferred_extraction_model,
+        )
+        return True
+
+    async def _extract_deferred_chunks(self, doc_keys: set[str]):
+        """Extract the chunks of already stored docs whose extraction is still deferred, a
+        plain insert of the docs does not wait for their completions to be ingested.
+        """
+        if not len(doc_keys) or self._deferred_extraction_file is not None:
+            return
+        keys = await self.deferred_extraction.all_keys()
+        if not len(keys):
+            return
+        states = await self.deferred_extraction.get_by_ids(keys)
+        keys = [k for k, state in zip(keys, states) if state is not None and "messages" in state]
+        chunks = {
+            k: dp
+            for k, dp in zip(keys, await self.text_chunks.get_by_ids(keys))
+            if dp is not None and len(doc_keys & set(_chunk_doc_ids(dp)))
+        }
+        if not len(chunks):
+            return
+        logger.info(f"[Deferred Extraction] extracting {len(chunks)} pending chunks")
+        maybe_new_kg = await extract_entities(
+            chunks,
+            knowledge_hypergraph_inst=self.chunk_entity_relation_hypergraph,
+            entity_vdb=self.entities_vdb,
+            relationships_vdb=self.relationships_vdb,
+            global_config=asdict(self),
+            merge_lock=self._merge_lock,
+            chunk_extractions=self.chunk_extractions,
+        )
+        if maybe_new_kg is None:
+            return
+        self.chunk_entity_relation_hypergraph = maybe_new_kg
+        self._hypergraph_changed = True
+        async with self._merge_lock:
+            duplicates = await self._link_deferred_duplicates(chunks)
+        await self.deferred_extraction.delete(list(chunks) + list(duplicates))
+
+    async def _link_deferred_duplicates(self, canonical_keys) -> dict[str, str]:
+        """Link the deferred near-duplicates of the merged canonical chunks, returns them"""
+        duplicates = {}
+        keys = await self.deferred_extraction.all_keys()
+        for key, state in zip(keys, await self.deferred_extraction.get_by_ids(keys)):
+            if state is not None and state.get("canonical_chunk_id") in canonical_keys:
+                duplicates[key] = state["canonical_chunk_id"]
+        if len(duplicates):
+            await link_duplicate_chunks(
+                duplicates, self.chunk_entity_relation_hypergraph, self.chunk_extractions
+            )
+        return duplicates
+
+    def export_extraction_requests(self, string_or_strings, request_file, model: str = None):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(
+            self.aexport_extraction_requests(string_or_strings, request_file, model)
+        )
+
+    async def aexport_extraction_requests(
+        self, string_or_strings, request_file, model: str = None
+    ) -> int:
+        """Phase one of the deferred (offline batch) insert. The documents are chunked and
+        stored like in ainsert, but instead of calling the llm, the extraction request of
+        every new chunk is written to the JSONL request_file, in the request format of the
+        OpenAI batch API with the chunk id as "custom_id". Returns the number of requests.
+        `model` defaults to llm_model_name, one of them is required.
+        Not to be run concurrently with other inserts. A plain insert of the same documents
+        before the completions are ingested extracts their chunks with the llm.
+        """
+        model = self._extraction_request_model(model)
+        if isinstance(string_or_strings, (str, os.PathLike)) or hasattr(
+            string_or_strings, "read"
+        ):
+            string_or_strings = [string_or_strings]
+        done_keys = []
+        with open(request_file, "w", encoding="utf-8") as f:
+            self._deferred_extraction_file = f
+            self._deferred_extraction_model = model
+            self._deferred_extraction_count = 0
+            try:
+                for source in string_or_strings:
+                    if not isinstance(source, str):
+                        done_keys += await self._insert_stream_doc(source)
+                done_keys += await self._insert_docs(
+                    [s for s in string_or_strings if isinstance(s, str)]
+                )
+                count = self._deferred_extraction_count
+            finally:
+                self._deferred_extraction_file = None
+                await self._insert_done()
+                await self._clear_checkpoint(done_keys)
+        logger.info(f"[Deferred Extraction] wrote {count} requests to {request_file}")
+        return count
+
+    def ingest_extraction_completions(self, completion_file, request_file=None, model: str = None):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(
+            self.aingest_extraction_completions(completion_file, request_file, model)
+        )
+
+    async def aingest_extraction_completions(
+        self, completion_file, request_file=None, model: str = None
+    ) -> dict:
+        """Phase two of the deferred insert. Reads the JSONL completions, either
+        {"custom_id", "content"} lines or the output file of the OpenAI batch API, and
+        merges the chunks whose extraction is complete into the hypergraph and the vector
+        dbs. The chunks with gleaning rounds left, and the failed completions, get their
+        next request written to request_file, to be run and ingested in the same way.
+        """
+        if request_file is not None:
+            model = self._extraction_request_model(model)
+        completions, failed_keys = {}, []
+        with open(completion_file, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                content = self._completion_content(record)
+                if content is None:
+                    failed_keys.append(record["custom_id"])
+                else:
+                    completions[record["custom_id"]] = content
+
+        global_config = asdict(self)
+        finished, updated, next_requests = {}, {}, {}
+        for key in failed_keys:
+            state = await self.deferred_extraction.get_by_id(key)
+            if state is not None and "messages" in state:
+                next_requests[key] = state["messages"]
+        for key, content in completions.items():
+            state = await self.deferred_extraction.get_by_id(key)
+            if state is None or "messages" not in state:
+                logger.warning(f"No deferred extraction of {key}, completion skipped")
+                continue
+            state = json.loads(json.dumps(state))
+            if advance_deferred_extraction(state, content, global_config):
+                finished[key] = state["result"]
+            else:
+                updated[key] = state
+                next_requests[key] = state["messages"]
+        if len(next_requests) and request_file is None:
+            raise ValueError(
+                f"{len(next_requests)} chunks need another request, request_file is missing"
+            )
+
+        duplicates = {}
+        try:
+            if len(finished):
+                logger.info(f"[Deferred Extraction] merging {len(finished)} chunks")
+                async with self._merge_lock:
+                    maybe_new_kg = await merge_deferred_extractions(
+                        finished,
+                        self.chunk_entity_relation_hypergraph,
+                        self.entities_vdb,
+                        self.relationships_vdb,
+                        global_config,
+                        self.chunk_extractions,
+                    )
+                    if maybe_new_kg is not None:
+                        self.chunk_entity_relation_hypergraph = maybe_new_kg
+                        self._hypergraph_changed = True
+                    duplicates = await self._link_deferred_duplicates(finished)
+            await self.deferred_extraction.delete(
+                list(finished) + list(duplicates) + list(updated)
+            )
+            await self.deferred_extraction.upsert(updated)
         finally:
             await self._insert_done()
+        if len(next_requests):
+            with open(request_file, "w", encoding="utf-8") as f:
+                self._write_extraction_requests(f, next_requests, model)
+        stats = {
+            "merged": len(finished),
+            "requests": len(next_requests),
+            "pending": len(await self.deferred_extraction.all_keys()),
+        }
+        logger.info(f"[Deferred Extraction] {stats}")
+        return stats
+
+    @staticmethod
+    def _completion_content(record: dict) -> Union[str, None]:
+        if "content" in record:
+            return record["content"]
+        response = record.get("response") or {}
+        if record.get("error") or response.get("status_code", 200) != 200:
+            return None
+        try:
+            return response["body"]["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def _extraction_request_model(self, model: str = None) -> str:
+        model = model or self.llm_model_name
+        if not model:
+            raise ValueError(
+                "The extraction requests need a model, pass model or set llm_model_name"
+            )
+        return model
+
+    @staticmethod
+    def _write_extraction_requests(f, requests: dict, model: str) -> int:
+        for chunk_key, messages in requests.items():
+            request = {
+                "custom_id": chunk_key,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": model, "messages": messages},
+            }
+            f.write(json.dumps(request, ensure_ascii=False) + "\n")
+        return len(requests)
 
     async def _insert_done(self):
         tasks = []
@@ -240,69 +1158,260 @@ class HyperRAG:
             self.full_docs,
             self.text_chunks,
             self.llm_response_cache,
+            self.extraction_checkpoint,
+            self.deferred_extraction,
+            self.chunk_extractions,
+            self.chunk_signatures,
             self.entities_vdb,
             self.relationships_vdb,
             self.chunks_vdb,
             self.chunk_entity_relation_hypergraph,
+            self.embedding_cache,
         ]:
             if storage_inst is None:
                 continue
             tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
+        changed, self._hypergraph_changed = self._hypergraph_changed, False
         await asyncio.gather(*tasks)
+        if self.query_cache is not None and changed:
+            await self._clear_query_cache()
+
+    def delete_doc(self, doc_id: str):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.adelete_doc(doc_id))
+
+    async def adelete_doc(self, doc_id: str) -> bool:
+        """Delete a document and its chunks without rebuilding the working_dir.
+
+        The chunks shared with other docs are kept. The ids of the others are removed
+        from the `source_id` of the vertices and hyperedges, the ones left without any
+        source are dropped, and only the affected ones are merged again from the stored
+        extractions, summarized and embedded. Returns False if the document is not stored.
+        """
+        try:
+            if await self.full_docs.get_by_id(doc_id) is None:
+                logger.warning(f"Doc {doc_id} is not in the storage")
+                return False
+            all_chunk_keys = await self.text_chunks.all_keys()
+            chunk_keys, shared_chunk_keys = [], []
+            for k, dp in zip(
+                all_chunk_keys,
+                await self.text_chunks.get_by_ids(
+                    all_chunk_keys, fields=["full_doc_id", "full_doc_ids"]
+                ),
+            ):
+                if dp is None or doc_id not in _chunk_doc_ids(dp):
+                    continue
+                if len(_chunk_doc_ids(dp)) > 1:
+                    shared_chunk_keys.append(k)
+                else:
+                    chunk_keys.append(k)
+            shared_chunks = {}
+            for k, dp in zip(
+                shared_chunk_keys, await self.text_chunks.get_by_ids(shared_chunk_keys)
+            ):
+                doc_ids = [d for d in _chunk_doc_ids(dp) if d != doc_id]
+                shared_chunks[k] = {**dp, "full_doc_id": doc_ids[0], "full_doc_ids": doc_ids}
+            logger.info(
+                f"[Delete Doc] deleting {doc_id} with {len(chunk_keys)} chunks, "
+                f"keeping {len(shared_chunks)} chunks shared with other docs"
+            )
+            if len(shared_chunks):
+                await self.text_chunks.delete(list(shared_chunks))
+                await self.text_chunks.upsert(shared_chunks)
+            if len(chunk_keys):
+                self._hypergraph_changed = True
+                async with self._merge_lock:
+                    self.chunk_entity_relation_hypergraph = await delete_chunks_from_hypergraph(
+                        chunk_keys,
+                        knowledge_hypergraph_inst=self.chunk_entity_relation_hypergraph,
+                        entity_vdb=self.entities_vdb,
+                        relationships_vdb=self.relationships_vdb,
+                        text_chunks_db=self.text_chunks,
+                        global_config=asdict(self),
+                        chunk_extractions=self.chunk_extractions,
+                    )
+                await self.chunks_vdb.delete(chunk_keys)
+                await self.text_chunks.delete(chunk_keys)
+                await self.chunk_extractions.delete(chunk_keys)
+                if self.chunk_signatures is not None:
+                    await self.chunk_signatures.delete(chunk_keys)
+                    dedup = await self._get_chunk_dedup()
+                    for k in chunk_keys:
+                        dedup.remove(k)
+            await self.full_docs.delete([doc_id])
+            await self._clear_checkpoint([doc_id] + chunk_keys)
+            return True
+        finally:
+            await self._insert_done()
+
+    def update_doc(self, doc_id: str, string_or_path):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.aupdate_doc(doc_id, string_or_path))
+
+    async def aupdate_doc(self, doc_id: str, string_or_path) -> str:
+        """Replace a document with a new version, returns the id of the new version.
+        The new version gets its own id, since the doc ids are hashes of the content.
+
+        The new version is inserted before the old one is deleted, so only its new
+        chunks are extracted, the unchanged chunks are shared by both versions and
+        kept, and only the chunks which are no longer in the document are deleted.
+        """
+        if isinstance(string_or_path, str):
+            new_doc_id = compute_mdhash_id(string_or_path.strip(), prefix="doc-")
+        elif isinstance(string_or_path, os.PathLike):
+            with open(string_or_path, "r", encoding="utf-8") as f:
+                new_doc_id = compute_mdhash_id_by_stream(
+                    f, prefix="doc-", read_size=self.chunk_stream_read_size
+                )
+        else:
+            new_doc_id = compute_mdhash_id_by_stream(
+                string_or_path, prefix="doc-", read_size=self.chunk_stream_read_size
+            )
+            string_or_path.seek(0)
+        if new_doc_id == doc_id:
+            logger.info(f"Doc {doc_id} is unchanged")
+            return doc_id
+        await self.ainsert(string_or_path)
+        await self.adelete_doc(doc_id)
+        return new_doc_id
 
     def query(self, query: str, param: QueryParam = QueryParam()):
         loop = always_get_an_event_loop()
         return loop.run_until_complete(self.aquery(query, param))
 
     async def aquery(self, query: str, param: QueryParam = QueryParam()):
-        
-        if param.mode == "hyper":
-            response = await hyper_query(
-                query,
-                self.chunk_entity_relation_hypergraph,
-                self.entities_vdb,
-                self.relationships_vdb,
-                self.text_chunks,
-                param,
-                asdict(self),
-            )
-        elif param.mode == "hyper-lite":
-            response = await hyper_query_lite(
-                query,
-                self.chunk_entity_relation_hypergraph,
-                self.entities_vdb,
-                self.text_chunks,
-                param,
-                asdict(self),
-            )
-        elif param.mode == "graph":
-            response = await graph_query(
-                query,
-                self.chunk_entity_relation_hypergraph,
-                self.entities_vdb,
-                self.relationships_vdb,
-                self.text_chunks,
-                param,
-                asdict(self),
-            )
-        elif param.mode == "naive":
-            response = await naive_query(
-                query,
-                self.chunks_vdb,
-                self.text_chunks,
-                param,
-                asdict(self),
-            )
-        elif param.mode == "llm":
-            response = await llm_query(
-                query,
-                param,
-                asdict(self),
-            )
-        else:
-            raise ValueError(f"Unknown mode {param.mode}")
-        await self._query_done()
-        return response
+        # the llm and embedding calls of queries are served before the waiting calls of inserts
+        priority_token = call_priority.set(CALL_PRIORITY_QUERY)
+        try:
+            use_query_cache = self.query_cache is not None and not param.stream
+            if use_query_cache:
+                response = await self._lookup_query_cache(query, param)
+                if response is not None:
+                    return response
+            generation = self._query_cache_generation
+            if param.mode == "hyper":
+                response = await hyper_query(
+                    query,
+                    self.chunk_entity_relation_hypergraph,
+                    self.entities_vdb,
+                    self.relationships_vdb,
+                    self.text_chunks,
+                    param,
+                    asdict(self),
+                )
+            elif param.mode == "hyper-lite":
+                response = await hyper_query_lite(
+                    query,
+                    self.chunk_entity_relation_hypergraph,
+                    self.entities_vdb,
+                    self.text_chunks,
+                    param,
+                    asdict(self),
+                )
+            elif param.mode == "graph":
+                response = await graph_query(
+                    query,
+                    self.chunk_entity_relation_hypergraph,
+                    self.entities_vdb,
+                    self.relationships_vdb,
+                    self.text_chunks,
+                    param,
+                    asdict(self),
+                )
+            elif param.mode == "naive":
+                response = await naive_query(
+                    query,
+                    self.chunks_vdb,
+                    self.text_chunks,
+                    param,
+                    asdict(self),
+                )
+            elif param.mode == "llm":
+                response = await llm_query(
+                    query,
+                    param,
+                    asdict(self),
+                )
+            else:
+                raise ValueError(f"Unknown mode {param.mode}")
+            if use_query_cache:
+                await self._store_query_cache(query, param, response, generation)
+            await self._query_done()
+            return response
+        finally:
+            call_priority.reset(priority_token)
+
+    async def aquery_stream(self, query: str, param: QueryParam = QueryParam()):
+        """Yield {"type": "metadata", "entities", "hyperedges", "text_units"} as soon as the
+        context is built, then {"type": "token", "content"} for the answer tokens as they
+        arrive from the llm.
+        """
+        result = await self.aquery(query, replace(param, stream=True))
+        if isinstance(result, str):
+            # only_need_context or the fail response
+            yield {"type": "metadata", "entities": [], "hyperedges": [], "text_units": []}
+            yield {"type": "token", "content": result}
+            return
+        response = result.pop("response")
+        result.pop("context", None)
+        yield {
+            "type": "metadata",
+            "entities": result.get("entities", []),
+            "hyperedges": result.get("hyperedges", []),
+            "text_units": result.get("text_units", []),
+        }
+        async for content in response:
+            yield {"type": "token", "content": content}
+
+    @staticmethod
+    def _query_cache_params_key(param: QueryParam) -> str:
+        return compute_args_hash(asdict(param))
+
+    async def _lookup_query_cache(self, query: str, param: QueryParam):
+        params_key = self._query_cache_params_key(param)
+        results = await self.query_cache_vdb.query(query, top_k=self.query_cache_top_k)
+        for r in results:
+            if (
+                r.get("params_key") != params_key
+                or r["distance"] < self.query_cache_similarity_threshold
+            ):
+                continue
+            entry = await self.query_cache.get_by_id(r["id"])
+            if entry is not None:
+                logger.info(f"Query cache hit with similarity {r['distance']:.3f}")
+                return entry["response"]
+        return None
+
+    async def _store_query_cache(self, query: str, param: QueryParam, response, generation):
+        if generation != self._query_cache_generation or response == PROMPTS["fail_response"]:
+            return
+        params_key = self._query_cache_params_key(param)
+        cache_id = compute_mdhash_id(params_key + query, prefix="qry-")
+        await self.query_cache.upsert(
+            {cache_id: {"query": query, "params_key": params_key, "response": response}}
+        )
+        await self.query_cache_vdb.upsert(
+            {cache_id: {"content": query, "params_key": params_key}}
+        )
+        self._query_cache_unsaved += 1
+
+    async def _save_query_cache(self):
+        self._query_cache_unsaved = 0
+        self._query_cache_saved_at = time.time()
+        await asyncio.gather(
+            self.query_cache.index_done_callback(),
+            self.query_cache_vdb.index_done_callback(),
+        )
+
+    async def _clear_query_cache(self):
+        self._query_cache_generation += 1
+        cache_ids = await self.query_cache.all_keys()
+        if not len(cache_ids):
+            return
+        await self.query_cache_vdb.delete(cache_ids)
+        await self.query_cache.drop()
+        await self._save_query_cache()
 
     async def _query_done(self):
         tasks = []
@@ -310,4 +1419,24 @@ class HyperRAG:
             if storage_inst is None:
                 continue
             tasks.append(cast(StorageNameSpace, storage_inst).query_done_callback())
+        if (
+            self._query_cache_unsaved
+            and time.time() - self._query_cache_saved_at >= self.query_cache_save_interval
+        ):
+            tasks.append(self._save_query_cache())
         await asyncio.gather(*tasks)
+
+    def close(self):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.aclose())
+
+    async def aclose(self):
+        """Save the unsaved query cache entries, close the pooled API clients and their
+        keep-alive connections, and the chunking process pool"""
+        if self._query_cache_unsaved:
+            await self._save_query_cache()
+        await close_api_clients()
+        if self._chunk_executor is not None:
+            executor, self._chunk_executor = self._chunk_executor, None
+            # shutdown waits for the workers, off the event loop
+            await asyncio.to_thread(executor.shutdown)
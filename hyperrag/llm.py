@@ -1,5 +1,8 @@
 import os
+import asyncio
 import copy
+import time
+import weakref
 from functools import lru_cache
 import json
 import aioboto3
@@ -12,6 +15,7 @@ from openai import (
     RateLimitError,
     Timeout,
     AsyncAzureOpenAI,
+    DefaultAsyncHttpxClient,
 )
 
 import base64
@@ -21,20 +25,144 @@ from tenacity import (
     retry,
     stop_after_attempt,
     wait_exponential,
+    retry_if_exception,
     retry_if_exception_type,
 )
 from pydantic import BaseModel, Field
 from typing import List, Dict, Callable, Any
 from .base import BaseKVStorage
-from .utils import compute_args_hash, wrap_embedding_func_with_attrs
+from .utils import (
+    acquire_rate_limit,
+    compute_args_hash,
+    defer_rate_limit,
+    get_retry_after,
+    is_rate_limit_error,
+    logger,
+    rate_limit_handled,
+    streamable,
+    wrap_embedding_func_with_attrs,
+)
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# rate limit errors are left to the RateLimiter of HyperRAG when it handles the call
+_retry_openai_error = retry_if_exception_type(
+    (APIConnectionError, Timeout)
+) | retry_if_exception(
+    lambda e: isinstance(e, RateLimitError) and not rate_limit_handled.get()
+)
+
+# Long-lived API clients of every event loop, keyed by (provider, base_url, api_key, ...),
+# so that calls reuse the keep-alive connection pools. The clients of a loop are dropped
+# with it, they can not be used from another loop.
+_api_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+_api_clients_without_loop: dict[tuple, Any] = {}
+_api_client_limits = {"max_connections": 100, "max_keepalive_connections": 20}
+_api_client_limits_set = False
+
+
+def set_api_client_limits(max_connections: int = None, max_keepalive_connections: int = None):
+    """Connection limits of the pooled clients, which are shared by the whole process.
+    Only the first call applies them, the later calls asking for other limits are ignored
+    with a warning.
+    """
+    global _api_client_limits_set
+    limits = dict(_api_client_limits)
+    if max_connections is not None:
+        limits["max_connections"] = max_connections
+    if max_keepalive_connections is not None:
+        limits["max_keepalive_connections"] = max_keepalive_connections
+    if _api_client_limits_set:
+        if limits != _api_client_limits:
+            logger.warning(
+                f"The API client limits are process-wide and already set to {_api_client_limits}, "
+                f"ignoring {limits}"
+            )
+        return
+    _api_client_limits.update(limits)
+    _api_client_limits_set = True
+
+
+def _loop_clients() -> dict:
+    """The pooled clients of the running event loop"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return _api_clients_without_loop
+    for other_loop in [l for l in _api_clients if l.is_closed()]:
+        # a client may hold its loop alive, drop them once the loop is closed
+        _api_clients.pop(other_loop, None)
+    return _api_clients.setdefault(loop, {})
+
 
+def get_openai_async_client(
+    provider: str = "openai", base_url: str = None, api_key: str = None, api_version: str = None
+):
+    """The pooled AsyncOpenAI / AsyncAzureOpenAI client of the endpoint and key.
+    The key is given to the client, os.environ is only read for the missing settings.
+    """
+    clients = _loop_clients()
+    key = (provider, base_url, api_key, api_version)
+    client = clients.get(key)
+    if client is not None:
+        return client
+    import httpx
+
+    http_client = DefaultAsyncHttpxClient(limits=httpx.Limits(**_api_client_limits))
+    if provider == "azure":
+        client = AsyncAzureOpenAI(
+            azure_endpoint=base_url or os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=api_key or os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version=api_version or os.getenv("AZURE_OPENAI_API_VERSION"),
+            http_client=http_client,
+        )
+    else:
+        client = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client)
+    clients[key] = client
+    return client
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    """The pooled aiohttp session of the running event loop"""
+    clients = _loop_clients()
+    session = clients.get("aiohttp")
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=_api_client_limits["max_connections"])
+        )
+        clients["aiohttp"] = session
+    return session
+
+
+async def close_api_clients():
+    """Close the pooled clients of the running event loop, they are created again on demand"""
+    clients = _loop_clients()
+    while len(clients):
+        await clients.pop(next(iter(clients))).close()
+
+
+async def _iter_completion_stream(response, model, hashing_kv, args_hash):
+    """Content of the chunks of a streamed chat completion, cached once it is complete"""
+    contents = []
+    async for chunk in response:
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if content:
+            contents.append(content)
+            yield content
+    if hashing_kv is not None:
+        await hashing_kv.upsert({args_hash: {"return": "".join(contents), "model": model}})
+
+
+@streamable
+@defer_rate_limit
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    retry=_retry_openai_error,
 )
 async def openai_complete_if_cache(
     model,
@@ -45,28 +173,30 @@ async def openai_complete_if_cache(
     api_key=None,
     **kwargs,
 ) -> str:
-    if api_key:
-        os.environ["OPENAI_API_KEY"] = api_key
-
-    openai_async_client = (
-        AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = get_openai_async_client("openai", base_url, api_key)
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
     messages = []
     if system_prompt is not None:
         messages.append({"role": "system", "content": system_prompt})
     messages.extend(history_messages)
     messages.append({"role": "user", "content": prompt})
+    args_hash = compute_args_hash(model, messages)
     if hashing_kv is not None:
-        args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
         if if_cache_return is not None:
             return if_cache_return["return"]
 
+    if kwargs.get("stream"):
+        await acquire_rate_limit()
+        response = await openai_async_client.chat.completions.create(
+            model=model, messages=messages, **kwargs
+        )
+        return _iter_completion_stream(response, model, hashing_kv, args_hash)
+
+    await acquire_rate_limit()
     response = await openai_async_client.chat.completions.create(
         model=model, messages=messages, **kwargs
     )
-
     if hashing_kv is not None:
         await hashing_kv.upsert(
             {args_hash: {"return": response.choices[0].message.content, "model": model}}
@@ -74,10 +204,12 @@ async def openai_complete_if_cache(
     return response.choices[0].message.content
 
 
+@streamable
+@defer_rate_limit
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    retry=_retry_openai_error,
 )
 async def azure_openai_complete_if_cache(
     model,
@@ -88,16 +220,7 @@ async def azure_openai_complete_if_cache(
     api_key=None,
     **kwargs,
 ):
-    if api_key:
-        os.environ["AZURE_OPENAI_API_KEY"] = api_key
-    if base_url:
-        os.environ["AZURE_OPENAI_ENDPOINT"] = base_url
-
-    openai_async_client = AsyncAzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    )
+    openai_async_client = get_openai_async_client("azure", base_url, api_key)
 
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
     messages = []
@@ -106,16 +229,23 @@ async def azure_openai_complete_if_cache(
     messages.extend(history_messages)
     if prompt is not None:
         messages.append({"role": "user", "content": prompt})
+    args_hash = compute_args_hash(model, messages)
     if hashing_kv is not None:
-        args_hash = compute_args_hash(model, messages)
         if_cache_return = await hashing_kv.get_by_id(args_hash)
         if if_cache_return is not None:
             return if_cache_return["return"]
 
+    if kwargs.get("stream"):
+        await acquire_rate_limit()
+        response = await openai_async_client.chat.completions.create(
+            model=model, messages=messages, **kwargs
+        )
+        return _iter_completion_stream(response, model, hashing_kv, args_hash)
+
+    await acquire_rate_limit()
     response = await openai_async_client.chat.completions.create(
         model=model, messages=messages, **kwargs
     )
-
     if hashing_kv is not None:
         await hashing_kv.upsert(
             {args_hash: {"return": response.choices[0].message.content, "model": model}}
@@ -127,6 +257,7 @@ class BedrockError(Exception):
     """Generic error for issues related to Amazon Bedrock"""
 
 
+@defer_rate_limit
 @retry(
     stop=stop_after_attempt(5),
     wait=wait_exponential(multiplier=1, max=60),
@@ -194,6 +325,7 @@ async def bedrock_complete_if_cache(
     # Call model via Converse API
     session = aioboto3.Session()
     async with session.client("bedrock-runtime") as bedrock_async_client:
+        await acquire_rate_limit()
         try:
             response = await bedrock_async_client.converse(**args, **kwargs)
         except Exception as e:
@@ -212,6 +344,8 @@ async def bedrock_complete_if_cache(
         return response["output"]["message"]["content"][0]["text"]
 
 
+@streamable
+@defer_rate_limit
 async def gpt_4o_complete(
     prompt, system_prompt=None, history_messages=[], **kwargs
 ) -> str:
@@ -226,6 +360,8 @@ async def gpt_4o_complete(
     )
 
 
+@streamable
+@defer_rate_limit
 async def gpt_4o_mini_complete(
     prompt, system_prompt=None, history_messages=[], **kwargs
 ) -> str:
@@ -238,6 +374,8 @@ async def gpt_4o_mini_complete(
     )
 
 
+@streamable
+@defer_rate_limit
 async def azure_openai_complete(
     prompt, system_prompt=None, history_messages=[], **kwargs
 ) -> str:
@@ -250,6 +388,7 @@ async def azure_openai_complete(
     )
 
 
+@defer_rate_limit
 async def bedrock_complete(
     prompt, system_prompt=None, history_messages=[], **kwargs
 ) -> str:
@@ -266,7 +405,7 @@ async def bedrock_complete(
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=60),
-    retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    retry=_retry_openai_error,
 )
 async def openai_embedding(
     texts: list[str],
@@ -274,12 +413,7 @@ async def openai_embedding(
     base_url: str = None,
     api_key: str = None,
 ) -> np.ndarray:
-    if api_key:
-        os.environ["OPENAI_API_KEY"] = api_key
-
-    openai_async_client = (
-        AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = get_openai_async_client("openai", base_url, api_key)
     response = await openai_async_client.embeddings.create(
         model=model, input=texts, encoding_format="float"
     )
@@ -290,7 +424,7 @@ async def openai_embedding(
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    retry=_retry_openai_error,
 )
 async def azure_openai_embedding(
     texts: list[str],
@@ -298,16 +432,7 @@ async def azure_openai_embedding(
     base_url: str = None,
     api_key: str = None,
 ) -> np.ndarray:
-    if api_key:
-        os.environ["AZURE_OPENAI_API_KEY"] = api_key
-    if base_url:
-        os.environ["AZURE_OPENAI_ENDPOINT"] = base_url
-
-    openai_async_client = AsyncAzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    )
+    openai_async_client = get_openai_async_client("azure", base_url, api_key)
 
     response = await openai_async_client.embeddings.create(
         model=model, input=texts, encoding_format="float"
@@ -318,7 +443,7 @@ async def azure_openai_embedding(
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=60),
-    retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    retry=_retry_openai_error,
 )
 async def siliconcloud_embedding(
     texts: list[str],
@@ -337,12 +462,12 @@ async def siliconcloud_embedding(
     payload = {"model": model, "input": truncate_texts, "encoding_format": "base64"}
 
     base64_strings = []
-    async with aiohttp.ClientSession() as session:
-        async with session.post(base_url, headers=headers, json=payload) as response:
-            content = await response.json()
-            if "code" in content:
-                raise ValueError(content)
-            base64_strings = [item["embedding"] for item in content["data"]]
+    session = get_aiohttp_session()
+    async with session.post(base_url, headers=headers, json=payload) as response:
+        content = await response.json()
+        if "code" in content:
+            raise ValueError(content)
+        base64_strings = [item["embedding"] for item in content["data"]]
 
     embeddings = []
     for string in base64_strings:
@@ -455,11 +580,48 @@ class Model(BaseModel):
         arbitrary_types_allowed = True
 
 
+class ModelStats:
+    """Load and health of a Model in MultiModel"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        # exponentially weighted moving averages of the latency of successful calls and of
+        # the error rate of all calls
+        self.ewma_latency = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.quarantined_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return self.quarantined_until <= now
+
+    def as_dict(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "errors": self.errors,
+            "ewma_latency": self.ewma_latency,
+            "error_rate": round(self.error_rate, 4),
+            "quarantined_for": max(0.0, self.quarantined_until - time.monotonic()),
+        }
+
+
 class MultiModel:
     """
     Distributes the load across multiple language models. Useful for circumventing low rate limits with certain api providers especially if you are on the free tier.
     Could also be used for spliting across diffrent models or providers.
 
+    Every call goes to the healthy model with the lowest expected wait, (in_flight + 1) * EWMA latency,
+    weighted by its recent error rate. A model is quarantined with exponential backoff after
+    `quarantine_after_failures` consecutive failures, or right away on a rate limit error or a
+    401 / 403 / 404, and a failed call is retried on another model. When all models are
+    quarantined a call waits for the first one released, and a rate limit error of a model with
+    no healthy model left to fail over to is retried by the model's own backoff. Invalid requests
+    (400, 413, 422) are raised, another model would reject them too. `stats()` shows the balance.
+
     Attributes:
         models (List[Model]): A list of language models to be used.
 
@@ -480,28 +642,139 @@ class MultiModel:
         ```
     """
 
-    def __init__(self, models: List[Model]):
+    def __init__(
+        self,
+        models: List[Model],
+        ewma_alpha: float = 0.3,
+        quarantine_after_failures: int = 3,
+        quarantine_seconds: float = 5.0,
+        max_quarantine_seconds: float = 300.0,
+        max_attempts: int = None,
+    ):
         self._models = models
         self._current_model = 0
+        self._stats = [
+            ModelStats(f"{i}:{model.kwargs.get('model', '')}") for i, model in enumerate(models)
+        ]
+        self.ewma_alpha = ewma_alpha
+        self.quarantine_after_failures = quarantine_after_failures
+        self.quarantine_seconds = quarantine_seconds
+        self.max_quarantine_seconds = max_quarantine_seconds
+        self.max_attempts = max_attempts or len(models)
+
+    def _next_model(self, exclude: set = frozenset()) -> int:
+        now = time.monotonic()
+        candidates = [i for i in range(len(self._models)) if i not in exclude]
+        healthy = [i for i in candidates if self._stats[i].healthy(now)]
+        if not healthy:
+            # all quarantined, the one released first
+            return min(candidates, key=lambda i: self._stats[i].quarantined_until)
+        known_latencies = [
+            self._stats[i].ewma_latency for i in healthy if self._stats[i].ewma_latency is not None
+        ]
+        default_latency = min(known_latencies) if known_latencies else 1.0
+
+        def expected_wait(i):
+            stats = self._stats[i]
+            latency = stats.ewma_latency if stats.ewma_latency is not None else default_latency
+            return (stats.in_flight + 1) * latency / max(0.05, 1.0 - stats.error_rate)
 
-    def _next_model(self):
+        # round robin among equally loaded models
         self._current_model = (self._current_model + 1) % len(self._models)
-        return self._models[self._current_model]
+        order = sorted(healthy, key=lambda i: (i - self._current_model) % len(self._models))
+        return min(order, key=expected_wait)
+
+    def _on_success(self, stats: ModelStats, latency: float):
+        a = self.ewma_alpha
+        stats.ewma_latency = (
+            latency if stats.ewma_latency is None else a * latency + (1 - a) * stats.ewma_latency
+        )
+        stats.error_rate = (1 - a) * stats.error_rate
+        stats.consecutive_failures = 0
+
+    def _on_failure(self, stats: ModelStats, e: Exception):
+        a = self.ewma_alpha
+        stats.errors += 1
+        stats.error_rate = a + (1 - a) * stats.error_rate
+        stats.consecutive_failures += 1
+        rate_limited = is_rate_limit_error(e)
+        if (
+            rate_limited
+            or self._is_model_error(e)
+            or stats.consecutive_failures >= self.quarantine_after_failures
+        ):
+            backoff = self.quarantine_seconds * 2 ** max(
+                0, stats.consecutive_failures - self.quarantine_after_failures
+            )
+            retry_after = get_retry_after(e) if rate_limited else None
+            backoff = min(self.max_quarantine_seconds, retry_after or backoff)
+            stats.quarantined_until = time.monotonic() + backoff
+            logger.warning(f"Model {stats.name} quarantined for {backoff:.1f}s: {e!r}")
+
+    @staticmethod
+    def _status(e: Exception):
+        return getattr(e, "status_code", None) or getattr(e, "status", None)
+
+    @classmethod
+    def _is_request_error(cls, e: Exception) -> bool:
+        # the request itself is invalid, another model would fail the same way
+        return cls._status(e) in (400, 413, 422)
+
+    @classmethod
+    def _is_model_error(cls, e: Exception) -> bool:
+        # bad key, no access to the model or unknown model, quarantined right away
+        return cls._status(e) in (401, 403, 404)
+
+    def stats(self) -> Dict[str, dict]:
+        return {stats.name: stats.as_dict() for stats in self._stats}
 
     async def llm_model_func(
         self, prompt, system_prompt=None, history_messages=[], **kwargs
     ) -> str:
         kwargs.pop("model", None)  # stop from overwriting the custom model name
-        next_model = self._next_model()
-        args = dict(
-            prompt=prompt,
-            system_prompt=system_prompt,
-            history_messages=history_messages,
-            **kwargs,
-            **next_model.kwargs,
-        )
-
-        return await next_model.gen_func(**args)
+        tried = set()
+        max_attempts = min(self.max_attempts, len(self._models))
+        while True:
+            index = self._next_model(exclude=tried)
+            tried.add(index)
+            next_model, stats = self._models[index], self._stats[index]
+            wait = stats.quarantined_until - time.monotonic()
+            if wait > 0:
+                # all quarantined, wait for the one released first
+                logger.warning(f"All models quarantined, waiting {wait:.1f}s for {stats.name}")
+                await asyncio.sleep(wait)
+            now = time.monotonic()
+            can_fail_over = len(tried) < max_attempts and any(
+                i not in tried and self._stats[i].healthy(now) for i in range(len(self._models))
+            )
+            args = dict(
+                prompt=prompt,
+                system_prompt=system_prompt,
+                history_messages=history_messages,
+                **kwargs,
+                **next_model.kwargs,
+            )
+            stats.in_flight += 1
+            stats.calls += 1
+            start = time.monotonic()
+            # rate limit errors fail over to another healthy model instead of being retried,
+            # the last model retries them itself
+            token = rate_limit_handled.set(can_fail_over)
+            try:
+                result = await next_model.gen_func(**args)
+            except Exception as e:
+                if self._is_request_error(e):
+                    raise
+                self._on_failure(stats, e)
+                if len(tried) >= max_attempts:
+                    raise
+                logger.warning(f"Model {stats.name} failed, retrying on another model: {e!r}")
+                continue
+            finally:
+                rate_limit_handled.reset(token)
+                stats.in_flight -= 1
+            self._on_success(stats, time.monotonic() - start)
+            return result
 
 
 if __name__ == "__main__":
@@ -1,16 +1,20 @@
+import os
 import sys
 import asyncio
 import json
+import math
 import re
 from datetime import datetime
-from typing import Union
+from typing import Any, Iterable, Union
 from collections import Counter, defaultdict
 import warnings
 
+import numpy as np
 
 from .utils import (
     logger,
     clean_str,
+    locate_json_string_body_from_string,
     compute_mdhash_id,
     decode_tokens_by_tiktoken,
     encode_string_by_tiktoken,
@@ -21,6 +25,9 @@ from .utils import (
     truncate_list_by_token_size,
     process_combine_contexts,
     deduplicate_by_key,
+    call_priority,
+    is_streamable,
+    CALL_PRIORITY_QUERY,
 )
 from .base import (
     BaseKVStorage,
@@ -51,17 +58,224 @@ def chunking_by_token_size(
         )
     return results
 
+
+def _split_stream_segment(buffer: str, read_size: int) -> int:
+    """Find a position to cut the buffer so that the text before it can be tokenized
+    independently. Cut before the whitespace run holding the last line break (or the
+    last whitespace), so that trailing whitespace is only emitted if more text follows.
+    """
+    index = buffer.rfind("\n")
+    if index < 0:
+        index = max(buffer.rfind(" "), buffer.rfind("\t"))
+    if index >= 0:
+        return len(buffer[:index].rstrip())
+    # no whitespace at all (e.g. CJK text), only cut once the buffer grows too large
+    return read_size if len(buffer) >= 2 * read_size else 0
+
+
+def _iter_stream_tokens(source, tiktoken_model="gpt-4o", read_size=65536):
+    """Read a text stream `read_size` characters at a time, and yield the tokens of the
+    stripped text block by block. Blocks are cut at whitespace, so that the concatenated
+    blocks are the same tokens as encoding the whole stripped text.
+    """
+    carry = ""
+    started = False
+    while True:
+        block = source.read(read_size)
+        if not block:
+            break
+        if not started:
+            # the same as content.strip() in the non-stream version
+            block = block.lstrip()
+            if not block:
+                continue
+            started = True
+        carry += block
+        cut = _split_stream_segment(carry, read_size)
+        if cut <= 0:
+            continue
+        yield encode_string_by_tiktoken(carry[:cut], model_name=tiktoken_model)
+        carry = carry[cut:]
+
+    carry = carry.rstrip()
+    if carry:
+        yield encode_string_by_tiktoken(carry, model_name=tiktoken_model)
+
+
+def chunking_by_token_size_stream(
+    source,
+    overlap_token_size=128,
+    max_token_size=1024,
+    tiktoken_model="gpt-4o",
+    read_size=65536,
+):
+    """Generator version of chunking_by_token_size.
+
+    `source` is a file path or a text stream. The text is read `read_size` characters
+    at a time and tokenized incrementally, so only the current window and one block
+    of text are held in memory. Chunks are yielded one at a time with the same
+    overlap semantics as chunking_by_token_size.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r", encoding="utf-8") as f:
+            yield from chunking_by_token_size_stream(
+                f, overlap_token_size, max_token_size, tiktoken_model, read_size
+            )
+        return
+
+    step = max_token_size - overlap_token_size
+    tokens = []
+    index = 0
+
+    def _windows(final: bool):
+        nonlocal tokens, index
+        while len(tokens) >= max_token_size or (final and tokens):
+            window = tokens[:max_token_size]
+            yield {
+                "tokens": len(window),
+                "content": decode_tokens_by_tiktoken(
+                    window, model_name=tiktoken_model
+                ).strip(),
+                "chunk_order_index": index,
+            }
+            index += 1
+            tokens = tokens[step:]
+
+    for block_tokens in _iter_stream_tokens(source, tiktoken_model, read_size):
+        tokens.extend(block_tokens)
+        yield from _windows(final=False)
+    yield from _windows(final=True)
+
+
+def _gear_hash(tokens: np.ndarray) -> np.ndarray:
+    """A pseudo random 64 bits value for every token id (splitmix64)"""
+    with np.errstate(over="ignore"):
+        z = tokens.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def _content_defined_chunks(
+    token_blocks: Iterable[list[int]],
+    min_token_size=256,
+    avg_token_size=768,
+    max_token_size=1024,
+    tiktoken_model="gpt-4o",
+    window_size=16,
+):
+    """Cut the tokens where the rolling hash of the last `window_size` tokens has its low
+    bits all zero, keeping every chunk within [min_token_size, max_token_size] tokens.
+
+    A boundary only depends on the tokens just before it, so after an edit the boundaries
+    (and the chunk hashes) resynchronize within one chunk.
+    """
+    bits = max(round(math.log2(max(avg_token_size - min_token_size, 1))), 0)
+    mask = np.uint64((1 << bits) - 1)
+    min_token_size = max(min(min_token_size, max_token_size), 1)
+    tokens = np.zeros(0, dtype=np.int64)
+    is_boundary = np.zeros(0, dtype=bool)
+    gear_tail = np.zeros(0, dtype=np.uint64)
+    index = 0
+
+    def _chunks(final: bool):
+        nonlocal tokens, is_boundary, index
+        start = 0
+        while start < len(tokens):
+            candidates = np.flatnonzero(
+                is_boundary[start + min_token_size - 1 : start + max_token_size]
+            )
+            if len(candidates):
+                end = start + min_token_size + int(candidates[0])
+            elif len(tokens) - start >= max_token_size:
+                end = start + max_token_size
+            elif final:
+                end = len(tokens)
+            else:
+                break
+            yield {
+                "tokens": end - start,
+                "content": decode_tokens_by_tiktoken(
+                    tokens[start:end].tolist(), model_name=tiktoken_model
+                ).strip(),
+                "chunk_order_index": index,
+            }
+            index += 1
+            start = end
+        tokens, is_boundary = tokens[start:], is_boundary[start:]
+
+    for block_tokens in token_blocks:
+        if not len(block_tokens):
+            continue
+        block_tokens = np.asarray(block_tokens, dtype=np.int64)
+        gears = np.concatenate([gear_tail, _gear_hash(block_tokens)])
+        sums = np.concatenate([np.zeros(1, dtype=np.uint64), np.cumsum(gears, dtype=np.uint64)])
+        ends = np.arange(len(gear_tail) + 1, len(gears) + 1)
+        with np.errstate(over="ignore"):
+            window_hash = sums[ends] - sums[np.maximum(ends - window_size, 0)]
+        tokens = np.concatenate([tokens, block_tokens])
+        is_boundary = np.concatenate([is_boundary, (window_hash & mask) == 0])
+        gear_tail = gears[-(window_size - 1):] if window_size > 1 else gears[:0]
+        yield from _chunks(final=False)
+    yield from _chunks(final=True)
+
+
+def chunking_by_content_defined(
+    content: str,
+    min_token_size=256,
+    avg_token_size=768,
+    max_token_size=1024,
+    tiktoken_model="gpt-4o",
+):
+    """Chunk at content-defined boundaries, chunks have no overlap.
+    Inserting or editing text only changes the chunks around the edit.
+    """
+    tokens = encode_string_by_tiktoken(content, model_name=tiktoken_model)
+    return list(
+        _content_defined_chunks(
+            [tokens], min_token_size, avg_token_size, max_token_size, tiktoken_model
+        )
+    )
+
+
+def chunking_by_content_defined_stream(
+    source,
+    min_token_size=256,
+    avg_token_size=768,
+    max_token_size=1024,
+    tiktoken_model="gpt-4o",
+    read_size=65536,
+):
+    """Generator version of chunking_by_content_defined, for a file path or a text stream"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "r", encoding="utf-8") as f:
+            yield from chunking_by_content_defined_stream(
+                f, min_token_size, avg_token_size, max_token_size, tiktoken_model, read_size
+            )
+        return
+    yield from _content_defined_chunks(
+        _iter_stream_tokens(source, tiktoken_model, read_size),
+        min_token_size,
+        avg_token_size,
+        max_token_size,
+        tiktoken_model,
+    )
+
+
 # summarize the descriptions of the entity
 async def _handle_entity_summary(
     entity_or_relation_name: str,
     description: str,
     global_config: dict,
+    num_tokens: int = None,
 ) -> str:
     use_llm_func: callable = global_config["llm_model_func"]
     llm_max_tokens = global_config["llm_model_max_token_size"]
     tiktoken_model_name = global_config["tiktoken_model_name"]
     summary_max_tokens = global_config["entity_summary_to_max_tokens"] # 500
 
+    if num_tokens is not None and num_tokens < summary_max_tokens:  # No need for summary
+        return description
     tokens = encode_string_by_tiktoken(description, model_name=tiktoken_model_name)
     if len(tokens) < summary_max_tokens:  # No need for summary
         return description
@@ -86,12 +300,15 @@ async def _handle_entity_additional_properties(
     entity_name: str,
     additional_properties: str,
     global_config: dict,
+    num_tokens: int = None,
 ) -> str:
     use_llm_func: callable = global_config["llm_model_func"]
     llm_max_tokens = global_config["llm_model_max_token_size"]
     tiktoken_model_name = global_config["tiktoken_model_name"]
     summary_max_tokens = global_config["entity_additional_properties_to_max_tokens"] # 可能需要修改 entity_properties_summary_to_max_tokens
 
+    if num_tokens is not None and num_tokens < summary_max_tokens:  # No need for summary
+        return additional_properties
     tokens = encode_string_by_tiktoken(additional_properties, model_name=tiktoken_model_name)
     if len(tokens) < summary_max_tokens:  # No need for summary
         return additional_properties
@@ -116,12 +333,15 @@ async def _handle_relation_summary(
     relation_name: str,
     description: str,
     global_config: dict,
+    num_tokens: int = None,
 ) -> str:
     use_llm_func: callable = global_config["llm_model_func"]
     llm_max_tokens = global_config["llm_model_max_token_size"]
     tiktoken_model_name = global_config["tiktoken_model_name"]
     summary_max_tokens = global_config["relation_summary_to_max_tokens"]  # 可能需要修改  relation_summary_to_max_tokens
 
+    if num_tokens is not None and num_tokens < summary_max_tokens:  # No need for summary
+        return description
     tokens = encode_string_by_tiktoken(description, model_name=tiktoken_model_name)
     if len(tokens) < summary_max_tokens:  # No need for summary
         return description
@@ -146,12 +366,15 @@ async def _handle_relation_keywords_summary(
     relation_name: str,
     keywords: str,
     global_config: dict,
+    num_tokens: int = None,
 ) -> str:
     use_llm_func: callable = global_config["llm_model_func"]
     llm_max_tokens = global_config["llm_model_max_token_size"]
     tiktoken_model_name = global_config["tiktoken_model_name"]
     summary_max_tokens = global_config["relation_keywords_to_max_tokens"]  # 可能需要修改relation_keywords_summary_to_max_tokens
 
+    if num_tokens is not None and num_tokens < summary_max_tokens:  # No need for summary
+        return keywords
     tokens = encode_string_by_tiktoken(keywords, model_name=tiktoken_model_name)
     if len(tokens) < summary_max_tokens:  # No need for summary
         return keywords
@@ -249,18 +472,54 @@ async def _handle_single_relationship_extraction_high(
     )
 
 
-async def _merge_nodes_then_upsert(
+def _count_joined_tokens(
+    parts: list[str], known_tokens: dict[str, int], tiktoken_model_name: str
+) -> int:
+    """Token count of GRAPH_FIELD_SEP.join(parts), only the parts without a known count are encoded"""
+    if not len(parts):
+        return 0
+    sep_tokens = len(encode_string_by_tiktoken(GRAPH_FIELD_SEP, model_name=tiktoken_model_name))
+    num_tokens = sep_tokens * (len(parts) - 1)
+    for part in parts:
+        part_tokens = known_tokens.get(part)
+        if part_tokens is None:
+            part_tokens = len(encode_string_by_tiktoken(part, model_name=tiktoken_model_name))
+        num_tokens += part_tokens
+    return num_tokens
+
+
+def _set_summarized_field(data: dict, field: str, summary: str, global_config: dict):
+    """Store the summary of a merged field, its token count is only recounted if it changed"""
+    if summary == data[field]:
+        return
+    data[field] = summary
+    data[f"{field}_tokens"] = len(
+        encode_string_by_tiktoken(summary, model_name=global_config["tiktoken_model_name"])
+    )
+
+
+async def _merge_nodes_data(
     entity_name: str,
     nodes_data: list[dict],
     knowledge_hypergraph_inst,
     global_config: dict,
-):
+    merge_stored: bool = True,
+) -> dict:
+    """Merge the extracted data of an entity with the stored vertex, without summarizing.
+    The token counts of the merged fields are kept in `description_tokens` and `additional_properties_tokens`.
+    With `merge_stored=False` the stored vertex is ignored, and the data is rebuilt from `nodes_data` only.
+    """
+    tiktoken_model_name = global_config["tiktoken_model_name"]
     already_entity_types = []
     already_source_ids = []
     already_description = []
     already_additional_properties = []
+    # token counts stored with the vertex, reused instead of encoding the stored fields again
+    known_tokens = {}
 
-    already_node = await knowledge_hypergraph_inst.get_vertex(entity_name)
+    already_node = (
+        await knowledge_hypergraph_inst.get_vertex(entity_name) if merge_stored else None
+    )
     if already_node is not None:
     #     """------------------------------------------------------------------"""
     #     if already_node["entity_type"] is None:
@@ -276,6 +535,9 @@ async def _merge_nodes_then_upsert(
         )
         already_description.append(already_node["description"])
         already_additional_properties.append(already_node["additional_properties"])
+        for field in ("description", "additional_properties"):
+            if already_node.get(f"{field}_tokens") is not None:
+                known_tokens[already_node[field]] = already_node[f"{field}_tokens"]
 
     entity_type_counts = sorted(
         Counter(
@@ -296,31 +558,44 @@ async def _merge_nodes_then_upsert(
     # """------------------------------------------------------------------"""
 
     # nodes_data = [dp["description"] for dp in nodes_data if dp["description"] is not None]
-    description = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["description"] for dp in nodes_data] + already_description))
-    )
-    additional_properties = GRAPH_FIELD_SEP.join(
-        sorted(set(
-            prop
-            for dp in nodes_data
-            for prop in dp["additional_properties"]
-        ) | set(already_additional_properties))
-    )
+    descriptions = sorted(set([dp["description"] for dp in nodes_data] + already_description))
+    description = GRAPH_FIELD_SEP.join(descriptions)
+    additional_properties_list = sorted(set(
+        prop
+        for dp in nodes_data
+        for prop in dp["additional_properties"]
+    ) | set(already_additional_properties))
+    additional_properties = GRAPH_FIELD_SEP.join(additional_properties_list)
     source_id = GRAPH_FIELD_SEP.join(
         set([dp["source_id"] for dp in nodes_data] + already_source_ids)
     )
-    description = await _handle_entity_summary(
-        entity_name, description, global_config
-    )
-    additional_properties = await _handle_entity_additional_properties(  # 应该新建一个合并附属信息的函数，以及prompt
-        entity_name, additional_properties, global_config
-    )
-    node_data = dict(
+    return dict(
         entity_type=entity_type,
         description=description,
         source_id=source_id,
         additional_properties=additional_properties,
+        description_tokens=_count_joined_tokens(
+            descriptions, known_tokens, tiktoken_model_name
+        ),
+        additional_properties_tokens=_count_joined_tokens(
+            additional_properties_list, known_tokens, tiktoken_model_name
+        ),
     )
+
+
+def _entity_vdb_content(entity_name: str, description: str) -> str:
+    return entity_name + description
+
+
+def _relation_vdb_content(id_set: tuple, keywords: str, description: str) -> str:
+    return keywords + str(id_set) + description
+
+
+async def _upsert_merged_node(
+    entity_name: str,
+    node_data: dict,
+    knowledge_hypergraph_inst,
+) -> dict:
     await knowledge_hypergraph_inst.upsert_vertex(
         entity_name,
         node_data,
@@ -329,18 +604,53 @@ async def _merge_nodes_then_upsert(
     return node_data
 
 
-async def _merge_edges_then_upsert(
+async def _merge_nodes_then_upsert(
+    entity_name: str,
+    nodes_data: list[dict],
+    knowledge_hypergraph_inst,
+    global_config: dict,
+):
+    node_data = await _merge_nodes_data(
+        entity_name, nodes_data, knowledge_hypergraph_inst, global_config
+    )
+    await _summarize_merged_node(entity_name, node_data, global_config)
+    return await _upsert_merged_node(entity_name, node_data, knowledge_hypergraph_inst)
+
+
+async def _summarize_merged_node(entity_name: str, node_data: dict, global_config: dict):
+    description = await _handle_entity_summary(
+        entity_name, node_data["description"], global_config, node_data.get("description_tokens")
+    )
+    _set_summarized_field(node_data, "description", description, global_config)
+    additional_properties = await _handle_entity_additional_properties(  # 应该新建一个合并附属信息的函数，以及prompt
+        entity_name,
+        node_data["additional_properties"],
+        global_config,
+        node_data.get("additional_properties_tokens"),
+    )
+    _set_summarized_field(node_data, "additional_properties", additional_properties, global_config)
+
+
+async def _merge_edges_data(
     id_set: tuple,
     edges_data: list[dict],
     knowledge_hypergraph_inst,
     global_config: dict,
-):
+    merge_stored: bool = True,
+) -> dict:
+    """Merge the extracted data of a hyperedge with the stored one, without summarizing.
+    Vertices of the hyperedge that do not exist yet are created.
+    The token counts of the merged fields are kept in `description_tokens` and `keywords_tokens`.
+    With `merge_stored=False` the stored hyperedge is ignored, and the data is rebuilt from `edges_data` only.
+    """
+    tiktoken_model_name = global_config["tiktoken_model_name"]
     already_weights = []
     already_source_ids = []
     already_description = []
     already_keywords = []
+    known_tokens = {}
 
-    if await knowledge_hypergraph_inst.has_hyperedge(id_set):
+    if merge_stored and await knowledge_hypergraph_inst.has_hyperedge(id_set):
         already_edge = await knowledge_hypergraph_inst.get_hyperedge(id_set)
         already_weights.append(already_edge["weight"])
         already_source_ids.extend(
@@ -350,20 +660,26 @@ async def _merge_edges_then_upsert(
         already_keywords.extend(
             split_string_by_multi_markers(already_edge["keywords"], [GRAPH_FIELD_SEP])
         )
+        if already_edge.get("description_tokens") is not None:
+            known_tokens[already_edge["description"]] = already_edge["description_tokens"]
+        # the stored count only matches a single keywords part, e.g. after a summary
+        if len(already_keywords) == 1 and already_edge.get("keywords_tokens") is not None:
+            known_tokens[already_keywords[0]] = already_edge["keywords_tokens"]
 
     weight = sum([dp["weight"] for dp in edges_data] + already_weights)
-    description = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["description"] for dp in edges_data] + already_description))
-    )
-    keywords = GRAPH_FIELD_SEP.join(
-        sorted(set([dp["keywords"] for dp in edges_data] + already_keywords))
-    )
+    descriptions = sorted(set([dp["description"] for dp in edges_data] + already_description))
+    description = GRAPH_FIELD_SEP.join(descriptions)
+    keywords_list = sorted(set([dp["keywords"] for dp in edges_data] + already_keywords))
+    keywords = GRAPH_FIELD_SEP.join(keywords_list)
     source_id = GRAPH_FIELD_SEP.join(
         set([dp["source_id"] for dp in edges_data] + already_source_ids)
     )
 
     for need_insert_id in id_set:
         if not (await knowledge_hypergraph_inst.has_vertex(need_insert_id)):
+            unknown_tokens = len(
+                encode_string_by_tiktoken("UNKNOWN", model_name=tiktoken_model_name)
+            )
             await knowledge_hypergraph_inst.upsert_vertex(
                 need_insert_id,
                 {
@@ -371,48 +687,266 @@ async def _merge_edges_then_upsert(
                     "description": "UNKNOWN", # 超边描述
                     "additional_properties": "UNKNOWN", # 超边关键词
                     "entity_type": "UNKNOWN",
+                    "description_tokens": unknown_tokens,
+                    "additional_properties_tokens": unknown_tokens,
                 },
             )
-    description = await _handle_relation_summary(  # 应该重新写一个针对超边描述进行合并的函数
-        id_set, description, global_config
+    return dict(
+        description=description,
+        keywords=keywords,
+        source_id=source_id,
+        weight=weight,
+        description_tokens=_count_joined_tokens(descriptions, known_tokens, tiktoken_model_name),
+        keywords_tokens=_count_joined_tokens(keywords_list, known_tokens, tiktoken_model_name),
     )
 
-    filter_keywords = await _handle_relation_keywords_summary(  # 应该重新写一个针对超边的关键词进行合并的函数
-        id_set, keywords, global_config
-    )
 
+async def _upsert_merged_edge(
+    id_set: tuple,
+    edge_data: dict,
+    knowledge_hypergraph_inst,
+) -> dict:
     await knowledge_hypergraph_inst.upsert_hyperedge(
         id_set,
-        dict(
-            description=description,
-            keywords=filter_keywords,
-            source_id=source_id,
-            weight=weight
-        ),
+        edge_data,
     )
 
-    edge_data = dict(
+    return dict(
         id_set=id_set,
-        description=description,
-        keywords=filter_keywords,
+        description=edge_data["description"],
+        keywords=edge_data["keywords"],
     )
 
-    return edge_data
 
+async def _merge_edges_then_upsert(
+    id_set: tuple,
+    edges_data: list[dict],
+    knowledge_hypergraph_inst,
+    global_config: dict,
+):
+    edge_data = await _merge_edges_data(
+        id_set, edges_data, knowledge_hypergraph_inst, global_config
+    )
+    await _summarize_merged_edge(id_set, edge_data, global_config)
+    return await _upsert_merged_edge(id_set, edge_data, knowledge_hypergraph_inst)
 
-async def extract_entities(
-    chunks: dict[str, TextChunkSchema],
-    knowledge_hypergraph_inst: BaseHypergraphStorage,
-    entity_vdb: BaseVectorStorage,
-    relationships_vdb: BaseVectorStorage,
+
+async def _summarize_merged_edge(id_set: tuple, edge_data: dict, global_config: dict):
+    description = await _handle_relation_summary(  # 应该重新写一个针对超边描述进行合并的函数
+        id_set, edge_data["description"], global_config, edge_data.get("description_tokens")
+    )
+    _set_summarized_field(edge_data, "description", description, global_config)
+
+    keywords = await _handle_relation_keywords_summary(  # 应该重新写一个针对超边的关键词进行合并的函数
+        id_set, edge_data["keywords"], global_config, edge_data.get("keywords_tokens")
+    )
+    _set_summarized_field(edge_data, "keywords", keywords, global_config)
+
+
+# kind of summary -> (single item handler, config key of the max summary tokens)
+_SUMMARY_HANDLERS = {
+    "entity_description": (_handle_entity_summary, "entity_summary_to_max_tokens"),
+    "entity_additional_properties": (
+        _handle_entity_additional_properties,
+        "entity_additional_properties_to_max_tokens",
+    ),
+    "relation_description": (_handle_relation_summary, "relation_summary_to_max_tokens"),
+    "relation_keywords": (
+        _handle_relation_keywords_summary,
+        "relation_keywords_to_max_tokens",
+    ),
+}
+
+
+async def _handle_batch_summary_items(
+    kind: str,
+    items: list[tuple[int, Any, str]],
     global_config: dict,
-) -> BaseHypergraphStorage | None:
+) -> dict[int, str]:
+    """Summarize several (index, name, text) items of the same kind with one LLM call.
+    Items missing from the parsed response, or all of them if the call fails, fall back
+    to the single item handler.
+    """
+    handler, max_tokens_key = _SUMMARY_HANDLERS[kind]
+    if len(items) == 1:
+        index, name, text = items[0]
+        return {index: await handler(name, text, global_config)}
+
     use_llm_func: callable = global_config["llm_model_func"]
-    entity_extract_max_gleaning = global_config["entity_extract_max_gleaning"]
+    summary_max_tokens = global_config[max_tokens_key]
+    item_prompt = PROMPTS["summarize_batch_item"]
+    items_str = "\n".join(
+        item_prompt.format(
+            item_id=i + 1,
+            name=name,
+            data_list=text.split(GRAPH_FIELD_SEP),
+            max_tokens=summary_max_tokens,
+        )
+        for i, (_, name, text) in enumerate(items)
+    )
+    use_prompt = PROMPTS["summarize_batch"].format(
+        task=PROMPTS["summarize_batch_tasks"][kind], items=items_str
+    )
+    logger.debug(f"Trigger batch summary of {len(items)} {kind}")
+    summaries = {}
+    try:
+        response = await use_llm_func(
+            use_prompt, max_tokens=summary_max_tokens * len(items)
+        )
+    except Exception as e:
+        logger.warning(f"Failed the batch summary of {len(items)} {kind}: {e!r}")
+        response = None
+    try:
+        parsed = json.loads(locate_json_string_body_from_string(response or "") or "")
+        if isinstance(parsed, dict):
+            for i, (index, _, _) in enumerate(items):
+                summary = parsed.get(str(i + 1))
+                if isinstance(summary, str) and summary.strip():
+                    summaries[index] = summary.strip()
+    except json.JSONDecodeError:
+        logger.warning(f"Failed to parse the batch summary of {len(items)} {kind}")
 
-    ordered_chunks = list(chunks.items())
+    missing = [item for item in items if item[0] not in summaries]
+    if len(missing):
+        logger.debug(f"Fall back to single summary for {len(missing)} {kind}")
+        fallback = await asyncio.gather(
+            *[handler(name, text, global_config) for _, name, text in missing]
+        )
+        summaries.update({item[0]: summary for item, summary in zip(missing, fallback)})
+    return summaries
 
-    entity_extract_prompt = PROMPTS["entity_extraction"]
+
+async def _handle_batch_summary(
+    requests: list[tuple[str, Any, str, int]],
+    global_config: dict,
+) -> list[str]:
+    """Summarize a list of (kind, name, text, num_tokens) requests.
+
+    Texts under the summary threshold of their kind are returned as is, the others are
+    packed into batch prompts of the same kind, bounded by `summary_batch_max_items`,
+    by `summary_batch_max_output_tokens` for the expected summaries and by
+    `llm_model_max_token_size` for the prompt plus the expected summaries.
+    """
+    llm_max_tokens = global_config["llm_model_max_token_size"]
+    tiktoken_model_name = global_config["tiktoken_model_name"]
+    max_output_tokens = global_config["summary_batch_max_output_tokens"]
+    # the batch prompt template, and the per item header
+    base_tokens = len(
+        encode_string_by_tiktoken(PROMPTS["summarize_batch"], model_name=tiktoken_model_name)
+    )
+    item_tokens = len(
+        encode_string_by_tiktoken(PROMPTS["summarize_batch_item"], model_name=tiktoken_model_name)
+    )
+
+    results = [text for _, _, text, _ in requests]
+    batches = []
+    for kind, (_, max_tokens_key) in _SUMMARY_HANDLERS.items():
+        summary_max_tokens = global_config[max_tokens_key]
+        max_items = max(
+            1,
+            min(global_config["summary_batch_max_items"], max_output_tokens // summary_max_tokens),
+        )
+        batch, batch_tokens = [], base_tokens
+        for index, (item_kind, name, text, num_tokens) in enumerate(requests):
+            if item_kind != kind:
+                continue
+            if num_tokens is None:
+                num_tokens = len(encode_string_by_tiktoken(text, model_name=tiktoken_model_name))
+            if num_tokens < summary_max_tokens:  # No need for summary
+                continue
+            cost = num_tokens + item_tokens + summary_max_tokens
+            if len(batch) and (
+                len(batch) >= max_items or batch_tokens + cost > llm_max_tokens
+            ):
+                batches.append((kind, batch))
+                batch, batch_tokens = [], base_tokens
+            # an item too large for any batch goes alone, the single handler truncates it
+            batch.append((index, name, text))
+            batch_tokens += cost
+        if len(batch):
+            batches.append((kind, batch))
+
+    summaries_list = await asyncio.gather(
+        *[_handle_batch_summary_items(kind, batch, global_config) for kind, batch in batches]
+    )
+    for summaries in summaries_list:
+        for index, summary in summaries.items():
+            results[index] = summary
+    return results
+
+
+async def _summarize_merged_nodes(
+    entity_names: list[str],
+    nodes_data: list[dict],
+    global_config: dict,
+):
+    """Summarize the merged fields of several vertices in place, through batch prompts
+    if `enable_batch_summary` is set.
+    """
+    if not global_config["enable_batch_summary"]:
+        await asyncio.gather(
+            *[
+                _summarize_merged_node(k, dp, global_config)
+                for k, dp in zip(entity_names, nodes_data)
+            ]
+        )
+        return
+    summaries = await _handle_batch_summary(
+        [
+            ("entity_description", k, dp["description"], dp.get("description_tokens"))
+            for k, dp in zip(entity_names, nodes_data)
+        ]
+        + [
+            (
+                "entity_additional_properties",
+                k,
+                dp["additional_properties"],
+                dp.get("additional_properties_tokens"),
+            )
+            for k, dp in zip(entity_names, nodes_data)
+        ],
+        global_config,
+    )
+    for i, dp in enumerate(nodes_data):
+        _set_summarized_field(dp, "description", summaries[i], global_config)
+        _set_summarized_field(
+            dp, "additional_properties", summaries[len(nodes_data) + i], global_config
+        )
+
+
+async def _summarize_merged_edges(
+    id_sets: list[tuple],
+    edges_data: list[dict],
+    global_config: dict,
+):
+    """Summarize the merged fields of several hyperedges in place, through batch prompts
+    if `enable_batch_summary` is set.
+    """
+    if not global_config["enable_batch_summary"]:
+        await asyncio.gather(
+            *[
+                _summarize_merged_edge(k, dp, global_config)
+                for k, dp in zip(id_sets, edges_data)
+            ]
+        )
+        return
+    summaries = await _handle_batch_summary(
+        [
+            ("relation_description", k, dp["description"], dp.get("description_tokens"))
+            for k, dp in zip(id_sets, edges_data)
+        ]
+        + [
+            ("relation_keywords", k, dp["keywords"], dp.get("keywords_tokens"))
+            for k, dp in zip(id_sets, edges_data)
+        ],
+        global_config,
+    )
+    for i, dp in enumerate(edges_data):
+        _set_summarized_field(dp, "description", summaries[i], global_config)
+        _set_summarized_field(dp, "keywords", summaries[len(edges_data) + i], global_config)
+
+
+def _get_extraction_context() -> dict:
     # We can choose the example what we want from the prompt.
     example_base = dict(
         tuple_delimiter=PROMPTS["DEFAULT_TUPLE_DELIMITER"],
@@ -422,7 +956,7 @@ async def extract_entities(
     example_prompt = PROMPTS["entity_extraction_examples"][0]
     example_str = example_prompt.format(**example_base)
 
-    context_base = dict(
+    return dict(
         language=PROMPTS["DEFAULT_LANGUAGE"],
         entity_types=",".join(PROMPTS["DEFAULT_ENTITY_TYPES"]),
         tuple_delimiter=PROMPTS["DEFAULT_TUPLE_DELIMITER"],
@@ -430,123 +964,224 @@ async def extract_entities(
         completion_delimiter=PROMPTS["DEFAULT_COMPLETION_DELIMITER"],
         examples = example_str
     )
+
+
+async def _extract_single_chunk(
+    chunk_key: str,
+    chunk_dp: TextChunkSchema,
+    global_config: dict,
+    context_base: dict = None,
+):
+    """Run the extraction prompt (with gleaning) on one chunk and parse the records.
+
+    Returns the (maybe_nodes, maybe_edges, maybe_edges_low, maybe_edges_high) dicts,
+    or four None if the LLM returned nothing.
+    """
+    use_llm_func: callable = global_config["llm_model_func"]
+    entity_extract_max_gleaning = global_config["entity_extract_max_gleaning"]
+    if context_base is None:
+        context_base = _get_extraction_context()
+    entity_extract_prompt = PROMPTS["entity_extraction"]
     continue_prompt = PROMPTS["entity_continue_extraction"]
     if_loop_prompt = PROMPTS["entity_if_loop_extraction"]
 
-    already_processed = 0
-    already_entities = 0
-    already_relations = 0
-    already_relations_low = 0
-    already_relations_high = 0
+    content = chunk_dp["content"]
+    hint_prompt = entity_extract_prompt.format(**context_base, input_text=content)
 
-    async def _process_single_content(chunk_key_dp: tuple[str, TextChunkSchema]):
-        nonlocal already_processed, already_entities, already_relations, already_relations_low, already_relations_high
-        chunk_key = chunk_key_dp[0]
-        chunk_dp = chunk_key_dp[1]
-        content = chunk_dp["content"]
-        hint_prompt = entity_extract_prompt.format(**context_base, input_text=content)
-
-        final_result = await use_llm_func(hint_prompt)
-        if final_result is None:
-            return None,None,None,None
-
-        history = pack_user_ass_to_openai_messages(hint_prompt, final_result)
-        for now_glean_index in range(entity_extract_max_gleaning):
-            glean_result = await use_llm_func(continue_prompt, history_messages=history)
-            if glean_result is None:
-                break
+    final_result = await use_llm_func(hint_prompt)
+    if final_result is None:
+        return None,None,None,None
 
-            history += pack_user_ass_to_openai_messages(continue_prompt, glean_result)
-            final_result += glean_result
-            if now_glean_index == entity_extract_max_gleaning - 1:
-                break
+    history = pack_user_ass_to_openai_messages(hint_prompt, final_result)
+    for now_glean_index in range(entity_extract_max_gleaning):
+        glean_result = await use_llm_func(continue_prompt, history_messages=history)
+        if glean_result is None:
+            break
 
-            if_loop_result: str = await use_llm_func(
-                if_loop_prompt, history_messages=history
-            )
-            if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
-            if if_loop_result != "yes":
-                break
+        history += pack_user_ass_to_openai_messages(continue_prompt, glean_result)
+        final_result += glean_result
+        if now_glean_index == entity_extract_max_gleaning - 1:
+            break
 
-        records = split_string_by_multi_markers(
-            final_result,
-            [context_base["record_delimiter"], context_base["completion_delimiter"]],
+        if_loop_result: str = await use_llm_func(
+            if_loop_prompt, history_messages=history
         )
+        if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
+        if if_loop_result != "yes":
+            break
 
-        maybe_nodes = defaultdict(list)
-        maybe_edges = defaultdict(list)
-        maybe_edges_low = defaultdict(list)
-        maybe_edges_high = defaultdict(list)
-        for record in records:
-            record = re.search(r"\((.*)\)", record)
-            if record is None:
-                continue
-            record = record.group(1)
-            record_attributes = split_string_by_multi_markers(
-                record, [context_base["tuple_delimiter"]]
+    return await _parse_extraction_records(final_result, chunk_key, context_base)
+
+
+async def _parse_extraction_records(final_result: str, chunk_key: str, context_base: dict):
+    """Parse the records of the extraction (and gleaning) answers of one chunk"""
+    records = split_string_by_multi_markers(
+        final_result,
+        [context_base["record_delimiter"], context_base["completion_delimiter"]],
+    )
+
+    maybe_nodes = defaultdict(list)
+    maybe_edges = defaultdict(list)
+    maybe_edges_low = defaultdict(list)
+    maybe_edges_high = defaultdict(list)
+    for record in records:
+        record = re.search(r"\((.*)\)", record)
+        if record is None:
+            continue
+        record = record.group(1)
+        record_attributes = split_string_by_multi_markers(
+            record, [context_base["tuple_delimiter"]]
+        )
+        if_entities = await _handle_single_entity_extraction(
+            record_attributes, chunk_key
+        )
+        if if_entities is not None:
+            maybe_nodes[if_entities["entity_name"]].append(if_entities)
+            continue
+
+        if_relation = await _handle_single_relationship_extraction_low(
+            record_attributes, chunk_key
+        )
+        if if_relation is not None:
+            maybe_edges[tuple((if_relation["entityN"]))].append(
+                if_relation
             )
-            if_entities = await _handle_single_entity_extraction(
-                record_attributes, chunk_key
+            maybe_edges_low[tuple((if_relation["entityN"]))].append(
+                if_relation
             )
-            if if_entities is not None:
-                maybe_nodes[if_entities["entity_name"]].append(if_entities)
-                continue
 
-            if_relation = await _handle_single_relationship_extraction_low(
-                record_attributes, chunk_key
+        if_relation = await _handle_single_relationship_extraction_high(
+            record_attributes, chunk_key
+        )
+        if if_relation is not None:
+            maybe_edges[tuple((if_relation["entityN"]))].append(
+                if_relation
             )
-            if if_relation is not None:
-                maybe_edges[tuple((if_relation["entityN"]))].append(
-                    if_relation
-                )
-                maybe_edges_low[tuple((if_relation["entityN"]))].append(
-                    if_relation
-                )
-
-            if_relation = await _handle_single_relationship_extraction_high(
-                record_attributes, chunk_key
+            maybe_edges_high[tuple((if_relation["entityN"]))].append(
+                if_relation
             )
-            if if_relation is not None:
-                maybe_edges[tuple((if_relation["entityN"]))].append(
-                    if_relation
-                )
-                maybe_edges_high[tuple((if_relation["entityN"]))].append(
-                    if_relation
-                )
+    return dict(maybe_nodes), dict(maybe_edges), dict(maybe_edges_low), dict(maybe_edges_high)
+
+
+def _dump_extraction_result(result: tuple) -> dict:
+    """Make the result of _extract_single_chunk json serializable (hyperedge keys are tuples)"""
+    m_nodes, m_edges, low_edge, high_edge = result
+    return dict(
+        nodes=m_nodes,
+        edges=[[list(k), v] for k, v in m_edges.items()],
+        edges_low=[[list(k), v] for k, v in low_edge.items()],
+        edges_high=[[list(k), v] for k, v in high_edge.items()],
+    )
+
+
+def _load_extraction_result(data: dict) -> tuple:
+    return (
+        data["nodes"],
+        {tuple(k): v for k, v in data["edges"]},
+        {tuple(k): v for k, v in data["edges_low"]},
+        {tuple(k): v for k, v in data["edges_high"]},
+    )
+
+
+async def _extract_single_chunk_or_checkpoint(
+    chunk_key: str,
+    chunk_dp: TextChunkSchema,
+    global_config: dict,
+    context_base: dict,
+    extraction_checkpoint: BaseKVStorage = None,
+):
+    """Reuse the checkpointed extraction of the chunk if there is one, otherwise
+    extract it and checkpoint the parsed result right away.
+    """
+    if extraction_checkpoint is not None:
+        checkpoint = await extraction_checkpoint.get_by_id(chunk_key)
+        if checkpoint is not None:
+            logger.debug(f"Resume extraction of {chunk_key} from checkpoint")
+            return _load_extraction_result(checkpoint["result"])
+    result = await _extract_single_chunk(
+        chunk_key, chunk_dp, global_config, context_base
+    )
+    if extraction_checkpoint is not None and result[0] is not None:
+        await extraction_checkpoint.upsert(
+            {chunk_key: {"result": _dump_extraction_result(result)}}
+        )
+    return result
+
 
-        already_processed += 1
-        already_entities += len(maybe_nodes)
-        already_relations += len(maybe_edges)
-        already_relations_low += len(maybe_edges_low)
-        already_relations_high += len(maybe_edges_high)
+def _relabel_extraction_result(data: dict, chunk_key: str) -> dict:
+    """The dumped extraction result of a chunk, as extracted from the chunk `chunk_key`"""
+    return {
+        k: (
+            {name: [{**dp, "source_id": chunk_key} for dp in v] for name, v in records.items()}
+            if k == "nodes"
+            else [[id_set, [{**dp, "source_id": chunk_key} for dp in v]] for id_set, v in records]
+        )
+        for k, records in data.items()
+    }
+
+
+async def _store_chunk_extractions(
+    chunk_extractions: BaseKVStorage, chunk_results: list[tuple[str, tuple]]
+):
+    """Keep the parsed extraction of the merged chunks, delete_chunks_from_hypergraph
+    merges the remaining chunks again from them instead of extracting them again.
+    """
+    if chunk_extractions is None:
+        return
+    await chunk_extractions.upsert(
+        {
+            chunk_key: {"result": _dump_extraction_result(result)}
+            for chunk_key, result in chunk_results
+            if result[0] is not None
+        }
+    )
+
+
+class _ExtractionProgress:
+    """Counters and the progress bar printed while extracting chunks"""
+
+    def __init__(self, total: int = None):
+        self.total = total
+        self.begin_time = datetime.now()
+        self.processed = 0
+        self.entities = 0
+        self.relations = 0
+        self.relations_low = 0
+        self.relations_high = 0
+
+    def update(self, result):
+        m_nodes, m_edges, low_edge, high_edge = result
+        self.processed += 1
+        self.entities += len(m_nodes or {})
+        self.relations += len(m_edges or {})
+        self.relations_low += len(low_edge or {})
+        self.relations_high += len(high_edge or {})
         now_ticks = PROMPTS["process_tickers"][
-            already_processed % len(PROMPTS["process_tickers"])
+            self.processed % len(PROMPTS["process_tickers"])
         ]
 
         # 计算用时
         current_time = datetime.now()
-        time = current_time - begin_time
+        time = current_time - self.begin_time
         total_seconds = int(time.total_seconds())
         hours = total_seconds // 3600
         minutes = (total_seconds % 3600) // 60
         seconds = total_seconds % 60
-        # 进度条
-        percent = (already_processed / len(ordered_chunks)) * 100
-        bar_length = int(50 * already_processed // len(ordered_chunks))
-        bar = '█' * bar_length + '-' * (50 - bar_length)
+        # 进度条, 总数未知时只显示已处理数
+        if self.total:
+            percent = (self.processed / self.total) * 100
+            bar_length = int(50 * self.processed // self.total)
+            bar = '█' * bar_length + '-' * (50 - bar_length)
+            head = f'|{bar}| {percent:.2f}% '
+        else:
+            head = f'| {self.processed} chunks '
         sys.stdout.write(
-            f'\n\r|{bar}| {percent:.2f}% |{hours:02}:{minutes:02}:{seconds:02}| {now_ticks} Processed, {already_entities} entities, {already_relations} relations, {already_relations_low} relations_low, {already_relations_high} relations_high \n')
+            f'\n\r{head}|{hours:02}:{minutes:02}:{seconds:02}| {now_ticks} Processed, {self.entities} entities, {self.relations} relations, {self.relations_low} relations_low, {self.relations_high} relations_high \n')
         sys.stdout.flush()
-        return dict(maybe_nodes), dict(maybe_edges), dict(maybe_edges_low), dict(maybe_edges_high)
 
-    # ----------------------------------------------------------------------------
-    # use_llm_func is wrapped in ascynio.Semaphore, limiting max_async callings
-    begin_time = datetime.now()
-    results = await asyncio.gather(
-        *[_process_single_content(c) for c in ordered_chunks ]
-    )
-    
-    # print()  # clear the progress bar
+
+def _group_extraction_results(results: list[tuple]) -> tuple[dict, dict]:
+    """Group the per-chunk extraction results by entity name / sorted hyperedge tuple"""
     maybe_nodes = defaultdict(list)
     maybe_edges = defaultdict(list)
     high = defaultdict(list)
@@ -566,10 +1201,28 @@ async def extract_entities(
                 high[tuple(sorted(k))].extend(v)
         if m_nodes is None or m_edges is None or low_edge is None or high_edge is None:
             print("extract a element that is None")
+    return maybe_nodes, maybe_edges
+
+
+async def _merge_extraction_results(
+    results: list[tuple],
+    knowledge_hypergraph_inst: BaseHypergraphStorage,
+    global_config: dict,
+) -> tuple[list[dict], list[dict]]:
+    """Group the per-chunk extraction results by entity / hyperedge and merge them
+    into the hypergraph. Return the merged entities and hyperedges data.
+    """
+    # print()  # clear the progress bar
+    maybe_nodes, maybe_edges = _group_extraction_results(results)
     # ----------------------------------------------------------------------------
     """
         update the hypergraph database
     """
+    if global_config["enable_batch_summary"]:
+        return await _merge_extraction_results_batch_summary(
+            maybe_nodes, maybe_edges, knowledge_hypergraph_inst, global_config
+        )
+
     all_entities_data = await asyncio.gather(
         *[
             _merge_nodes_then_upsert(k, v, knowledge_hypergraph_inst, global_config)
@@ -583,40 +1236,650 @@ async def extract_entities(
             for k, v in maybe_edges.items()
         ]
     )
-    if not len(all_entities_data):
-        logger.warning("Didn't extract any entities, maybe your LLM is not working")
-        return None
-    if not len(all_relationships_data):
-        logger.warning(
-            "Didn't extract any relationships, maybe your LLM is not working"
-        )
-        return None
+    return all_entities_data, all_relationships_data
+
+
+async def _merge_extraction_results_batch_summary(
+    maybe_nodes: dict[str, list[dict]],
+    maybe_edges: dict[tuple, list[dict]],
+    knowledge_hypergraph_inst: BaseHypergraphStorage,
+    global_config: dict,
+) -> tuple[list[dict], list[dict]]:
+    """Same as the merge in _merge_extraction_results, but all the summaries needed by
+    the merged entities (and then hyperedges) are requested through batch prompts.
+    """
+    entity_names = list(maybe_nodes.keys())
+    nodes_data = await asyncio.gather(
+        *[
+            _merge_nodes_data(k, maybe_nodes[k], knowledge_hypergraph_inst, global_config)
+            for k in entity_names
+        ]
+    )
+    await _summarize_merged_nodes(entity_names, nodes_data, global_config)
+    all_entities_data = await asyncio.gather(
+        *[
+            _upsert_merged_node(k, dp, knowledge_hypergraph_inst)
+            for k, dp in zip(entity_names, nodes_data)
+        ]
+    )
+
+    id_sets = list(maybe_edges.keys())
+    edges_data = await asyncio.gather(
+        *[
+            _merge_edges_data(k, maybe_edges[k], knowledge_hypergraph_inst, global_config)
+            for k in id_sets
+        ]
+    )
+    await _summarize_merged_edges(id_sets, edges_data, global_config)
+    all_relationships_data = await asyncio.gather(
+        *[
+            _upsert_merged_edge(k, dp, knowledge_hypergraph_inst)
+            for k, dp in zip(id_sets, edges_data)
+        ]
+    )
+    return all_entities_data, all_relationships_data
+
 
-    if entity_vdb is not None:
+async def _upsert_extraction_to_vdb(
+    all_entities_data: list[dict],
+    all_relationships_data: list[dict],
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+):
+    """Upsert the merged entities and hyperedges into the vdbs, except the ones stored
+    there with the same content hash, whose embedding would not change.
+    """
+    if entity_vdb is not None and len(all_entities_data):
         data_for_vdb = {
             compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
-                "content": dp["entity_name"] + dp["description"],
+                "content": _entity_vdb_content(dp["entity_name"], dp["description"]),
                 "entity_name": dp["entity_name"],
             }
             for dp in all_entities_data
         }
-        await entity_vdb.upsert(data_for_vdb)
+        await _upsert_changed_to_vdb(entity_vdb, data_for_vdb)
 
-    if relationships_vdb is not None:
+    if relationships_vdb is not None and len(all_relationships_data):
         data_for_vdb = {
             compute_mdhash_id(str(sorted(dp["id_set"])), prefix="rel-"): {
                 "id_set": dp["id_set"],
-                "content": dp["keywords"]
-                           + str(dp["id_set"])
-                           + dp["description"],
+                "content": _relation_vdb_content(
+                    dp["id_set"], dp["keywords"], dp["description"]
+                ),
             }
             for dp in all_relationships_data
         }
-        await relationships_vdb.upsert(data_for_vdb)
+        await _upsert_changed_to_vdb(relationships_vdb, data_for_vdb)
+
+
+async def _upsert_changed_to_vdb(vdb: BaseVectorStorage, data_for_vdb: dict[str, dict]):
+    for dp in data_for_vdb.values():
+        dp["content_hash"] = compute_mdhash_id(dp["content"])
+    stored = await vdb.get_by_ids(list(data_for_vdb))
+    data_for_vdb = {
+        k: dp
+        for (k, dp), stored_dp in zip(data_for_vdb.items(), stored)
+        if stored_dp is None or stored_dp.get("content_hash") != dp["content_hash"]
+    }
+    num_unchanged = len(stored) - len(data_for_vdb)
+    if num_unchanged:
+        logger.info(f"Skip the upsert of {num_unchanged} unchanged vectors to {vdb.namespace}")
+    if len(data_for_vdb):
+        await vdb.upsert(data_for_vdb)
+
+
+async def extract_entities(
+    chunks: dict[str, TextChunkSchema],
+    knowledge_hypergraph_inst: BaseHypergraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    global_config: dict,
+    extraction_checkpoint: BaseKVStorage = None,
+    merge_lock: asyncio.Lock = None,
+    chunk_extractions: BaseKVStorage = None,
+) -> BaseHypergraphStorage | None:
+    """Extract the chunks concurrently, then merge the results into the hypergraph and
+    the vector dbs. `merge_lock` serializes the merge with the other inserts sharing it.
+    The parsed results of the merged chunks are kept in `chunk_extractions`.
+    """
+    if merge_lock is None:
+        merge_lock = asyncio.Lock()
+    ordered_chunks = list(chunks.items())
+    context_base = _get_extraction_context()
+    progress = _ExtractionProgress(total=len(ordered_chunks))
+
+    async def _process_single_content(chunk_key_dp: tuple[str, TextChunkSchema]):
+        result = await _extract_single_chunk_or_checkpoint(
+            chunk_key_dp[0],
+            chunk_key_dp[1],
+            global_config,
+            context_base,
+            extraction_checkpoint,
+        )
+        progress.update(result)
+        return result
+
+    # ----------------------------------------------------------------------------
+    # use_llm_func is wrapped in ascynio.Semaphore, limiting max_async callings
+    tasks = [asyncio.create_task(_process_single_content(c)) for c in ordered_chunks]
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        # do not leave the other chunks running (and checkpointing) after a failure
+        for task in tasks:
+            task.cancel()
+        raise
+
+    async with merge_lock:
+        all_entities_data, all_relationships_data = await _merge_extraction_results(
+            results, knowledge_hypergraph_inst, global_config
+        )
+        if not len(all_entities_data):
+            logger.warning("Didn't extract any entities, maybe your LLM is not working")
+            return None
+        if not len(all_relationships_data):
+            logger.warning(
+                "Didn't extract any relationships, maybe your LLM is not working"
+            )
+            return None
+
+        await _upsert_extraction_to_vdb(
+            all_entities_data, all_relationships_data, entity_vdb, relationships_vdb
+        )
+        await _store_chunk_extractions(
+            chunk_extractions, [(k, r) for (k, _), r in zip(ordered_chunks, results)]
+        )
+    return knowledge_hypergraph_inst
 
+
+def deferred_extraction_state(chunk_dp: TextChunkSchema, context_base: dict = None) -> dict:
+    """State of the deferred extraction of a chunk, "messages" is its next request"""
+    if context_base is None:
+        context_base = _get_extraction_context()
+    hint_prompt = PROMPTS["entity_extraction"].format(
+        **context_base, input_text=chunk_dp["content"]
+    )
+    return {"messages": [{"role": "user", "content": hint_prompt}], "result": "", "round": 0}
+
+
+def advance_deferred_extraction(state: dict, completion: str, global_config: dict) -> bool:
+    """Add the completion of the last request to the state, returns True once the
+    extraction and its gleaning rounds are complete, otherwise the state holds the
+    gleaning request. There is no loop check between the gleaning rounds, all
+    entity_extract_max_gleaning rounds are requested.
+    """
+    state["messages"].append({"role": "assistant", "content": completion})
+    state["result"] += completion
+    state["round"] += 1
+    if state["round"] > global_config["entity_extract_max_gleaning"]:
+        return True
+    state["messages"].append({"role": "user", "content": PROMPTS["entity_continue_extraction"]})
+    return False
+
+
+async def merge_deferred_extractions(
+    final_results: dict[str, str],
+    knowledge_hypergraph_inst: BaseHypergraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    global_config: dict,
+    chunk_extractions: BaseKVStorage = None,
+) -> BaseHypergraphStorage | None:
+    """Parse the completed deferred extractions {chunk_key: answers} and merge them into
+    the hypergraph and the vector dbs, as extract_entities does after the llm calls.
+    """
+    context_base = _get_extraction_context()
+    results = [
+        await _parse_extraction_records(final_result, chunk_key, context_base)
+        for chunk_key, final_result in final_results.items()
+    ]
+    all_entities_data, all_relationships_data = await _merge_extraction_results(
+        results, knowledge_hypergraph_inst, global_config
+    )
+    if not len(all_entities_data):
+        logger.warning("Didn't extract any entities from the completions")
+        return None
+    await _upsert_extraction_to_vdb(
+        all_entities_data, all_relationships_data, entity_vdb, relationships_vdb
+    )
+    await _store_chunk_extractions(chunk_extractions, list(zip(final_results, results)))
     return knowledge_hypergraph_inst
 
 
+_PIPELINE_DONE = object()
+
+
+def _drain_queue(queue: asyncio.Queue, first) -> list:
+    items = [first]
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+async def extract_entities_pipeline(
+    chunks: Iterable[tuple[str, TextChunkSchema]],
+    knowledge_hypergraph_inst: BaseHypergraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    chunks_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    global_config: dict,
+    extraction_checkpoint: BaseKVStorage = None,
+    merge_lock: asyncio.Lock = None,
+    chunk_extractions: BaseKVStorage = None,
+) -> BaseHypergraphStorage | None:
+    """Staged version of the insert: chunk embedding -> extraction -> merge -> vdb upsert.
+
+    The stages are connected by bounded asyncio queues, so a chunk goes to extraction
+    as soon as it is produced, and merged entities and hyperedges go to the vector
+    dbs as soon as they are summarized. The merge stage merges whatever extraction
+    results are queued when it becomes free. Chunks are written to `text_chunks_db`
+    after their entities are merged. `merge_lock` serializes the merge stage with the
+    other inserts sharing it.
+    """
+    if merge_lock is None:
+        merge_lock = asyncio.Lock()
+    queue_size = global_config["insert_pipeline_queue_size"]
+    num_workers = max(1, global_config["llm_model_max_async"])
+    group_size = global_config["embedding_batch_num"]
+    context_base = _get_extraction_context()
+    progress = _ExtractionProgress()
+
+    extract_queue = asyncio.Queue(maxsize=queue_size)
+    merge_queue = asyncio.Queue(maxsize=queue_size)
+    vdb_queue = asyncio.Queue(maxsize=queue_size)
+    seen_chunk_keys = set()
+    num_new_chunks = 0
+    merged_any_entities = False
+
+    async def _feed_chunks():
+        group = {}
+
+        async def _flush():
+            nonlocal num_new_chunks
+            new_keys = await text_chunks_db.filter_keys(list(group.keys()))
+            new_chunks = {k: v for k, v in group.items() if k in new_keys}
+            if not len(new_chunks):
+                return
+            num_new_chunks += len(new_chunks)
+            await chunks_vdb.upsert(new_chunks)
+            for item in new_chunks.items():
+                await extract_queue.put(item)
+
+        for chunk_key, chunk_dp in chunks:
+            if chunk_key in seen_chunk_keys:
+                continue
+            seen_chunk_keys.add(chunk_key)
+            group[chunk_key] = chunk_dp
+            if len(group) >= group_size:
+                await _flush()
+                group = {}
+        if len(group):
+            await _flush()
+        for _ in range(num_workers):
+            await extract_queue.put(_PIPELINE_DONE)
+
+    async def _extract_chunks():
+        while (item := await extract_queue.get()) is not _PIPELINE_DONE:
+            result = await _extract_single_chunk_or_checkpoint(
+                item[0], item[1], global_config, context_base, extraction_checkpoint
+            )
+            progress.update(result)
+            await merge_queue.put((item, result))
+        await merge_queue.put(_PIPELINE_DONE)
+
+    async def _merge_results():
+        nonlocal merged_any_entities
+        finished_workers = 0
+        while finished_workers < num_workers:
+            items = _drain_queue(merge_queue, await merge_queue.get())
+            finished_workers += sum(1 for it in items if it is _PIPELINE_DONE)
+            items = [it for it in items if it is not _PIPELINE_DONE]
+            if not len(items):
+                continue
+            async with merge_lock:
+                all_entities_data, all_relationships_data = await _merge_extraction_results(
+                    [result for _, result in items], knowledge_hypergraph_inst, global_config
+                )
+                await _store_chunk_extractions(
+                    chunk_extractions, [(item[0], result) for item, result in items]
+                )
+            if not len(all_entities_data):
+                logger.warning(
+                    f"Didn't extract any entities from {len(items)} chunks, maybe your LLM is not working"
+                )
+                continue
+            merged_any_entities = True
+            await vdb_queue.put(
+                (all_entities_data, all_relationships_data, dict(item for item, _ in items))
+            )
+        await vdb_queue.put(_PIPELINE_DONE)
+
+    async def _upsert_vdb():
+        done = False
+        while not done:
+            items = _drain_queue(vdb_queue, await vdb_queue.get())
+            done = items[-1] is _PIPELINE_DONE
+            items = [it for it in items if it is not _PIPELINE_DONE]
+            if not len(items):
+                continue
+            # later merges of the same entity / hyperedge win
+            all_entities_data = {dp["entity_name"]: dp for it in items for dp in it[0]}
+            all_relationships_data = {
+                tuple(sorted(dp["id_set"])): dp for it in items for dp in it[1]
+            }
+            async with merge_lock:
+                # an insert sharing the lock may have merged them again since
+                for k in all_entities_data:
+                    if await knowledge_hypergraph_inst.has_vertex(k):
+                        all_entities_data[k] = {
+                            **(await knowledge_hypergraph_inst.get_vertex(k)),
+                            "entity_name": k,
+                        }
+                for k in all_relationships_data:
+                    if await knowledge_hypergraph_inst.has_hyperedge(k):
+                        all_relationships_data[k] = {
+                            **(await knowledge_hypergraph_inst.get_hyperedge(k)),
+                            "id_set": k,
+                        }
+                await _upsert_extraction_to_vdb(
+                    list(all_entities_data.values()),
+                    list(all_relationships_data.values()),
+                    entity_vdb,
+                    relationships_vdb,
+                )
+            await text_chunks_db.upsert({k: v for it in items for k, v in it[2].items()})
+
+    tasks = [
+        asyncio.create_task(_feed_chunks()),
+        *[asyncio.create_task(_extract_chunks()) for _ in range(num_workers)],
+        asyncio.create_task(_merge_results()),
+        asyncio.create_task(_upsert_vdb()),
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    if not num_new_chunks:
+        logger.warning("All chunks are already in the storage")
+    elif not merged_any_entities:
+        logger.warning("Didn't extract any entities, maybe your LLM is not working")
+        return None
+    return knowledge_hypergraph_inst
+
+
+async def delete_chunks_from_hypergraph(
+    chunk_ids: list[str],
+    knowledge_hypergraph_inst: BaseHypergraphStorage,
+    entity_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    global_config: dict,
+    chunk_extractions: BaseKVStorage = None,
+) -> BaseHypergraphStorage:
+    """Remove the chunks from the `source_id` of the vertices and hyperedges.
+
+    Hyperedges left without any source are removed, and so are the vertices left without
+    any source and incident hyperedge. The other affected vertices and hyperedges are
+    merged again from the stored extraction of their remaining chunks, summarized again
+    and re-embedded. Only the chunks without a record in `chunk_extractions` (inserted
+    before it existed) are extracted again. The affected vertices and hyperedges are
+    looked up from the stored extraction of the removed chunks.
+    """
+    removed_chunks = set(chunk_ids)
+
+    def _source_ids(data: dict) -> list[str]:
+        return split_string_by_multi_markers(data.get("source_id") or "", [GRAPH_FIELD_SEP])
+
+    # ----------------------------------------------------------------------------
+    # the vertices and hyperedges extracted from the removed chunks, and the vertices of
+    # these hyperedges, which are created with their sources. The whole hypergraph is
+    # only scanned when a removed chunk has no stored extraction.
+    records = (
+        await chunk_extractions.get_by_ids(chunk_ids)
+        if chunk_extractions is not None
+        else [None]
+    )
+    if all(r is not None for r in records):
+        extracted_nodes, extracted_edges = _group_extraction_results(
+            [_load_extraction_result(r["result"]) for r in records]
+        )
+        candidate_edges = list(extracted_edges)
+        candidate_nodes = list(
+            dict.fromkeys([*extracted_nodes, *(v for id_set in extracted_edges for v in id_set)])
+        )
+    else:
+        candidate_edges = list(await knowledge_hypergraph_inst.get_all_hyperedges())
+        candidate_nodes = list(await knowledge_hypergraph_inst.get_all_vertices())
+
+    affected_edges = {}
+    for id_set in candidate_edges:
+        if not await knowledge_hypergraph_inst.has_hyperedge(id_set):
+            continue
+        source_ids = _source_ids(await knowledge_hypergraph_inst.get_hyperedge(id_set))
+        if removed_chunks.intersection(source_ids):
+            affected_edges[id_set] = [s for s in source_ids if s not in removed_chunks]
+    affected_nodes = {}
+    for entity_name in candidate_nodes:
+        if not await knowledge_hypergraph_inst.has_vertex(entity_name):
+            continue
+        source_ids = _source_ids(await knowledge_hypergraph_inst.get_vertex(entity_name))
+        if removed_chunks.intersection(source_ids):
+            affected_nodes[entity_name] = [s for s in source_ids if s not in removed_chunks]
+
+    # hyperedges first, a vertex can only be removed once it has no incident hyperedge
+    removed_edges = [k for k, v in affected_edges.items() if not len(v)]
+    for id_set in removed_edges:
+        await knowledge_hypergraph_inst.remove_hyperedge(id_set)
+        affected_edges.pop(id_set)
+    removed_nodes = []
+    for entity_name, source_ids in affected_nodes.items():
+        if len(source_ids):
+            continue
+        nbr_edges = await knowledge_hypergraph_inst.get_nbr_e_of_vertex(entity_name)
+        if not len(nbr_edges):
+            removed_nodes.append(entity_name)
+            continue
+        # only known through its hyperedges, which then are its sources
+        for id_set in nbr_edges:
+            source_ids.extend(
+                s
+                for s in _source_ids(await knowledge_hypergraph_inst.get_hyperedge(id_set))
+                if s not in removed_chunks and s not in source_ids
+            )
+    for entity_name in removed_nodes:
+        await knowledge_hypergraph_inst.remove_vertex(entity_name)
+        affected_nodes.pop(entity_name)
+    logger.info(
+        f"[Delete Chunks] removed {len(removed_nodes)} entities and {len(removed_edges)} relations, "
+        f"rebuilding {len(affected_nodes)} entities and {len(affected_edges)} relations"
+    )
+    if entity_vdb is not None and len(removed_nodes):
+        await entity_vdb.delete(
+            [compute_mdhash_id(k, prefix="ent-") for k in removed_nodes]
+        )
+    if relationships_vdb is not None and len(removed_edges):
+        await relationships_vdb.delete(
+            [compute_mdhash_id(str(sorted(k)), prefix="rel-") for k in removed_edges]
+        )
+    if not len(affected_nodes) and not len(affected_edges):
+        return knowledge_hypergraph_inst
+
+    # ----------------------------------------------------------------------------
+    remaining_chunks = set()
+    for source_ids in list(affected_nodes.values()) + list(affected_edges.values()):
+        remaining_chunks.update(source_ids)
+    remaining_chunks = sorted(remaining_chunks)
+    records = (
+        await chunk_extractions.get_by_ids(remaining_chunks)
+        if chunk_extractions is not None
+        else [None] * len(remaining_chunks)
+    )
+    results = [_load_extraction_result(r["result"]) for r in records if r is not None]
+    missing_chunks = [k for k, r in zip(remaining_chunks, records) if r is None]
+    if len(missing_chunks):
+        logger.info(f"[Delete Chunks] extracting {len(missing_chunks)} chunks without a stored extraction")
+        chunks = await text_chunks_db.get_by_ids(missing_chunks)
+        context_base = _get_extraction_context()
+        missing_chunks = [(k, dp) for k, dp in zip(missing_chunks, chunks) if dp is not None]
+        extracted = await asyncio.gather(
+            *[
+                _extract_single_chunk(k, dp, global_config, context_base)
+                for k, dp in missing_chunks
+            ]
+        )
+        await _store_chunk_extractions(
+            chunk_extractions, [(k, r) for (k, _), r in zip(missing_chunks, extracted)]
+        )
+        results.extend(extracted)
+    maybe_nodes, maybe_edges = _group_extraction_results(results)
+
+    async def _rebuild(key, source_ids, records, merge_func, get_func):
+        records = [dp for dp in records if dp["source_id"] in source_ids]
+        if len(records):
+            data = await merge_func(
+                key, records, knowledge_hypergraph_inst, global_config, merge_stored=False
+            )
+        else:
+            # not extracted again from the remaining chunks, keep what is stored
+            data = dict(await get_func(key))
+            data.pop("entity_name", None)
+        data["source_id"] = GRAPH_FIELD_SEP.join(source_ids)
+        return data
+
+    entity_names = list(affected_nodes.keys())
+    nodes_data = await asyncio.gather(
+        *[
+            _rebuild(
+                k,
+                affected_nodes[k],
+                maybe_nodes.get(k, []),
+                _merge_nodes_data,
+                knowledge_hypergraph_inst.get_vertex,
+            )
+            for k in entity_names
+        ]
+    )
+    await _summarize_merged_nodes(entity_names, nodes_data, global_config)
+    all_entities_data = await asyncio.gather(
+        *[
+            _upsert_merged_node(k, dp, knowledge_hypergraph_inst)
+            for k, dp in zip(entity_names, nodes_data)
+        ]
+    )
+
+    id_sets = list(affected_edges.keys())
+    edges_data = await asyncio.gather(
+        *[
+            _rebuild(
+                k,
+                affected_edges[k],
+                maybe_edges.get(tuple(sorted(k)), []),
+                _merge_edges_data,
+                knowledge_hypergraph_inst.get_hyperedge,
+            )
+            for k in id_sets
+        ]
+    )
+    await _summarize_merged_edges(id_sets, edges_data, global_config)
+    all_relationships_data = await asyncio.gather(
+        *[
+            _upsert_merged_edge(k, dp, knowledge_hypergraph_inst)
+            for k, dp in zip(id_sets, edges_data)
+        ]
+    )
+
+    await _upsert_extraction_to_vdb(
+        all_entities_data, all_relationships_data, entity_vdb, relationships_vdb
+    )
+    return knowledge_hypergraph_inst
+
+
+async def link_duplicate_chunks(
+    duplicate_chunks: dict[str, str],
+    knowledge_hypergraph_inst: BaseHypergraphStorage,
+    chunk_extractions: BaseKVStorage = None,
+):
+    """Add the near-duplicate chunks (chunk id -> canonical chunk id), which are not
+    extracted, to the `source_id` of the vertices and hyperedges of their canonical chunk.
+    These are looked up from the stored extraction of the canonical chunk, which is kept
+    for the near-duplicates too. The whole hypergraph is only scanned for the canonical
+    chunks without a stored extraction.
+    """
+    duplicates_of = defaultdict(list)
+    for chunk_key, canonical_key in duplicate_chunks.items():
+        duplicates_of[canonical_key].append(chunk_key)
+    canonical_keys = list(duplicates_of.keys())
+    records = (
+        await chunk_extractions.get_by_ids(canonical_keys)
+        if chunk_extractions is not None
+        else [None] * len(canonical_keys)
+    )
+
+    def _linked_source_id(data: dict) -> Union[str, None]:
+        source_ids = split_string_by_multi_markers(data.get("source_id") or "", [GRAPH_FIELD_SEP])
+        linked = [
+            k
+            for s in source_ids
+            for k in duplicates_of.get(s, [])
+            if k not in source_ids
+        ]
+        if not len(linked):
+            return None
+        return GRAPH_FIELD_SEP.join(source_ids + sorted(set(linked)))
+
+    if any(r is None for r in records):
+        entity_names = list(await knowledge_hypergraph_inst.get_all_vertices())
+        id_sets = list(await knowledge_hypergraph_inst.get_all_hyperedges())
+    else:
+        entity_names, id_sets = set(), set()
+        for r in records:
+            entity_names.update(r["result"]["nodes"].keys())
+            for id_set, _ in r["result"]["edges"]:
+                id_sets.add(tuple(sorted(id_set)))
+                # the vertices of a hyperedge may only be known through it
+                entity_names.update(id_set)
+
+    num_linked = 0
+    for entity_name in entity_names:
+        data = await knowledge_hypergraph_inst.get_vertex(entity_name)
+        source_id = _linked_source_id(data) if data is not None else None
+        if source_id is not None:
+            await knowledge_hypergraph_inst.upsert_vertex(entity_name, {"source_id": source_id})
+            num_linked += 1
+    for id_set in id_sets:
+        data = await knowledge_hypergraph_inst.get_hyperedge(id_set)
+        source_id = _linked_source_id(data) if data is not None else None
+        if source_id is not None:
+            await knowledge_hypergraph_inst.upsert_hyperedge(id_set, {"source_id": source_id})
+            num_linked += 1
+    if chunk_extractions is not None:
+        await chunk_extractions.upsert(
+            {
+                chunk_key: {"result": _relabel_extraction_result(r["result"], chunk_key)}
+                for canonical_key, r in zip(canonical_keys, records)
+                if r is not None
+                for chunk_key in duplicates_of[canonical_key]
+            }
+        )
+    logger.info(
+        f"[Chunk Dedup] linked {len(duplicate_chunks)} near-duplicate chunks to {num_linked} entities and relations"
+    )
+
+
+def _drop_duplicate_text_units(text_units: list[dict]) -> list[dict]:
+    """Drop the near-duplicate chunks whose canonical chunk is already in the text units"""
+    ids = set(t["id"] for t in text_units)
+    return [
+        t
+        for t in text_units
+        if (t["data"] or {}).get("canonical_chunk_id") not in ids
+    ]
+
+
 async def _build_entity_query_context(
     query,
     knowledge_hypergraph_inst: BaseHypergraphStorage,
@@ -805,6 +2068,7 @@ async def _find_most_related_text_unit_from_entities(
         for k, v in all_text_units_lookup.items() 
         if v is not None and v.get("data") is not None and "content" in v["data"]
     ]
+    all_text_units = _drop_duplicate_text_units(all_text_units)
 
     if not all_text_units:
         logger.warning("No valid text units found")
@@ -818,6 +2082,7 @@ async def _find_most_related_text_unit_from_entities(
     all_text_units = truncate_list_by_token_size(
         all_text_units,
         key=lambda x: x["data"]["content"],
+        token_key=lambda x: x["data"].get("tokens"),
         max_token_size=query_param.max_token_for_text_unit,
     )
 
@@ -857,6 +2122,7 @@ async def _find_most_related_edges_from_entities(
     all_edges_data = truncate_list_by_token_size(
         all_edges_data,
         key=lambda x: x["description"],
+        token_key=lambda x: x.get("description_tokens"),
         max_token_size=query_param.max_token_for_relation_context,
     )
     return all_edges_data
@@ -896,6 +2162,7 @@ async def _build_relation_query_context(
     edge_datas = truncate_list_by_token_size(
         edge_datas,
         key=lambda x: x["description"],
+        token_key=lambda x: x.get("description_tokens"),
         max_token_size=query_param.max_token_for_relation_context,
     )
 
@@ -1019,6 +2286,7 @@ async def _find_most_related_entities_from_relationships(
     node_datas = truncate_list_by_token_size(
         node_datas,
         key=lambda x: x["description"],
+        token_key=lambda x: x.get("description_tokens"),
         max_token_size=query_param.max_token_for_entity_context,
     )
 
@@ -1051,10 +2319,12 @@ async def _find_related_text_unit_from_relationships(
     all_text_units = [
         {"id": k, **v} for k, v in all_text_units_lookup.items() if v is not None
     ]
+    all_text_units = _drop_duplicate_text_units(all_text_units)
     all_text_units = sorted(all_text_units, key=lambda x: x["order"])
     all_text_units = truncate_list_by_token_size(
         all_text_units,
         key=lambda x: x["data"]["content"],
+        token_key=lambda x: x["data"].get("tokens"),
         max_token_size=query_param.max_token_for_text_unit,
     )
     all_text_units: list[TextChunkSchema] = [t["data"] for t in all_text_units]
@@ -1062,6 +2332,30 @@ async def _find_related_text_unit_from_relationships(
     return all_text_units
 
 
+async def _llm_response_stream(use_model_func, prompt, system_prompt):
+    """Answer tokens of a llm call with stream=True. The llm functions which are not
+    streamable are called without it, and their whole answer is one token.
+    """
+    stream_kwargs = {"stream": True} if is_streamable(use_model_func) else {}
+    # consumed by the caller of aquery_stream, outside of aquery
+    priority_token = call_priority.set(CALL_PRIORITY_QUERY)
+    try:
+        response = await use_model_func(prompt, system_prompt=system_prompt, **stream_kwargs)
+    finally:
+        call_priority.reset(priority_token)
+    if isinstance(response, str):
+        yield response
+        return
+    try:
+        async for content in response:
+            if content:
+                yield content
+    finally:
+        # frees the slot of the llm limiter when the caller stops early
+        if hasattr(response, "aclose"):
+            await response.aclose()
+
+
 async def hyper_query(
     query,
     knowledge_hypergraph_inst: BaseHypergraphStorage,
@@ -1109,21 +2403,25 @@ async def hyper_query(
             ll_keywords: Find information based on low-level keywords.
             hl_keywords: Define topic information based on high-level keywords.
     """
-    if entity_keywords:
-        """
-        low_level_context: Retrieves vertices and their first-order neighbor hyperedges.
-        high_level_context: Retrieves hyperedges and their first-order neighbor vertices.
-        """
-        entity_context = await _build_entity_query_context(
+    async def _no_context():
+        return None
+
+    """
+    low_level_context: Retrieves vertices and their first-order neighbor hyperedges.
+    high_level_context: Retrieves hyperedges and their first-order neighbor vertices.
+    Both are built concurrently, so that their query embeddings go in one request.
+    """
+    entity_context, relation_context = await asyncio.gather(
+        _build_entity_query_context(
             entity_keywords,
             knowledge_hypergraph_inst,
             entities_vdb,
             text_chunks_db,
             query_param,
         )
-
-    if relation_keywords:
-        relation_context = await _build_relation_query_context(
+        if entity_keywords
+        else _no_context(),
+        _build_relation_query_context(
             relation_keywords,
             knowledge_hypergraph_inst,
             entities_vdb,
@@ -1131,6 +2429,9 @@ async def hyper_query(
             text_chunks_db,
             query_param,
         )
+        if relation_keywords
+        else _no_context(),
+    )
     """
         combine the information from the local_query and global_query,
         so that we can have the final retrieval information.
@@ -1160,6 +2461,11 @@ async def hyper_query(
     sys_prompt = sys_prompt_temp.format(
         context_data=context, response_type=query_param.response_type
     )
+    if query_param.stream:
+        contextJson["response"] = _llm_response_stream(
+            use_model_func, query + define_str, sys_prompt
+        )
+        return contextJson
     response = await use_model_func(
         query + define_str,
         system_prompt=sys_prompt,
@@ -1255,6 +2561,11 @@ async def hyper_query_lite(
     sys_prompt = sys_prompt_temp.format(
         context_data=context, response_type=query_param.response_type
     )
+    if query_param.stream:
+        entity_context["response"] = _llm_response_stream(
+            use_model_func, query + define_str, sys_prompt
+        )
+        return entity_context
     response = await use_model_func(
         query + define_str,
         system_prompt=sys_prompt,
@@ -1344,6 +2655,7 @@ async def graph_query(
         edge_datas = truncate_list_by_token_size(
             edge_datas,
             key=lambda x: x["description"],
+            token_key=lambda x: x.get("description_tokens"),
             max_token_size=query_param.max_token_for_relation_context,
         )
         # 相关实体
@@ -1366,6 +2678,7 @@ async def graph_query(
         node_datas = truncate_list_by_token_size(
             node_datas,
             key=lambda x: x["description"],
+            token_key=lambda x: x.get("description_tokens"),
             max_token_size=query_param.max_token_for_entity_context,
         )
         # 相关文本
@@ -1384,10 +2697,12 @@ async def graph_query(
         all_text_units = [
             {"id": k, **v} for k, v in all_text_units_lookup.items() if v is not None and v["data"] is not None
         ]
+        all_text_units = _drop_duplicate_text_units(all_text_units)
         all_text_units = sorted(all_text_units, key=lambda x: x["order"])
         all_text_units = truncate_list_by_token_size(
             all_text_units,
             key=lambda x: x["data"]["content"],
+            token_key=lambda x: x["data"].get("tokens"),
             max_token_size=query_param.max_token_for_text_unit,
         )
         all_text_units = [t["data"] for t in all_text_units]
@@ -1484,6 +2799,11 @@ async def graph_query(
         sys_prompt = sys_prompt_temp.format(
             context_data=context_string, response_type=query_param.response_type
         )
+        if query_param.stream:
+            contextJson["response"] = _llm_response_stream(
+                use_model_func, query + define_str, sys_prompt
+            )
+            return contextJson
         response = await use_model_func(
             query + define_str,
             system_prompt=sys_prompt,
@@ -1598,6 +2918,7 @@ async def naive_query(
     maybe_trun_chunks = truncate_list_by_token_size(
         chunks,
         key=lambda x: x["content"],
+        token_key=lambda x: x.get("tokens"),
         max_token_size=query_param.max_token_for_text_unit,
     )
     logger.info(f"Truncate {len(chunks)} to {len(maybe_trun_chunks)} chunks")
@@ -1608,6 +2929,13 @@ async def naive_query(
     sys_prompt = sys_prompt_temp.format(
         content_data=section, response_type=query_param.response_type
     )
+    if query_param.stream:
+        return {
+            "text_units": [
+                {"id": i, "content": c["content"]} for i, c in enumerate(maybe_trun_chunks)
+            ],
+            "response": _llm_response_stream(use_model_func, query, sys_prompt),
+        }
     response = await use_model_func(
         query,
         system_prompt=sys_prompt,
@@ -1644,6 +2972,8 @@ async def llm_query(
     sys_prompt = sys_prompt_temp.format(
         context_data="", response_type=query_param.response_type
     )
+    if query_param.stream:
+        return {"response": _llm_response_stream(use_model_func, query, sys_prompt)}
     response = await use_model_func(
         query,
         system_prompt=sys_prompt,
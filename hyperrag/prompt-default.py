@@ -291,6 +291,35 @@ Format these keywords separated by ',' as below:
 Output:
 """
 
+PROMPTS[
+    "summarize_batch"
+] = """You are a helpful assistant responsible for generating comprehensive summaries of the data provided below.
+{task}
+Every item below is independent: summarize each item separately, only from the data of that item, within the length given for it.
+#######
+-Data-
+{items}
+#######
+Return only one JSON object which maps the id of every item to its summary, as below:
+{{"1": "<summary of item 1>", "2": "<summary of item 2>", ...}}
+Output:
+"""
+
+PROMPTS[
+    "summarize_batch_item"
+] = """Item {item_id}
+Name: {name}
+Data List: {data_list}
+Length: at most {max_tokens} tokens
+"""
+
+PROMPTS["summarize_batch_tasks"] = {
+    "entity_description": "Each item is one entity and a list of its descriptions. Concatenate the descriptions into a single, comprehensive description, resolve the contradictions if any, and write it in third person.",
+    "entity_additional_properties": "Each item is one entity and a list of its additional properties. Concatenate the additional properties into a single, comprehensive description, resolve the contradictions if any, and write it in third person.",
+    "relation_description": "Each item is a set of entities and a list of descriptions of the relation between them. Summarize the relation between the entities into a single, comprehensive description.",
+    "relation_keywords": "Each item is a set of entities and a list of keywords describing the relations between them. Select the important keywords which summarize the main idea, major concept or theme, and give them separated by ',' in the summary.",
+}
+
 PROMPTS[
     "entity_continue_extraction"
 ] = """MANY entities were missed in the last extraction.  Add them below using the same format:
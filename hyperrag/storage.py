@@ -1,16 +1,32 @@
 import asyncio
 import html
+import json
 import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from hashlib import md5
 from typing import Any, Union, cast, List, Set, Tuple, Optional, Dict
 import numpy as np
 from nano_vectordb import NanoVectorDB
+from nano_vectordb.dbs import load_storage
 from hyperdb import HypergraphDB
-from .utils import load_json, logger, write_json
+from .utils import (
+    EmbeddingFunc,
+    load_json,
+    logger,
+    pack_embedding_batches,
+    single_flight,
+    unpack_embedding_batches,
+    write_json,
+)
 from .base import (
     BaseKVStorage,
     BaseVectorStorage,
-    BaseHypergraphStorage
+    BaseHypergraphStorage,
+    StorageNameSpace,
 )
 
 
@@ -51,10 +67,484 @@ class JsonKVStorage(BaseKVStorage):
         self._data.update(left_data)
         return left_data
 
+    async def delete(self, ids: list[str]):
+        for id in ids:
+            self._data.pop(id, None)
+
     async def drop(self):
         self._data = {}
 
 
+@dataclass
+class JsonlKVStorage(BaseKVStorage):
+    """Append-only KV storage, every upsert / delete is written to disk immediately,
+    from a thread. The file is compacted in index_done_callback.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.jsonl")
+        self._data = {}
+        self._num_lines = 0
+        if os.path.exists(self._file_name):
+            with open(self._file_name, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line may be cut off by a crash
+                        continue
+                    self._num_lines += 1
+                    if record.get("deleted"):
+                        self._data.pop(record["key"], None)
+                    else:
+                        self._data[record["key"]] = record["value"]
+        # keeps the appends and the compaction of the file in order
+        self._write_lock = asyncio.Lock()
+        logger.info(f"Load KV {self.namespace} with {len(self._data)} data")
+
+    def _write_records(self, records: list[dict]):
+        with open(self._file_name, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def _append(self, records: list[dict]):
+        if not len(records):
+            return
+        async with self._write_lock:
+            # the fsync does not block the event loop
+            await asyncio.to_thread(self._write_records, records)
+            self._num_lines += len(records)
+
+    def _compact(self, data: dict):
+        tmp_file_name = self._file_name + ".tmp"
+        with open(tmp_file_name, "w", encoding="utf-8") as f:
+            for k, v in data.items():
+                f.write(json.dumps({"key": k, "value": v}, ensure_ascii=False) + "\n")
+        os.replace(tmp_file_name, self._file_name)
+
+    async def all_keys(self) -> list[str]:
+        return list(self._data.keys())
+
+    async def index_done_callback(self):
+        async with self._write_lock:
+            if self._num_lines == len(self._data):
+                return
+            data = dict(self._data)
+            await asyncio.to_thread(self._compact, data)
+            self._num_lines = len(data)
+
+    async def get_by_id(self, id):
+        return self._data.get(id, None)
+
+    async def get_by_ids(self, ids, fields=None):
+        if fields is None:
+            return [self._data.get(id, None) for id in ids]
+        return [
+            (
+                {k: v for k, v in self._data[id].items() if k in fields}
+                if self._data.get(id, None)
+                else None
+            )
+            for id in ids
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return set([s for s in data if s not in self._data])
+
+    async def upsert(self, data: dict[str, dict]):
+        left_data = {k: v for k, v in data.items() if k not in self._data}
+        self._data.update(left_data)
+        await self._append([{"key": k, "value": v} for k, v in left_data.items()])
+        return left_data
+
+    async def delete(self, ids: list[str]):
+        ids = [id for id in ids if id in self._data]
+        for id in ids:
+            self._data.pop(id)
+        await self._append([{"key": id, "deleted": True} for id in ids])
+
+    async def drop(self):
+        async with self._write_lock:
+            self._data = {}
+            open(self._file_name, "w").close()
+            self._num_lines = 0
+
+
+@dataclass
+class SqliteCacheKVStorage(BaseKVStorage):
+    """KV storage of cached llm responses in SQLite, so that lookups do not load the cache
+    into memory and writes do not rewrite it. Entries are grouped by the "model" field of
+    their value, expire after llm_cache_ttl seconds and are evicted least recently used
+    first beyond llm_cache_max_entries / llm_cache_max_bytes (0 for no limit).
+
+    The cache of JsonKVStorage (kv_store_<namespace>.json) of an existing working
+    directory is imported when the SQLite file is created. The access times of the
+    lookups are kept in memory and written with the next upsert or callback. The SQLite
+    calls run in one thread of their own, off the event loop.
+    """
+
+    # pending access times written at most this many at a time
+    _max_pending_accesses = 1000
+    # keys per "IN (...)" query, below the variable limit of SQLite
+    _max_query_keys = 500
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.sqlite")
+        self._max_entries = self.global_config.get("llm_cache_max_entries", 0)
+        self._max_bytes = self.global_config.get("llm_cache_max_bytes", 0)
+        self._ttl = self.global_config.get("llm_cache_ttl", 0)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite_cache")
+        created = not os.path.exists(self._file_name)
+        self._conn = sqlite3.connect(self._file_name, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, model TEXT, value TEXT, "
+            "size INTEGER, created REAL, accessed REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_accessed ON kv (accessed)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_model ON kv (model)")
+        self._conn.commit()
+        self._accessed: dict[str, float] = {}
+        self._recount()
+        if created:
+            self._import_json_storage()
+        logger.info(f"Load KV {self.namespace} with {self._num_entries} data")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _recount(self):
+        self._num_entries, self._num_bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM kv"
+        ).fetchone()
+
+    def _import_json_storage(self):
+        # the cache of JsonKVStorage in existing working directories
+        json_file_name = os.path.join(
+            self.global_config["working_dir"], f"kv_store_{self.namespace}.json"
+        )
+        data = load_json(json_file_name) if os.path.exists(json_file_name) else None
+        if data:
+            self._insert(data)
+            self._evict()
+            self._conn.commit()
+            logger.info(f"Imported {len(data)} data of {json_file_name}")
+
+    def _expired(self, created: float) -> bool:
+        return bool(self._ttl) and created + self._ttl < time.time()
+
+    def _select(self, columns: str, keys: list[str]) -> list[tuple]:
+        rows = []
+        for start in range(0, len(keys), self._max_query_keys):
+            part = keys[start : start + self._max_query_keys]
+            rows += self._conn.execute(
+                f"SELECT key, {columns} FROM kv WHERE key IN ({', '.join('?' * len(part))})",
+                part,
+            ).fetchall()
+        return rows
+
+    def _insert(self, data: dict[str, dict]):
+        now = time.time()
+        rows = []
+        for k, v in data.items():
+            value = json.dumps(v, ensure_ascii=False)
+            model = v.get("model", "") if isinstance(v, dict) else ""
+            rows.append((k, model, value, len(value), now, now))
+        cursor = self._conn.executemany(
+            "INSERT OR IGNORE INTO kv VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        if cursor.rowcount == len(rows):
+            self._num_entries += len(rows)
+            self._num_bytes += sum(row[3] for row in rows)
+        else:
+            self._recount()
+
+    def _flush_accessed(self):
+        if not self._accessed:
+            return
+        self._conn.executemany(
+            "UPDATE kv SET accessed = ? WHERE key = ?",
+            [(t, k) for k, t in self._accessed.items()],
+        )
+        self._accessed = {}
+
+    def _delete_rows(self, where: str, params: tuple) -> int:
+        # keeps the counters up to date without scanning the table
+        num_entries, num_bytes = self._conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM kv WHERE {where}", params
+        ).fetchone()
+        if num_entries:
+            self._conn.execute(f"DELETE FROM kv WHERE {where}", params)
+            self._num_entries -= num_entries
+            self._num_bytes -= num_bytes
+        return num_entries
+
+    def _delete_keys(self, keys: list[str]):
+        for key in keys:
+            self._accessed.pop(key, None)
+        for start in range(0, len(keys), self._max_query_keys):
+            part = tuple(keys[start : start + self._max_query_keys])
+            self._delete_rows(f"key IN ({', '.join('?' * len(part))})", part)
+
+    def _evict(self):
+        self._flush_accessed()
+        num_entries = self._num_entries - self._max_entries if self._max_entries else 0
+        num_bytes = self._num_bytes - self._max_bytes if self._max_bytes else 0
+        if num_entries <= 0 and num_bytes <= 0:
+            return
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM kv ORDER BY accessed"):
+            if num_entries <= 0 and num_bytes <= 0:
+                break
+            evicted.append((key,))
+            num_entries -= 1
+            num_bytes -= size
+            self._num_entries -= 1
+            self._num_bytes -= size
+        self._conn.executemany("DELETE FROM kv WHERE key = ?", evicted)
+        logger.debug(f"Evicted {len(evicted)} data of KV {self.namespace}")
+
+    def _purge_expired(self):
+        if not self._ttl:
+            return
+        self._delete_rows("created < ?", (time.time() - self._ttl,))
+
+    def _commit(self, purge: bool = False):
+        self._flush_accessed()
+        if purge:
+            self._purge_expired()
+        self._conn.commit()
+
+    def _get_by_ids(self, ids: list[str]) -> list[Union[dict, None]]:
+        found, expired = {}, []
+        now = time.time()
+        for key, value, created in self._select("value, created", list(dict.fromkeys(ids))):
+            if self._expired(created):
+                expired.append(key)
+                continue
+            found[key] = value
+            self._accessed[key] = now
+        if len(expired):
+            self._delete_keys(expired)
+        if len(expired) or len(self._accessed) >= self._max_pending_accesses:
+            self._commit()
+        return [None if id not in found else json.loads(found[id]) for id in ids]
+
+    def _filter_keys(self, keys: list[str]) -> set[str]:
+        return set(keys) - {row[0] for row in self._select("1", keys)}
+
+    def _upsert(self, data: dict[str, dict]) -> dict[str, dict]:
+        left_data = {k: data[k] for k in self._filter_keys(list(data.keys()))}
+        self._insert(left_data)
+        self._evict()
+        self._conn.commit()
+        return left_data
+
+    def _all_keys(self) -> list[str]:
+        return [row[0] for row in self._conn.execute("SELECT key FROM kv")]
+
+    def _delete_model(self, model: str):
+        self._flush_accessed()
+        self._delete_rows("model = ?", (model,))
+        self._conn.commit()
+
+    def _model_stats(self) -> dict[str, dict]:
+        return {
+            model: {"entries": entries, "bytes": size}
+            for model, entries, size in self._conn.execute(
+                "SELECT model, COUNT(*), SUM(size) FROM kv GROUP BY model"
+            )
+        }
+
+    def _drop(self):
+        self._conn.execute("DELETE FROM kv")
+        self._conn.commit()
+        self._accessed = {}
+        self._num_entries, self._num_bytes = 0, 0
+
+    async def all_keys(self) -> list[str]:
+        return await self._run(self._all_keys)
+
+    async def index_done_callback(self):
+        await self._run(self._commit, True)
+
+    async def query_done_callback(self):
+        await self._run(self._commit)
+
+    async def get_by_id(self, id):
+        return (await self._run(self._get_by_ids, [id]))[0]
+
+    async def get_by_ids(self, ids, fields=None):
+        results = await self._run(self._get_by_ids, list(ids))
+        if fields is None:
+            return results
+        return [
+            None if value is None else {k: v for k, v in value.items() if k in fields}
+            for value in results
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return await self._run(self._filter_keys, list(data))
+
+    async def upsert(self, data: dict[str, dict]):
+        return await self._run(self._upsert, data)
+
+    async def delete(self, ids: list[str]):
+        await self._run(self._delete_keys, list(ids))
+
+    async def delete_model(self, model: str):
+        """Drop the cached responses of one model"""
+        await self._run(self._delete_model, model)
+
+    async def model_stats(self) -> dict[str, dict]:
+        """Number of entries and bytes per model"""
+        return await self._run(self._model_stats)
+
+    async def drop(self):
+        await self._run(self._drop)
+
+
+@dataclass
+class MemmapEmbeddingCache(StorageNameSpace):
+    """Content-addressed cache of embeddings, shared by all the vector dbs. The vectors are
+    kept in a memory-mapped float32 file, one slot per (model, dimension, text) key, and the
+    md5 digest of the key of every slot in a second memory-mapped file, which is the index.
+    Beyond embedding_cache_max_entries the least recently used slots are reused.
+    """
+
+    embedding_dim: int = 0
+    model_name: str = ""
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        prefix = os.path.join(working_dir, f"{self.namespace}_{self.embedding_dim}d")
+        self._vectors_file_name = prefix + ".f32"
+        self._keys_file_name = prefix + ".keys"
+        self._order_file_name = prefix + ".json"
+        self._max_entries = self.global_config.get("embedding_cache_max_entries", 0)
+        self._capacity = 0
+        self._vectors = self._keys = None
+        # key digest -> slot, least recently used first
+        self._slots: OrderedDict[bytes, int] = OrderedDict()
+        self._free_slots: list[int] = []
+        self.hits = self.misses = 0
+        if os.path.exists(self._keys_file_name):
+            self._load()
+        logger.info(f"Load embedding cache {prefix} with {len(self._slots)} vectors")
+
+    def _map(self, capacity: int):
+        for file_name, width, dtype in [
+            (self._vectors_file_name, self.embedding_dim, np.float32),
+            (self._keys_file_name, 16, np.uint8),
+        ]:
+            with open(file_name, "ab") as f:
+                f.truncate(capacity * width * np.dtype(dtype).itemsize)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._keys.flush()
+        self._vectors = np.memmap(
+            self._vectors_file_name, dtype=np.float32, mode="r+", shape=(capacity, self.embedding_dim)
+        )
+        self._keys = np.memmap(self._keys_file_name, dtype=np.uint8, mode="r+", shape=(capacity, 16))
+        self._free_slots += range(capacity - 1, self._capacity - 1, -1)
+        self._capacity = capacity
+
+    def _load(self):
+        capacity = os.path.getsize(self._keys_file_name) // 16
+        self._map(capacity)
+        used = set(np.flatnonzero(self._keys.any(axis=1)).tolist())
+        # the recency order is only a hint, the slots holding a key are in the index
+        order = [slot for slot in load_json(self._order_file_name) or [] if slot in used]
+        for slot in sorted(used - set(order)) + order:
+            self._slots[self._keys[slot].tobytes()] = slot
+        self._free_slots = sorted(set(range(capacity)) - used, reverse=True)
+
+    def key(self, text: str) -> bytes:
+        return md5(f"{self.model_name}|{self.embedding_dim}|{text}".encode()).digest()
+
+    def get(self, key: bytes) -> Union[np.ndarray, None]:
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        self._slots.move_to_end(key)
+        return np.array(self._vectors[slot])
+
+    def _slot_for(self, key: bytes) -> tuple[int, bool]:
+        """A slot for the key, and whether it held another key"""
+        if key in self._slots:
+            return self._slots.pop(key), True
+        if self._free_slots:
+            return self._free_slots.pop(), False
+        if self._max_entries and self._capacity >= self._max_entries:
+            return self._slots.popitem(last=False)[1], True
+        capacity = max(1024, self._capacity * 2)
+        self._map(min(capacity, self._max_entries) if self._max_entries else capacity)
+        return self._free_slots.pop(), False
+
+    def put(self, vectors: dict[bytes, np.ndarray]):
+        """Store {key: vector}. The vectors are flushed before their keys are written, the
+        keys file never indexes a vector which is not on disk.
+        """
+        slots, reused = {}, False
+        for key in vectors:
+            slot, was_used = self._slot_for(key)
+            if was_used:
+                # unindex the slot on disk before its vector is replaced
+                self._keys[slot] = 0
+                reused = True
+            self._slots[key] = slots[key] = slot
+        if not len(slots):
+            return
+        if reused:
+            self._keys.flush()
+        for key, slot in slots.items():
+            self._vectors[slot] = vectors[key]
+        self._vectors.flush()
+        for key, slot in slots.items():
+            # a key of this batch may have been evicted by a later one
+            if self._slots.get(key) == slot:
+                self._keys[slot] = np.frombuffer(key, dtype=np.uint8)
+
+    def wrap(self, embedding_func: EmbeddingFunc) -> EmbeddingFunc:
+        """An EmbeddingFunc which serves the cached texts, and embeds the missing ones
+        with one call of `embedding_func`.
+        """
+
+        async def cached_embedding(texts: list[str], **kwargs) -> np.ndarray:
+            keys = [self.key(text) for text in texts]
+            vectors = [self.get(key) for key in keys]
+            missing = {}
+            for key, text, vector in zip(keys, texts, vectors):
+                if vector is None:
+                    missing.setdefault(key, text)
+            self.hits += len(texts) - sum(v is None for v in vectors)
+            self.misses += len(missing)
+            if missing:
+                new_vectors = await embedding_func(list(missing.values()), **kwargs)
+                new_vectors = dict(zip(missing.keys(), np.asarray(new_vectors, dtype=np.float32)))
+                self.put(new_vectors)
+                vectors = [new_vectors[k] if v is None else v for k, v in zip(keys, vectors)]
+            return np.array(vectors, dtype=np.float32)
+
+        return EmbeddingFunc(
+            embedding_dim=embedding_func.embedding_dim,
+            max_token_size=embedding_func.max_token_size,
+            func=cached_embedding,
+        )
+
+    async def index_done_callback(self):
+        if self._vectors is None:
+            return
+        self._vectors.flush()
+        self._keys.flush()
+        write_json(list(self._slots.values()), self._order_file_name)
+
+
 @dataclass
 class NanoVectorDBStorage(BaseVectorStorage):
     cosine_better_than_threshold: float = 0.2
@@ -63,10 +553,16 @@ class NanoVectorDBStorage(BaseVectorStorage):
         self._client_file_name = os.path.join(
             self.global_config["working_dir"], f"vdb_{self.namespace}.json"
         )
-        self._max_batch_size = self.global_config["embedding_batch_num"]
+        self._init_embedding()
         self._client = NanoVectorDB(
             self.embedding_func.embedding_dim, storage_file=self._client_file_name
         )
+
+    def _init_embedding(self):
+        self._max_batch_size = self.global_config["embedding_batch_num"]
+        self._max_batch_tokens = self.global_config.get("embedding_batch_max_tokens", 0)
+        # fill statistics of the embedding requests of the upserts
+        self.batch_stats = dict(items=0, batches=0, tokens=0, truncated=0, split=0)
         self.cosine_better_than_threshold = self.global_config.get(
             "cosine_better_than_threshold", self.cosine_better_than_threshold
         )
@@ -83,23 +579,49 @@ class NanoVectorDBStorage(BaseVectorStorage):
             }
             for k, v in data.items()
         ]
-        contents = [v["content"] for v in data.values()]
-        batches = [
-            contents[i : i + self._max_batch_size]
-            for i in range(0, len(contents), self._max_batch_size)
-        ]
-        embeddings_list = await asyncio.gather(
-            *[self.embedding_func(batch) for batch in batches]
-        )
-        embeddings = np.concatenate(embeddings_list)
+        embeddings = await self._embed_contents([v["content"] for v in data.values()])
         for i, d in enumerate(list_data):
             d["__vector__"] = embeddings[i]
         results = self._client.upsert(datas=list_data)
         return results
 
+    async def _embed_contents(self, contents: list[str]) -> np.ndarray:
+        batches, owners, stats = pack_embedding_batches(
+            contents,
+            max_batch_tokens=self._max_batch_tokens,
+            max_batch_size=self._max_batch_size,
+            max_token_size=self.embedding_func.max_token_size,
+            over_length=self.global_config.get("embedding_over_length", "truncate"),
+            model_name=self.global_config.get("tiktoken_model_name", "gpt-4o"),
+        )
+        for k in self.batch_stats:
+            self.batch_stats[k] += stats[k]
+        if stats["truncated"] or stats["split"]:
+            logger.warning(
+                f"{stats['truncated']} truncated and {stats['split']} split contents "
+                f"beyond {self.embedding_func.max_token_size} tokens in {self.namespace}"
+            )
+        logger.debug(
+            f"Embedding {stats['items']} contents of {self.namespace} in {stats['batches']} "
+            f"batches, {stats['tokens']} tokens, fill {stats['fill']}"
+        )
+        embeddings_list = await asyncio.gather(
+            *[self.embedding_func(batch) for batch in batches]
+        )
+        return unpack_embedding_batches(len(contents), owners, embeddings_list)
+
+    async def _embed_query(self, query: str) -> np.ndarray:
+        # concurrent queries of the same text share one embedding call
+        embedding_func = self.query_embedding_func or self.embedding_func
+        embedding = await single_flight(
+            ("query_embedding", id(embedding_func), query),
+            embedding_func,
+            [query],
+        )
+        return embedding[0]
+
     async def query(self, query: str, top_k=5):
-        embedding = await self.embedding_func([query])
-        embedding = embedding[0]
+        embedding = await self._embed_query(query)
         results = self._client.query(
             query=embedding,
             top_k=top_k,
@@ -110,10 +632,311 @@ class NanoVectorDBStorage(BaseVectorStorage):
         ]
         return results
 
+    async def delete(self, ids: list[str]):
+        logger.info(f"Deleting {len(ids)} vectors from {self.namespace}")
+        self._client.delete(ids)
+
+    async def get_by_ids(self, ids: list[str]) -> list[Union[dict, None]]:
+        found = {dp["__id__"]: dp for dp in self._client.get(set(ids))}
+        return [found.get(i) for i in ids]
+
     async def index_done_callback(self):
         self._client.save()
 
 
+# rows of the quantized matrix converted to float32 at a time when scoring, about 16 MB
+_SCORE_CHUNK_BYTES = 1 << 24
+
+
+@dataclass
+class QuantizedVectorDBStorage(NanoVectorDBStorage):
+    """Vector storage which holds the normalized vectors in memory at reduced precision:
+    float16, or int8 quantized per dimension as offset + scale * (code + 128), with the
+    scale and offset stored. The full precision vectors stay on disk in a memory-mapped
+    float32 file, which the ranges are refit from and the top candidates of the quantized
+    search are re-scored with.
+
+    Options, in `vector_db_storage_cls_kwargs`: "precision" ("int8" or "float16") and
+    "rescore_factor", the rescore_factor * top_k best quantized candidates are re-scored
+    exactly, 0 to rank by the quantized scores only.
+    """
+
+    def __post_init__(self):
+        options = self.global_config.get("vector_db_storage_cls_kwargs") or {}
+        self._precision = options.get("precision", "int8")
+        if self._precision not in ("int8", "float16"):
+            raise ValueError(f"Unknown precision {self._precision}, use int8 or float16")
+        self._code_dtype = np.int8 if self._precision == "int8" else np.float16
+        self._rescore_factor = options.get("rescore_factor", 4)
+        self._dim = self.embedding_func.embedding_dim
+        prefix = os.path.join(self.global_config["working_dir"], f"vdb_{self.namespace}")
+        self._meta_file_name = prefix + ".quant.json"
+        self._codes_file_name = prefix + f".{self._precision}.npy"
+        self._exact_file_name = prefix + ".f32"
+        self._init_embedding()
+
+        self._capacity = 0
+        self._exact = None
+        self._codes = np.zeros((0, self._dim), dtype=self._code_dtype)
+        self._used = np.zeros(0, dtype=bool)
+        # data of every slot (None if free), and the slot of every id
+        self._datas: list[Union[dict, None]] = []
+        self._slots: dict[str, int] = {}
+        self._free_slots: list[int] = []
+        self._offset = np.zeros(self._dim, dtype=np.float32)
+        self._scale = np.zeros(self._dim, dtype=np.float32)
+        if os.path.exists(self._meta_file_name):
+            self._load()
+        else:
+            self._import_nano_vectordb()
+        logger.info(
+            f"Load {self._precision} vdb {self.namespace} with {len(self._slots)} vectors"
+        )
+
+    def _resize(self, capacity: int):
+        with open(self._exact_file_name, "ab") as f:
+            f.truncate(capacity * self._dim * 4)
+        if self._exact is not None:
+            self._exact.flush()
+        self._exact = (
+            np.memmap(self._exact_file_name, dtype=np.float32, mode="r+", shape=(capacity, self._dim))
+            if capacity
+            else np.zeros((0, self._dim), dtype=np.float32)
+        )
+        codes = np.zeros((capacity, self._dim), dtype=self._code_dtype)
+        codes[: len(self._codes)] = self._codes[:capacity]
+        self._codes = codes
+        self._used = np.concatenate([self._used, np.zeros(capacity - self._capacity, dtype=bool)])
+        self._datas += [None] * (capacity - self._capacity)
+        self._free_slots += range(capacity - 1, self._capacity - 1, -1)
+        self._capacity = capacity
+
+    def _load(self):
+        meta = load_json(self._meta_file_name)
+        assert (
+            meta["embedding_dim"] == self._dim
+        ), f"Embedding dim mismatch, expected: {self._dim}, but loaded: {meta['embedding_dim']}"
+        self._resize(len(meta["data"]))
+        self._datas = meta["data"]
+        self._offset = np.array(meta["offset"], dtype=np.float32)
+        self._scale = np.array(meta["scale"], dtype=np.float32)
+        self._slots = {dp["__id__"]: i for i, dp in enumerate(self._datas) if dp is not None}
+        self._used[list(self._slots.values())] = True
+        self._free_slots = [i for i in range(self._capacity - 1, -1, -1) if not self._used[i]]
+        codes = np.load(self._codes_file_name) if os.path.exists(self._codes_file_name) else None
+        if codes is not None and codes.shape == self._codes.shape:
+            self._codes = codes
+        else:
+            # e.g. switched from the other precision
+            self._requantize()
+
+    def _import_nano_vectordb(self):
+        # the vdb of NanoVectorDBStorage in existing working directories
+        storage = load_storage(
+            os.path.join(self.global_config["working_dir"], f"vdb_{self.namespace}.json")
+        )
+        if storage is None or not len(storage["data"]):
+            return
+        self._upsert_vectors(
+            {dp["__id__"]: dp for dp in storage["data"]}, storage["matrix"]
+        )
+        logger.info(f"Imported {len(storage['data'])} vectors of vdb_{self.namespace}.json")
+
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self._precision == "float16":
+            return vectors.astype(np.float16)
+        scale = np.where(self._scale > 0, self._scale, 1.0)
+        codes = np.rint((vectors - self._offset) / scale) - 128
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def _requantize(self):
+        rows = max(1, _SCORE_CHUNK_BYTES // (self._dim * 4))
+        for start in range(0, self._capacity, rows):
+            self._codes[start : start + rows] = self._quantize(
+                np.asarray(self._exact[start : start + rows])
+            )
+
+    def _fit_range(self, vectors: np.ndarray):
+        """Widen the per dimension range of the int8 codes to the new vectors, by a margin
+        of a quarter of the range so that refits, which quantize all vectors again, are rare.
+        """
+        if self._precision != "int8":
+            return
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        if len(self._slots):
+            old_low, old_high = self._offset, self._offset + 255 * self._scale
+            if np.all(low >= old_low) and np.all(high <= old_high):
+                return
+            low, high = np.minimum(low, old_low), np.maximum(high, old_high)
+        margin = (high - low) / 4
+        # the components of normalized vectors are in [-1, 1]
+        low, high = np.maximum(low - margin, -1.0), np.minimum(high + margin, 1.0)
+        self._offset = low.astype(np.float32)
+        self._scale = ((high - low) / 255).astype(np.float32)
+        if len(self._slots):
+            logger.info(f"Refit the int8 ranges of {self.namespace}")
+            self._requantize()
+
+    def _upsert_vectors(self, datas: dict[str, dict], vectors: np.ndarray) -> dict:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+        self._fit_range(vectors)
+        report_return = {"update": [], "insert": []}
+        slots = []
+        for k in datas:
+            if k in self._slots:
+                report_return["update"].append(k)
+            else:
+                if not self._free_slots:
+                    # a small growth factor, the spare slots take memory too
+                    self._resize(max(1024, self._capacity + self._capacity // 4))
+                self._slots[k] = self._free_slots.pop()
+                report_return["insert"].append(k)
+            slots.append(self._slots[k])
+        self._exact[slots] = vectors
+        self._codes[slots] = self._quantize(vectors)
+        self._used[slots] = True
+        for slot, (k, dp) in zip(slots, datas.items()):
+            self._datas[slot] = {**dp, "__id__": k}
+        return report_return
+
+    async def upsert(self, data: dict[str, dict]):
+        logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
+        if not len(data):
+            logger.warning("You insert an empty data to vector DB")
+            return []
+        datas = {
+            k: {k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields}
+            for k, v in data.items()
+        }
+        embeddings = await self._embed_contents([v["content"] for v in data.values()])
+        return self._upsert_vectors(datas, embeddings)
+
+    def _scores(self, query: np.ndarray, exact: bool = False) -> np.ndarray:
+        """Cosine scores of the normalized query with all the slots, -inf for the free ones"""
+        matrix = self._exact if exact else self._codes
+        if self._precision == "int8" and not exact:
+            # offset + scale * (code + 128), with the scale folded into the query
+            scaled_query = query * self._scale
+            base = query @ self._offset + 128 * scaled_query.sum()
+        else:
+            scaled_query, base = query, 0.0
+        rows = max(1, _SCORE_CHUNK_BYTES // (self._dim * 4))
+        scores = np.concatenate(
+            [
+                np.asarray(matrix[start : start + rows], dtype=np.float32) @ scaled_query
+                for start in range(0, self._capacity, rows)
+            ]
+            or [np.zeros(0, dtype=np.float32)]
+        ) + base
+        scores[~self._used] = -np.inf
+        return scores
+
+    def _search(
+        self, query: np.ndarray, top_k: int, rescore_factor: int, better_than_threshold: float = None
+    ) -> list[dict]:
+        query = np.asarray(query, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        top_k = min(top_k, len(self._slots))
+        if top_k <= 0:
+            return []
+        scores = self._scores(query)
+        num_candidates = min(len(self._slots), top_k * max(rescore_factor, 1))
+        candidates = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+        if rescore_factor:
+            candidates = np.sort(candidates)
+            candidate_scores = np.asarray(self._exact[candidates]) @ query
+        else:
+            candidate_scores = scores[candidates]
+        order = np.argsort(-candidate_scores)[:top_k]
+        results = []
+        for slot, score in zip(candidates[order], candidate_scores[order]):
+            if better_than_threshold is not None and score < better_than_threshold:
+                break
+            results.append({**self._datas[slot], "__metrics__": float(score)})
+        return results
+
+    async def query(self, query: str, top_k=5):
+        embedding = await self._embed_query(query)
+        results = self._search(
+            embedding, top_k, self._rescore_factor, self.cosine_better_than_threshold
+        )
+        return [{**dp, "id": dp["__id__"], "distance": dp["__metrics__"]} for dp in results]
+
+    async def delete(self, ids: list[str]):
+        logger.info(f"Deleting {len(ids)} vectors from {self.namespace}")
+        for id in ids:
+            slot = self._slots.pop(id, None)
+            if slot is not None:
+                self._used[slot] = False
+                self._datas[slot] = None
+                self._free_slots.append(slot)
+
+    async def get_by_ids(self, ids: list[str]) -> list[Union[dict, None]]:
+        return [
+            None if self._slots.get(id) is None else self._datas[self._slots[id]]
+            for id in ids
+        ]
+
+    async def index_done_callback(self):
+        if self._capacity:
+            self._exact.flush()
+        np.save(self._codes_file_name, self._codes)
+        write_json(
+            {
+                "embedding_dim": self._dim,
+                "precision": self._precision,
+                "offset": self._offset.tolist(),
+                "scale": self._scale.tolist(),
+                "data": self._datas,
+            },
+            self._meta_file_name,
+        )
+
+    def recall_report(
+        self, top_k: int = 10, num_queries: int = 100, queries: np.ndarray = None, seed: int = 0
+    ) -> dict:
+        """Recall@top_k of the quantized search, without and with re-scoring, against the
+        exact search over the float32 vectors, and the memory of the quantized matrix.
+        The queries default to `num_queries` stored vectors, with gaussian noise so that
+        they are not their own first neighbour.
+        """
+        rng = np.random.default_rng(seed)
+        if queries is None:
+            used_slots = np.flatnonzero(self._used)
+            if not len(used_slots):
+                return {}
+            picked = rng.choice(used_slots, min(num_queries, len(used_slots)), replace=False)
+            queries = np.asarray(self._exact[np.sort(picked)])
+            queries = queries + rng.normal(scale=1 / np.sqrt(self._dim), size=queries.shape)
+        recalls = {"quantized": [], "rescored": []}
+        for query in np.asarray(queries, dtype=np.float32):
+            query = query / np.linalg.norm(query)
+            k = min(top_k, len(self._slots))
+            exact_scores = self._scores(query, exact=True)
+            exact_ids = set(np.argpartition(-exact_scores, k - 1)[:k].tolist())
+            for name, rescore_factor in [
+                ("quantized", 0),
+                ("rescored", max(self._rescore_factor, 1)),
+            ]:
+                found = {self._slots[dp["__id__"]] for dp in self._search(query, k, rescore_factor)}
+                recalls[name].append(len(found & exact_ids) / k)
+        num_vectors = len(self._slots)
+        report = {
+            "precision": self._precision,
+            "vectors": num_vectors,
+            "queries": len(recalls["quantized"]),
+            "top_k": top_k,
+            f"recall@{top_k}": float(np.mean(recalls["quantized"])),
+            f"recall@{top_k}_rescored": float(np.mean(recalls["rescored"])),
+            "rescore_factor": max(self._rescore_factor, 1),
+            "memory_bytes": self._codes.nbytes,
+            "float32_memory_bytes": num_vectors * self._dim * 4,
+        }
+        logger.info(f"Recall report of {self.namespace}: {report}")
+        return report
+
+
 @dataclass
 class HypergraphStorage(BaseHypergraphStorage):
 
@@ -1,11 +1,17 @@
 import asyncio
+import heapq
 import html
+import inspect
+import itertools
 import io
 import csv
 import json
 import logging
 import os
 import re
+import time
+from collections import defaultdict
+from contextvars import ContextVar
 from dataclasses import dataclass
 from functools import wraps
 from hashlib import md5
@@ -73,28 +79,610 @@ def compute_mdhash_id(content, prefix: str = ""):
     return prefix + md5(content.encode()).hexdigest()
 
 
-def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
-    """Add restriction of maximum async calling times for a async func"""
+def compute_mdhash_id_by_stream(stream, prefix: str = "", read_size: int = 65536):
+    """Same as compute_mdhash_id(content.strip()), but reads the content from a text stream"""
+    hasher = md5()
+    started = False
+    pending_whitespace = ""
+    while True:
+        block = stream.read(read_size)
+        if not block:
+            break
+        if not started:
+            block = block.lstrip()
+            if not block:
+                continue
+            started = True
+        stripped = block.rstrip()
+        if stripped:
+            hasher.update((pending_whitespace + stripped).encode())
+            pending_whitespace = block[len(stripped):]
+        else:
+            pending_whitespace += block
+    return prefix + hasher.hexdigest()
+
+
+# priority classes of the limited calls, lower values are served first
+CALL_PRIORITY_QUERY = 0
+CALL_PRIORITY_INSERT = 10
+# the priority of the limited calls made by the current task, set by HyperRAG.aquery
+call_priority: ContextVar[int] = ContextVar("call_priority", default=CALL_PRIORITY_INSERT)
+
+
+class _ReleasingAsyncIterator:
+    """Iterate `iterator` and call `release` once it is exhausted, fails, is closed or
+    is garbage collected
+    """
+
+    def __init__(self, iterator, release: callable):
+        self._iterator = iterator.__aiter__()
+        self._release = release
+
+    def _done(self):
+        if self._release is not None:
+            release, self._release = self._release, None
+            release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            self._done()
+            raise
+
+    async def aclose(self):
+        self._done()
+        if hasattr(self._iterator, "aclose"):
+            await self._iterator.aclose()
+
+    def __del__(self):
+        self._done()
+
+
+def streamable(func):
+    """Mark a llm function which returns an async iterator of the answer tokens when it
+    is called with stream=True
+    """
+    func.streamable = True
+    return func
+
+
+def is_streamable(func) -> bool:
+    """Whether the llm function (through functools.partial and the decorators setting
+    __wrapped__) is marked with streamable or takes a `stream` argument
+    """
+    while func is not None:
+        if getattr(func, "streamable", False):
+            return True
+        try:
+            if "stream" in inspect.signature(func).parameters:
+                return True
+        except (TypeError, ValueError):
+            pass
+        func = getattr(func, "func", None) or getattr(func, "__wrapped__", None)
+    return False
+
+
+def limit_async_func_call(max_size: int, rate_limiter: "RateLimiter" = None):
+    """Add restriction of maximum async calling times for a async func.
+    Waiting calls are woken in order of `call_priority`, then arrival, when a slot frees.
+    With a `rate_limiter` the calls also go through its budgets, and the limit follows
+    its adaptive concurrency, capped by max_size.
+    """
 
     def final_decro(func):
         """Not using async.Semaphore to aovid use nest-asyncio"""
         __current_size = 0
+        # heap of (priority, arrival, future) of the waiting calls
+        __waiters = []
+        __arrival = itertools.count()
+
+        def current_limit():
+            if rate_limiter is None:
+                return max_size
+            return min(max_size, rate_limiter.concurrency_limit)
+
+        def wake_waiters():
+            nonlocal __current_size
+            while __waiters and __current_size < current_limit():
+                _, _, waiter = heapq.heappop(__waiters)
+                if waiter.done():
+                    # cancelled while waiting
+                    continue
+                # the slot is handed over to the waiter
+                __current_size += 1
+                waiter.set_result(None)
+
+        def release():
+            nonlocal __current_size
+            __current_size -= 1
+            wake_waiters()
 
         @wraps(func)
         async def wait_func(*args, **kwargs):
             nonlocal __current_size
-            while __current_size >= max_size:
-                await asyncio.sleep(waitting_time)
-            __current_size += 1
-            result = await func(*args, **kwargs)
-            __current_size -= 1
+            if __current_size < current_limit() and not __waiters:
+                __current_size += 1
+            else:
+                waiter = asyncio.get_running_loop().create_future()
+                heapq.heappush(
+                    __waiters, (call_priority.get(), next(__arrival), waiter)
+                )
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    if waiter.done() and not waiter.cancelled():
+                        # cancelled after the slot was handed over
+                        release()
+                    raise
+            try:
+                if rate_limiter is None:
+                    result = await func(*args, **kwargs)
+                else:
+                    result = await rate_limiter.call(func, *args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            if hasattr(result, "__aiter__"):
+                # a streamed response holds the slot until it is consumed or closed
+                return _ReleasingAsyncIterator(result, release)
+            release()
             return result
 
+        if rate_limiter is not None:
+            rate_limiter.add_listener(wake_waiters)
         return wait_func
 
     return final_decro
 
 
+# set while a RateLimiter handles the rate limit errors of the call, so that the
+# llm functions do not retry them on their own
+rate_limit_handled: ContextVar[bool] = ContextVar("rate_limit_handled", default=False)
+
+
+# set while a RateLimiter runs a function marked with defer_rate_limit, charges the
+# budgets of the call
+_rate_limit_acquire: ContextVar[Union[callable, None]] = ContextVar(
+    "_rate_limit_acquire", default=None
+)
+
+
+def defer_rate_limit(func):
+    """Mark a llm function which calls `acquire_rate_limit` right before its requests to
+    the provider. A RateLimiter then only charges its budgets for the calls reaching the
+    provider, not for the cache hits and the callers sharing a call in flight.
+    """
+    func.defers_rate_limit = True
+    return func
+
+
+def _defers_rate_limit(func) -> bool:
+    # through functools.partial and the decorators setting __wrapped__
+    while func is not None:
+        if getattr(func, "defers_rate_limit", False):
+            return True
+        func = getattr(func, "func", None) or getattr(func, "__wrapped__", None)
+    return False
+
+
+async def acquire_rate_limit():
+    """Wait for and charge the budgets of the RateLimiter handling the call, if any"""
+    acquire = _rate_limit_acquire.get()
+    if acquire is not None:
+        await acquire()
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """HTTP 429 of the openai client (status_code) or aiohttp (status)"""
+    return getattr(e, "status_code", None) == 429 or getattr(e, "status", None) == 429
+
+
+def get_retry_after(e: Exception) -> Union[float, None]:
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if headers is None:
+        headers = getattr(e, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Budget of `rate_per_minute` units, refilled continuously, with a burst of
+    `burst_seconds` of the rate. Reservations are taken immediately and may overdraw
+    the bucket, the caller sleeps the returned time, so that waiting calls are served
+    in order without polling.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 1.0):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = self.rate * burst_seconds
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budgets of a llm or embedding function,
+    with adaptive concurrency: halved on a rate limit error or a latency above
+    target_latency, grown by one call per round of successful calls up to max_concurrency.
+    Rate limit errors are retried by the limiter after Retry-After or an exponential pause.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        count_tokens: callable = None,
+        adaptive_concurrency: bool = False,
+        min_concurrency: int = 1,
+        target_latency: float = 0,
+        max_retries: int = 5,
+        name: str = "",
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.adaptive_concurrency = adaptive_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.count_tokens = count_tokens
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket = (
+            TokenBucket(tokens_per_minute)
+            if tokens_per_minute > 0 and count_tokens is not None
+            else None
+        )
+        self._concurrency = float(max_concurrency)
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._listeners = []
+        self.stats = {
+            "requests": 0,
+            "tokens": 0,
+            "rate_limited": 0,
+            "retries": 0,
+            "wait_seconds": 0.0,
+        }
+
+    @property
+    def concurrency_limit(self) -> int:
+        return max(1, int(self._concurrency))
+
+    def add_listener(self, callback):
+        """Called when the concurrency limit grows"""
+        self._listeners.append(callback)
+
+    def _set_concurrency(self, value: float):
+        old_limit = self.concurrency_limit
+        self._concurrency = min(float(self.max_concurrency), max(float(self.min_concurrency), value))
+        if self.concurrency_limit > old_limit:
+            for callback in self._listeners:
+                callback()
+        elif self.concurrency_limit < old_limit:
+            logger.info(f"{self.name} concurrency reduced to {self.concurrency_limit}")
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        # one decrease per second, the calls in flight fail or slow down together
+        if now - self._last_decrease < 1.0:
+            return
+        self._last_decrease = now
+        self._set_concurrency(self._concurrency * factor)
+
+    def on_success(self, latency: float):
+        if not self.adaptive_concurrency:
+            return
+        if self.target_latency and latency > self.target_latency:
+            self._decrease(0.5)
+        else:
+            self._set_concurrency(self._concurrency + 1.0 / self._concurrency)
+
+    def on_rate_limited(self, attempt: int, retry_after: float = None):
+        self.stats["rate_limited"] += 1
+        pause = retry_after if retry_after is not None else min(60.0, 2.0**attempt)
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        if self.adaptive_concurrency:
+            self._decrease(0.5)
+
+    def _reserve(self, tokens: int) -> float:
+        wait = self._paused_until - time.monotonic()
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        return max(0.0, wait)
+
+    async def call(self, func, *args, **kwargs):
+        """Call `func` within the budgets. A function marked with defer_rate_limit is
+        charged when it calls acquire_rate_limit, the others before they are called.
+        """
+        tokens = self.count_tokens(args, kwargs) if self.token_bucket is not None else 0
+        deferred = _defers_rate_limit(func)
+        for attempt in range(self.max_retries + 1):
+            # the time the last request was sent, None while nothing was charged
+            sent = [None]
+
+            async def _acquire():
+                wait = self._reserve(tokens)
+                if wait > 0:
+                    self.stats["wait_seconds"] += wait
+                    await asyncio.sleep(wait)
+                self.stats["requests"] += 1
+                self.stats["tokens"] += tokens
+                sent[0] = time.monotonic()
+
+            if not deferred:
+                await _acquire()
+            token = rate_limit_handled.set(True)
+            acquire_token = _rate_limit_acquire.set(_acquire if deferred else None)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                self.on_rate_limited(attempt, get_retry_after(e))
+                self.stats["retries"] += 1
+                continue
+            finally:
+                _rate_limit_acquire.reset(acquire_token)
+                rate_limit_handled.reset(token)
+            if sent[0] is not None:
+                self.on_success(time.monotonic() - sent[0])
+            return result
+
+
+def count_llm_call_tokens(args: tuple, kwargs: dict, model_name: str = "gpt-4o") -> int:
+    """Prompt tokens of a llm_model_func call"""
+    prompt = args[0] if args else kwargs.get("prompt", "")
+    contents = [prompt, kwargs.get("system_prompt") or ""] + [
+        m.get("content", "") for m in kwargs.get("history_messages") or []
+    ]
+    return sum(len(encode_string_by_tiktoken(c, model_name)) for c in contents)
+
+
+def count_embedding_call_tokens(args: tuple, kwargs: dict, model_name: str = "gpt-4o") -> int:
+    """Tokens of the texts of an embedding_func call"""
+    texts = args[0] if args else kwargs.get("texts", [])
+    return sum(len(encode_string_by_tiktoken(t, model_name)) for t in texts)
+
+
+def pack_embedding_batches(
+    contents: list[str],
+    max_batch_tokens: int,
+    max_batch_size: int,
+    max_token_size: int,
+    over_length: str = "truncate",
+    model_name: str = "gpt-4o",
+) -> tuple[list[list[str]], list[list[tuple[int, int]]], dict]:
+    """Pack the contents into embedding requests of at most `max_batch_tokens` tokens
+    and `max_batch_size` texts. Contents beyond `max_token_size` tokens, or
+    `max_batch_tokens` if lower, are cut to their first tokens with
+    over_length="truncate", or into pieces of at most that many tokens with
+    over_length="split". The tokens are counted with the tiktoken encoding of
+    `model_name`, so they approximate the tokens of the embedding model.
+
+    With `max_batch_tokens` 0 the contents are not encoded, they are sent as they are in
+    requests of `max_batch_size` texts and the token statistics stay 0.
+
+    Returns the batches of texts, the (content index, tokens) of every text of the
+    batches, and the fill statistics of the batches.
+    """
+    if over_length not in ("truncate", "split"):
+        raise ValueError(f"Unknown over_length {over_length}, use truncate or split")
+    stats = dict(items=len(contents), truncated=0, split=0)
+    if not max_batch_tokens:
+        starts = range(0, len(contents), max_batch_size)
+        batches = [contents[start : start + max_batch_size] for start in starts]
+        owners = [
+            [(i, 0) for i in range(start, min(start + max_batch_size, len(contents)))]
+            for start in starts
+        ]
+        stats.update(batches=len(batches), tokens=0, max_batch_tokens=0, fill=None)
+        return batches, owners, stats
+    # a text never exceeds the budget of a request
+    max_token_size = min(max_token_size, max_batch_tokens)
+    pieces = []  # (tokens, content index, text)
+    for i, content in enumerate(contents):
+        tokens = encode_string_by_tiktoken(content, model_name)
+        if len(tokens) <= max_token_size:
+            pieces.append((len(tokens), i, content))
+            continue
+        if over_length == "truncate":
+            stats["truncated"] += 1
+            pieces.append(
+                (max_token_size, i, decode_tokens_by_tiktoken(tokens[:max_token_size], model_name))
+            )
+            continue
+        stats["split"] += 1
+        for start in range(0, len(tokens), max_token_size):
+            part = tokens[start : start + max_token_size]
+            pieces.append((len(part), i, decode_tokens_by_tiktoken(part, model_name)))
+
+    # first fit decreasing, the short texts fill up the batches of the long ones
+    pieces.sort(key=lambda x: x[0], reverse=True)
+    batches, owners, batch_tokens = [], [], []
+    open_batches = []  # indexes of the batches which are not full
+    for num_tokens, i, text in pieces:
+        b = next(
+            (
+                b
+                for b in open_batches
+                if batch_tokens[b] + num_tokens <= max_batch_tokens
+            ),
+            None,
+        )
+        if b is None:
+            b = len(batches)
+            batches.append([])
+            owners.append([])
+            batch_tokens.append(0)
+            open_batches.append(b)
+        batches[b].append(text)
+        owners[b].append((i, num_tokens))
+        batch_tokens[b] += num_tokens
+        if len(batches[b]) >= max_batch_size or batch_tokens[b] == max_batch_tokens:
+            open_batches.remove(b)
+    stats.update(
+        batches=len(batches),
+        tokens=sum(batch_tokens),
+        max_batch_tokens=max(batch_tokens, default=0),
+        fill=sum(batch_tokens) / (len(batches) * max_batch_tokens) if batches else None,
+    )
+    return batches, owners, stats
+
+
+def unpack_embedding_batches(
+    num_contents: int, owners: list[list[tuple[int, int]]], embeddings_list: list[np.ndarray]
+) -> np.ndarray:
+    """The embedding of every content from the embedded batches of pack_embedding_batches,
+    the pieces of a split content are averaged by their tokens, and normalized.
+    """
+    pieces = defaultdict(list)
+    for batch_owners, batch_embeddings in zip(owners, embeddings_list):
+        for (i, num_tokens), embedding in zip(batch_owners, batch_embeddings):
+            pieces[i].append((num_tokens, embedding))
+    embeddings = []
+    for i in range(num_contents):
+        if len(pieces[i]) == 1:
+            embeddings.append(pieces[i][0][1])
+            continue
+        mean = sum(n * np.asarray(e, dtype=np.float32) for n, e in pieces[i]) / sum(
+            n for n, _ in pieces[i]
+        )
+        embeddings.append(mean / (np.linalg.norm(mean) or 1.0))
+    return np.array(embeddings)
+
+
+def count_async_func_call(func):
+    """Count the callings of a async func in `num_calls` of the returned func"""
+
+    @wraps(func)
+    async def count_func(*args, **kwargs):
+        count_func.num_calls += 1
+        return await func(*args, **kwargs)
+
+    count_func.num_calls = 0
+    return count_func
+
+
+# in-flight calls of single_flight, keyed by (event loop, key)
+_in_flight_calls: dict[tuple, asyncio.Task] = {}
+
+
+async def single_flight(key, func, *args, **kwargs):
+    """Run `func(*args, **kwargs)` once for concurrent callers of the same key,
+    later callers await the result (or the exception) of the call in flight.
+    """
+    flight_key = (id(asyncio.get_running_loop()), key)
+    task = _in_flight_calls.get(flight_key)
+    if task is None:
+        task = asyncio.ensure_future(func(*args, **kwargs))
+        _in_flight_calls[flight_key] = task
+        task.add_done_callback(lambda _: _in_flight_calls.pop(flight_key, None))
+    # a cancelled caller does not cancel the call of the others
+    return await asyncio.shield(task)
+
+
+def single_flight_func_call(func):
+    """Concurrent calls of a async llm func with the same arguments, keyword arguments
+    included, share one call through single_flight. Wrapped around the limiter, the
+    callers sharing a call do not take a slot of it. Streamed calls are not shared, their
+    iterator can only be consumed once.
+    """
+
+    @wraps(func)
+    async def single_flight_func(*args, **kwargs):
+        if kwargs.get("stream"):
+            return await func(*args, **kwargs)
+        key = ("llm", id(single_flight_func), compute_args_hash(args, sorted(kwargs.items())))
+        return await single_flight(key, func, *args, **kwargs)
+
+    return single_flight_func
+
+
+class EmbeddingMicroBatcher:
+    """Embed the concurrent calls of fewer than `max_batch_size` texts with one call of
+    `embedding_func`: a call waits at most `max_wait` seconds for others to join its
+    batch, which is sent once another call would take it beyond `max_batch_size` texts.
+    Larger calls are passed through. The stats count the calls and the batched requests.
+    """
+
+    def __init__(self, embedding_func: callable, max_wait: float = 0.002, max_batch_size: int = 64):
+        self.embedding_func = embedding_func
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        # per event loop, the (texts, future) of the calls waiting and the flush timer
+        self._pending: dict[int, list[tuple[list[str], asyncio.Future]]] = {}
+        self._timers: dict[int, asyncio.TimerHandle] = {}
+        # the requests in flight, the event loop only keeps weak references to tasks
+        self._tasks: set[asyncio.Task] = set()
+        self.stats = {"calls": 0, "requests": 0, "texts": 0}
+
+    async def __call__(self, texts: list[str], **kwargs) -> np.ndarray:
+        if kwargs or len(texts) >= self.max_batch_size:
+            return await self.embedding_func(texts, **kwargs)
+        loop = asyncio.get_running_loop()
+        loop_key = id(loop)
+        future = loop.create_future()
+        num_texts = sum(len(t) for t, _ in self._pending.get(loop_key, [])) + len(texts)
+        if num_texts > self.max_batch_size:
+            # send the waiting calls first, this one starts the next batch
+            self._flush(loop_key)
+            num_texts = len(texts)
+        self._pending.setdefault(loop_key, []).append((texts, future))
+        self.stats["calls"] += 1
+        if num_texts == self.max_batch_size:
+            self._flush(loop_key)
+        elif loop_key not in self._timers:
+            self._timers[loop_key] = loop.call_later(self.max_wait, self._flush, loop_key)
+        return await future
+
+    def _flush(self, loop_key: int):
+        timer = self._timers.pop(loop_key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._pending.pop(loop_key, [])
+        if len(pending):
+            task = asyncio.ensure_future(self._embed(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed(self, pending: list[tuple[list[str], asyncio.Future]]):
+        unique_texts = list(dict.fromkeys(t for texts, _ in pending for t in texts))
+        self.stats["requests"] += 1
+        self.stats["texts"] += len(unique_texts)
+        try:
+            embeddings = await self.embedding_func(unique_texts)
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        except BaseException:
+            for _, future in pending:
+                future.cancel()
+            raise
+        index = {t: i for i, t in enumerate(unique_texts)}
+        for texts, future in pending:
+            # the caller may have been cancelled meanwhile
+            if not future.done():
+                future.set_result(np.array([embeddings[index[t]] for t in texts]))
+
+
 def wrap_embedding_func_with_attrs(**kwargs):
     """Wrap a function with attributes"""
 
@@ -165,18 +753,98 @@ def is_float_regex(value):
     return bool(re.match(r"^[-+]?[0-9]*\.?[0-9]+$", value))
 
 
-def truncate_list_by_token_size(list_data: list, key: callable, max_token_size: int):
-    """Truncate a list of data by token size"""
+def truncate_list_by_token_size(
+    list_data: list, key: callable, max_token_size: int, token_key: callable = None
+):
+    """Truncate a list of data by token size.
+    `token_key` returns the stored token count of an item, the text is only encoded if it returns None.
+    """
     if max_token_size <= 0:
         return []
     tokens = 0
     for i, data in enumerate(list_data):
-        tokens += len(encode_string_by_tiktoken(key(data)))
+        num_tokens = token_key(data) if token_key is not None else None
+        if num_tokens is None:
+            num_tokens = len(encode_string_by_tiktoken(key(data)))
+        tokens += num_tokens
         if tokens > max_token_size:
             return list_data[:i]
     return list_data
 
 
+class MinHashLSH:
+    """MinHash signatures of the word shingles of texts, indexed by LSH bands to find
+    the stored text whose estimated Jaccard similarity with a new one is >= threshold.
+    """
+
+    _mersenne_prime = np.uint64((1 << 61) - 1)
+    _max_hash = np.uint64((1 << 32) - 1)
+
+    def __init__(
+        self, threshold: float = 0.9, num_perm: int = 128, shingle_size: int = 5, seed: int = 1
+    ):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, (1 << 61) - 1, size=num_perm, dtype=np.uint64)
+        # the (bands, rows) whose S-curve (1/bands)^(1/rows) is the closest to the threshold
+        self.rows = min(
+            (r for r in range(1, num_perm + 1) if num_perm % r == 0),
+            key=lambda r: abs((r / num_perm) ** (1 / r) - threshold),
+        )
+        self.bands = num_perm // self.rows
+        self._signatures: dict[str, np.ndarray] = {}
+        self._buckets: dict[tuple, list[str]] = {}
+
+    def signature(self, text: str) -> np.ndarray:
+        words = re.findall(r"\w+", text.lower())
+        shingles = {
+            " ".join(words[i : i + self.shingle_size])
+            for i in range(max(len(words) - self.shingle_size + 1, 1))
+        }
+        hashes = np.array(
+            [int.from_bytes(md5(sh.encode()).digest()[:4], "little") for sh in shingles],
+            dtype=np.uint64,
+        )
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) % self._mersenne_prime
+        return np.bitwise_and(permuted, self._max_hash).min(axis=0).astype(np.uint32)
+
+    def _bands_of(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows : (band + 1) * self.rows].tobytes()
+
+    def query(self, signature: np.ndarray) -> Union[str, None]:
+        """The key of the most similar stored text above the threshold, or None"""
+        candidates = set()
+        for band_key in self._bands_of(signature):
+            candidates.update(self._buckets.get(band_key, []))
+        best_key, best_similarity = None, self.threshold
+        for key in candidates:
+            similarity = float(np.mean(self._signatures[key] == signature))
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def insert(self, key: str, signature: np.ndarray):
+        if key in self._signatures:
+            return
+        self._signatures[key] = signature
+        for band_key in self._bands_of(signature):
+            self._buckets.setdefault(band_key, []).append(key)
+
+    def remove(self, key: str):
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return
+        for band_key in self._bands_of(signature):
+            self._buckets[band_key].remove(key)
+            if not len(self._buckets[band_key]):
+                del self._buckets[band_key]
+
+
 def list_of_list_to_csv(data: List[List[str]]) -> str:
     output = io.StringIO()
     writer = csv.writer(output)
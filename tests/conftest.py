@@ -0,0 +1,17 @@
+import tiktoken
+
+import hyperrag.utils
+
+
+def pytest_configure(config):
+    # the tokenizer files are downloaded on first use, fall back to a byte-level
+    # encoding when they can not be
+    try:
+        tiktoken.encoding_for_model("gpt-4o")
+    except Exception:
+        hyperrag.utils.ENCODER = tiktoken.Encoding(
+            name="bytes",
+            pat_str=r"""[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+            mergeable_ranks={bytes([i]): i for i in range(256)},
+            special_tokens={},
+        )
@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+import pytest
+
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.operate import _handle_batch_summary
+from hyperrag.prompt import GRAPH_FIELD_SEP, PROMPTS
+
+BATCH_HEADER = PROMPTS["summarize_batch"].split("{")[0]
+NAMES = ["ALPHA", "BETA", "GAMMA", "DELTA", "OMEGA"]
+
+
+def make_config(llm_model_func, **kwargs) -> dict:
+    return {
+        "llm_model_func": llm_model_func,
+        "llm_model_max_token_size": 10**6,
+        "tiktoken_model_name": "gpt-4o",
+        "summary_batch_max_items": 16,
+        "summary_batch_max_output_tokens": 4096,
+        "entity_summary_to_max_tokens": 500,
+        "entity_additional_properties_to_max_tokens": 250,
+        "relation_summary_to_max_tokens": 750,
+        "relation_keywords_to_max_tokens": 100,
+        **kwargs,
+    }
+
+
+def summary_requests() -> list:
+    # descriptions long enough to be summarized by the single item handler too
+    return [
+        ("entity_description", name, GRAPH_FIELD_SEP.join([f"{name} sails far. " * 200] * 2), None)
+        for name in NAMES
+    ]
+
+
+def test_batches_are_capped_by_the_output_tokens():
+    fake = FakeOpenAI()
+    complete = fake.complete_func()
+    batch_max_tokens = []
+
+    async def llm_model_func(prompt, **kwargs):
+        if prompt.startswith(BATCH_HEADER):
+            batch_max_tokens.append(kwargs["max_tokens"])
+        return await complete(prompt, **kwargs)
+
+    config = make_config(llm_model_func, summary_batch_max_output_tokens=1000)
+    results = asyncio.run(_handle_batch_summary(summary_requests(), config))
+    # 2 + 2 items in batch prompts, the last one alone
+    assert batch_max_tokens == [1000, 1000]
+    assert fake.stats["chat"] == 3
+    assert results[:4] == ["Summary of item 1", "Summary of item 2"] * 2
+
+
+def drop_first_item(response: str) -> str:
+    summaries = json.loads(response)
+    del summaries["1"]
+    return json.dumps(summaries)
+
+
+def fail(response: str) -> str:
+    raise RuntimeError("batch summary failed")
+
+
+@pytest.mark.parametrize("break_response", [drop_first_item, fail])
+def test_failed_batch_items_fall_back_to_single_summaries(break_response):
+    fake = FakeOpenAI()
+    complete = fake.complete_func()
+
+    async def llm_model_func(prompt, **kwargs):
+        response = await complete(prompt, **kwargs)
+        return break_response(response) if prompt.startswith(BATCH_HEADER) else response
+
+    requests = summary_requests()
+    results = asyncio.run(_handle_batch_summary(requests, make_config(llm_model_func)))
+    single = [r for r in results if not r.startswith("Summary of item")]
+    assert len(single) == (1 if break_response is drop_first_item else len(NAMES))
+    assert results[0] in single and results[0] != requests[0][2]
@@ -0,0 +1,55 @@
+import asyncio
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.prompt import GRAPH_FIELD_SEP
+from hyperrag.utils import compute_mdhash_id
+
+WORDS = ["Alpha", "meets", "Beta", "at", "the", "Harbor", "and", "sails", "with", "Omega"]
+DOC = " ".join(f"{WORDS[i % len(WORDS)]}{i // len(WORDS)}" for i in range(200)) + "."
+NEAR_DUPLICATE_DOC = DOC.replace("Beta0", "Gamma0")
+OTHER_DOC = "Sigma rides to the Island with Delta."
+
+
+def make_rag(working_dir, fake: FakeOpenAI) -> HyperRAG:
+    return HyperRAG(
+        working_dir=str(working_dir),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        enable_llm_cache=False,
+        entity_extract_max_gleaning=0,
+        enable_chunk_dedup=True,
+        chunk_token_size=4096,
+    )
+
+
+def chunk_id(doc: str) -> str:
+    return compute_mdhash_id(doc, prefix="chunk-")
+
+
+def test_near_duplicate_chunks_are_linked_not_extracted(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+
+    async def main():
+        rag = make_rag(tmp_path, fake)
+        await rag.ainsert(DOC)
+        await rag.aclose()
+        # the signatures of the stored chunks are loaded by a new instance
+        rag = make_rag(tmp_path, fake)
+        chats = fake.stats["chat"]
+        await rag.ainsert(NEAR_DUPLICATE_DOC)
+        assert fake.stats["chat"] == chats
+        await rag.ainsert(OTHER_DOC)
+        assert fake.stats["chat"] > chats
+
+        duplicate = await rag.text_chunks.get_by_id(chunk_id(NEAR_DUPLICATE_DOC))
+        assert duplicate["canonical_chunk_id"] == chunk_id(DOC)
+        vertex = await rag.chunk_entity_relation_hypergraph.get_vertex("HARBOR0")
+        assert set(vertex["source_id"].split(GRAPH_FIELD_SEP)) == {
+            chunk_id(DOC),
+            chunk_id(NEAR_DUPLICATE_DOC),
+        }
+        other = await rag.text_chunks.get_by_id(chunk_id(OTHER_DOC))
+        assert "canonical_chunk_id" not in other
+
+    asyncio.run(main())
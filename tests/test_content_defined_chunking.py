@@ -0,0 +1,67 @@
+import asyncio
+import io
+import random
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.operate import chunking_by_content_defined, chunking_by_content_defined_stream
+
+WORDS = ["Alpha", "Beta", "Gamma", "Delta", "Omega", "Sigma", "harbor", "island", "sails", "meets"]
+CHUNKING = dict(min_token_size=32, avg_token_size=96, max_token_size=256)
+
+
+def make_doc(num_words: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    return " ".join(f"{rng.choice(WORDS)}{rng.randrange(100)}" for _ in range(num_words)) + "."
+
+
+DOC = make_doc(2000)
+# an edit in the middle of the doc
+EDITED_DOC = DOC[: len(DOC) // 2] + " Theta meets Kappa at the harbor. " + DOC[len(DOC) // 2 :]
+
+
+def contents(chunks) -> list[str]:
+    return [chunk["content"] for chunk in chunks]
+
+
+def test_chunks_resync_after_an_edit():
+    chunks = contents(chunking_by_content_defined(DOC, **CHUNKING))
+    edited_chunks = contents(chunking_by_content_defined(EDITED_DOC, **CHUNKING))
+    assert len(chunks) > 10
+    # only the chunks around the edit change, the boundaries resync within one chunk
+    assert len(set(chunks) - set(edited_chunks)) <= 2
+    assert len(set(edited_chunks) - set(chunks)) <= 2
+
+
+def test_stream_chunks_equal_the_batch_chunks():
+    stream_chunks = chunking_by_content_defined_stream(
+        io.StringIO(DOC), read_size=64, **CHUNKING
+    )
+    assert list(stream_chunks) == chunking_by_content_defined(DOC, **CHUNKING)
+
+
+def test_edited_doc_only_extracts_the_changed_chunks(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    rag = HyperRAG(
+        working_dir=str(tmp_path),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        enable_llm_cache=False,
+        entity_extract_max_gleaning=0,
+        chunking_mode="content_defined",
+        chunk_min_token_size=CHUNKING["min_token_size"],
+        chunk_avg_token_size=CHUNKING["avg_token_size"],
+        chunk_token_size=CHUNKING["max_token_size"],
+    )
+
+    async def main():
+        await rag.ainsert(DOC)
+        chunk_keys = set(await rag.text_chunks.all_keys())
+        chats = fake.stats["chat"]
+        await rag.ainsert(EDITED_DOC)
+        new_chunk_keys = set(await rag.text_chunks.all_keys()) - chunk_keys
+        return len(chunk_keys), len(new_chunk_keys), fake.stats["chat"] - chats
+
+    num_chunks, num_new_chunks, extractions = asyncio.run(main())
+    assert 0 < num_new_chunks <= 2 < num_chunks
+    assert extractions == num_new_chunks
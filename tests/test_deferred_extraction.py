@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.prompt import GRAPH_FIELD_SEP
+
+DOCS = [
+    "Alpha meets Beta and Gamma at the Harbor. Delta watches Alpha from the Tower.",
+    "Gamma sails with Epsilon to the Island. Beta stays at the Harbor with Delta.",
+]
+
+
+def make_rag(working_dir, fake: FakeOpenAI) -> HyperRAG:
+    working_dir.mkdir()
+    return HyperRAG(
+        working_dir=str(working_dir),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        enable_llm_cache=False,
+        entity_extract_max_gleaning=0,
+        chunk_token_size=16,
+        chunk_overlap_token_size=0,
+    )
+
+
+def fill_requests(fake: FakeOpenAI, request_file, completion_file):
+    """Answer the requests offline, as the batch API would"""
+    with open(request_file) as f, open(completion_file, "w") as out:
+        for line in f:
+            request = json.loads(line)
+            content = fake.completion_text(request["body"]["messages"])
+            out.write(json.dumps({"custom_id": request["custom_id"], "content": content}) + "\n")
+
+
+async def graph_of(rag: HyperRAG) -> dict:
+    graph = rag.chunk_entity_relation_hypergraph
+    vertices = {v: dict(await graph.get_vertex(v)) for v in await graph.get_all_vertices()}
+    hyperedges = {
+        tuple(sorted(e)): dict(await graph.get_hyperedge(e))
+        for e in await graph.get_all_hyperedges()
+    }
+    # the source ids are joined from a set, their order is arbitrary
+    for data in list(vertices.values()) + list(hyperedges.values()):
+        data["source_id"] = sorted(data["source_id"].split(GRAPH_FIELD_SEP))
+    return {"vertices": vertices, "hyperedges": hyperedges}
+
+
+def test_deferred_insert_matches_insert_and_ingest_is_idempotent(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    inserted = make_rag(tmp_path / "inserted", fake)
+    deferred = make_rag(tmp_path / "deferred", fake)
+    request_file, completion_file = tmp_path / "requests.jsonl", tmp_path / "completions.jsonl"
+
+    async def main():
+        await inserted.ainsert(DOCS)
+        num_requests = await deferred.aexport_extraction_requests(DOCS, request_file, "fake")
+        assert num_requests > 1
+        fill_requests(fake, request_file, completion_file)
+        stats = await deferred.aingest_extraction_completions(completion_file, request_file, "fake")
+        assert stats == {"merged": num_requests, "requests": 0, "pending": 0}
+        graph = await graph_of(deferred)
+        assert len(graph["vertices"]) and len(graph["hyperedges"])
+        assert graph == await graph_of(inserted)
+
+        stats = await deferred.aingest_extraction_completions(completion_file, request_file, "fake")
+        assert stats == {"merged": 0, "requests": 0, "pending": 0}
+        assert await graph_of(deferred) == graph
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import asyncio
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.prompt import GRAPH_FIELD_SEP
+from hyperrag.utils import compute_mdhash_id
+
+KEPT_DOC = "Alpha meets Beta at the Harbor."
+DELETED_DOC = "Alpha sails with Omega to the Island."
+UPDATED_DOC = "Alpha rides with Sigma."
+
+
+def make_rag(working_dir) -> HyperRAG:
+    fake = FakeOpenAI(embedding_dim=32)
+    return HyperRAG(
+        working_dir=str(working_dir),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        enable_llm_cache=False,
+        entity_extract_max_gleaning=0,
+    )
+
+
+async def chunk_ids_of(rag: HyperRAG, doc: str) -> set[str]:
+    doc_id = compute_mdhash_id(doc, prefix="doc-")
+    return {
+        k
+        for k in await rag.text_chunks.all_keys()
+        if doc_id in (await rag.text_chunks.get_by_id(k))["full_doc_ids"]
+    }
+
+
+def forbid_graph_scan(rag: HyperRAG):
+    # the affected entities are looked up from the extractions of the deleted chunks
+    graph = rag.chunk_entity_relation_hypergraph
+    graph.get_all_vertices = graph.get_all_hyperedges = None
+
+
+def relation_id(id_set) -> str:
+    return compute_mdhash_id(str(sorted(id_set)), prefix="rel-")
+
+
+async def assert_only_sourced_by(rag: HyperRAG, chunk_ids: set[str], inserted_edges: list):
+    graph = rag.chunk_entity_relation_hypergraph
+    vertices = {v: await graph.get_vertex(v) for v in graph._hg.all_v}
+    hyperedges = {e: await graph.get_hyperedge(e) for e in graph._hg.all_e}
+    for data in list(vertices.values()) + list(hyperedges.values()):
+        assert set(data["source_id"].split(GRAPH_FIELD_SEP)) <= chunk_ids
+
+    assert "ALPHA" in vertices
+    assert "OMEGA" not in vertices and "ISLAND." not in vertices
+    entity_ids = [compute_mdhash_id(v, prefix="ent-") for v in ("ALPHA", "OMEGA")]
+    assert [dp is not None for dp in await rag.entities_vdb.get_by_ids(entity_ids)] == [True, False]
+    # the hyperedges of the deleted doc only are gone from the vdb too
+    stored = await rag.relationships_vdb.get_by_ids([relation_id(e) for e in inserted_edges])
+    kept = {relation_id(e) for e in hyperedges}
+    assert any(dp is None for dp in stored)
+    assert [dp is not None for dp in stored] == [relation_id(e) in kept for e in inserted_edges]
+
+
+def test_delete_doc_keeps_the_other_sources_and_removes_orphans(tmp_path):
+    rag = make_rag(tmp_path)
+
+    async def main():
+        await rag.ainsert([KEPT_DOC, DELETED_DOC])
+        inserted_edges = list(rag.chunk_entity_relation_hypergraph._hg.all_e)
+        kept_chunks = await chunk_ids_of(rag, KEPT_DOC)
+        forbid_graph_scan(rag)
+        assert await rag.adelete_doc(compute_mdhash_id(DELETED_DOC, prefix="doc-"))
+        await assert_only_sourced_by(rag, kept_chunks, inserted_edges)
+
+    asyncio.run(main())
+
+
+def test_update_doc_rebuilds_from_the_new_version(tmp_path):
+    rag = make_rag(tmp_path)
+
+    async def main():
+        await rag.ainsert([KEPT_DOC, DELETED_DOC])
+        inserted_edges = list(rag.chunk_entity_relation_hypergraph._hg.all_e)
+        forbid_graph_scan(rag)
+        new_doc_id = await rag.aupdate_doc(
+            compute_mdhash_id(DELETED_DOC, prefix="doc-"), UPDATED_DOC
+        )
+        chunks = await chunk_ids_of(rag, KEPT_DOC) | await chunk_ids_of(rag, UPDATED_DOC)
+        assert new_doc_id == compute_mdhash_id(UPDATED_DOC, prefix="doc-")
+        await assert_only_sourced_by(rag, chunks, inserted_edges)
+        assert await rag.chunk_entity_relation_hypergraph.has_vertex("SIGMA.")
+
+    asyncio.run(main())
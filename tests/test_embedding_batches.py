@@ -0,0 +1,58 @@
+import numpy as np
+
+import hyperrag.utils
+from hyperrag.utils import (
+    encode_string_by_tiktoken,
+    pack_embedding_batches,
+    unpack_embedding_batches,
+)
+
+SHORT_TEXTS = ["alpha beta", "gamma", "delta epsilon zeta", "eta"]
+LONG_TEXT = " ".join(f"word{i}" for i in range(200))
+
+
+def test_batches_stay_within_the_token_budget():
+    budget = 24
+    contents = SHORT_TEXTS + [LONG_TEXT]
+    batches, owners, stats = pack_embedding_batches(
+        contents, max_batch_tokens=budget, max_batch_size=8, max_token_size=8192
+    )
+    # the long text is clamped to the budget of a request, not to max_token_size
+    assert stats["truncated"] == 1
+    for batch in batches:
+        assert len(batch) <= 8
+        assert sum(len(encode_string_by_tiktoken(t)) for t in batch) <= budget
+    assert sorted(i for batch_owners in owners for i, _ in batch_owners) == list(
+        range(len(contents))
+    )
+
+
+def test_split_pieces_are_averaged_back():
+    budget = 24
+    batches, owners, stats = pack_embedding_batches(
+        [LONG_TEXT, "alpha"],
+        max_batch_tokens=budget,
+        max_batch_size=4,
+        max_token_size=8192,
+        over_length="split",
+    )
+    assert stats["split"] == 1
+    assert all(n <= budget for batch_owners in owners for _, n in batch_owners)
+    embeddings = [np.ones((len(batch), 4), dtype=np.float32) for batch in batches]
+    unpacked = unpack_embedding_batches(2, owners, embeddings)
+    assert unpacked.shape == (2, 4)
+    assert np.isclose(np.linalg.norm(unpacked[0]), 1.0)
+
+
+def test_no_budget_skips_the_token_counting(monkeypatch):
+    def forbidden_encode(*args, **kwargs):
+        raise AssertionError("contents are encoded without a token budget")
+
+    monkeypatch.setattr(hyperrag.utils, "encode_string_by_tiktoken", forbidden_encode)
+    contents = SHORT_TEXTS + [LONG_TEXT]
+    batches, owners, stats = pack_embedding_batches(
+        contents, max_batch_tokens=0, max_batch_size=2, max_token_size=8
+    )
+    assert batches == [contents[0:2], contents[2:4], contents[4:]]
+    assert [[i for i, _ in batch_owners] for batch_owners in owners] == [[0, 1], [2, 3], [4]]
+    assert stats["truncated"] == 0 and stats["tokens"] == 0
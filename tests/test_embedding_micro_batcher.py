@@ -0,0 +1,39 @@
+import asyncio
+
+import numpy as np
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.utils import EmbeddingMicroBatcher
+
+QUERIES = ["Alpha", "Beta", "Gamma", "Delta"]
+
+
+def test_concurrent_query_embeddings_are_one_request(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    rag = HyperRAG(
+        working_dir=str(tmp_path),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        embedding_micro_batch_wait=0.01,
+    )
+
+    async def main():
+        return await asyncio.gather(*[rag.chunks_vdb._embed_query(q) for q in QUERIES])
+
+    embeddings = asyncio.run(main())
+    assert fake.stats["embeddings"] == 1
+    assert np.allclose(embeddings, [fake.embedding(q) for q in QUERIES])
+
+
+def test_full_batch_is_sent_without_waiting():
+    fake = FakeOpenAI(embedding_dim=32)
+    batcher = EmbeddingMicroBatcher(fake.embeddings, max_wait=60, max_batch_size=len(QUERIES))
+
+    async def main():
+        calls = [batcher([q]) for q in QUERIES]
+        return await asyncio.wait_for(asyncio.gather(*calls), timeout=1)
+
+    asyncio.run(main())
+    assert fake.stats["embeddings"] == 1
+    assert batcher.stats == {"calls": len(QUERIES), "requests": 1, "texts": len(QUERIES)}
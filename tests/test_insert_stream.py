@@ -0,0 +1,34 @@
+import asyncio
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.utils import compute_mdhash_id
+
+FILE_DOCS = {"a.txt": "Alpha meets Beta at the Harbor.", "b.txt": "Gamma sails to the Island."}
+STRING_DOC = "Delta rides with Sigma."
+
+
+def test_path_strings_in_an_iterable_are_read_as_files(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    (tmp_path / "rag").mkdir()
+    rag = HyperRAG(
+        working_dir=str(tmp_path / "rag"),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        enable_llm_cache=False,
+        entity_extract_max_gleaning=0,
+    )
+    paths = []
+    for name, content in FILE_DOCS.items():
+        (tmp_path / name).write_text(content, encoding="utf-8")
+        paths.append(str(tmp_path / name))
+
+    async def main():
+        stats = await rag.ainsert_stream(paths + [STRING_DOC])
+        return stats, set(await rag.full_docs.all_keys())
+
+    stats, doc_keys = asyncio.run(main())
+    assert stats["docs"] == 3 and stats["failed"] == 0
+    assert doc_keys == {
+        compute_mdhash_id(doc, prefix="doc-") for doc in [*FILE_DOCS.values(), STRING_DOC]
+    }
@@ -0,0 +1,80 @@
+import asyncio
+import gc
+
+import pytest
+
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.utils import CALL_PRIORITY_QUERY, call_priority, limit_async_func_call
+
+MESSAGES = [{"role": "user", "content": "Alpha meets Beta and Gamma"}]
+
+
+def test_query_priority_overtakes_waiting_inserts():
+    order = []
+
+    async def main():
+        holding, release = asyncio.Event(), asyncio.Event()
+
+        @limit_async_func_call(1)
+        async def call(name):
+            order.append(name)
+            if name == "holding":
+                holding.set()
+                await release.wait()
+
+        async def query():
+            call_priority.set(CALL_PRIORITY_QUERY)
+            await call("query")
+
+        first = asyncio.create_task(call("holding"))
+        await holding.wait()
+        inserts = [asyncio.create_task(call(f"insert {i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        queried = asyncio.create_task(query())
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *inserts, queried)
+
+    asyncio.run(main())
+    assert order == ["holding", "query", "insert 0", "insert 1", "insert 2"]
+
+
+def test_failed_call_frees_its_slot():
+    @limit_async_func_call(1)
+    async def call(fail: bool):
+        if fail:
+            raise ValueError("provider error")
+        return "ok"
+
+    async def main():
+        with pytest.raises(ValueError):
+            await call(True)
+        return await asyncio.wait_for(call(False), timeout=1)
+
+    assert asyncio.run(main()) == "ok"
+
+
+@pytest.mark.parametrize("stop", ["aclose", "abandon"])
+def test_stopped_stream_frees_its_slot(stop):
+    fake = FakeOpenAI()
+
+    @limit_async_func_call(1)
+    async def complete(stream: bool):
+        if stream:
+            return fake.chat_stream(MESSAGES)
+        return await fake.chat(MESSAGES)
+
+    async def main():
+        response = await complete(True)
+        assert len(await response.__anext__())
+        # the slot is held while the answer is streamed
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.shield(complete(False)), timeout=0.05)
+        if stop == "aclose":
+            await response.aclose()
+        else:
+            del response
+            gc.collect()
+        return await asyncio.wait_for(complete(False), timeout=1)
+
+    assert asyncio.run(main())
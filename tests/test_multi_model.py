@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.llm import Model, MultiModel
+from hyperrag.utils import rate_limit_handled
+
+
+def make_model(fake: FakeOpenAI, handled: list) -> Model:
+    complete = fake.complete_func()
+
+    async def gen_func(prompt, **kwargs):
+        # whether a rate limit error of this call is left to the fail-over
+        handled.append(rate_limit_handled.get())
+        return await complete(prompt, **kwargs)
+
+    return Model(gen_func=gen_func, kwargs={})
+
+
+def test_rate_limits_fail_over_only_to_a_healthy_model():
+    handled = []
+    multi_model = MultiModel([make_model(FakeOpenAI(), handled) for _ in range(2)])
+
+    async def main():
+        await multi_model.llm_model_func("Alpha")
+        multi_model._stats[0].quarantined_until = time.monotonic() + 60
+        await multi_model.llm_model_func("Alpha")
+
+    asyncio.run(main())
+    # the last healthy model retries its rate limit errors itself
+    assert handled == [True, False]
+
+
+def test_all_quarantined_waits_for_the_first_release():
+    fakes = [FakeOpenAI(), FakeOpenAI()]
+    multi_model = MultiModel([make_model(fake, []) for fake in fakes])
+    now = time.monotonic()
+    multi_model._stats[0].quarantined_until = now + 60
+    multi_model._stats[1].quarantined_until = now + 0.2
+
+    async def main():
+        start = time.monotonic()
+        await multi_model.llm_model_func("Alpha")
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) >= 0.2
+    assert [fake.stats["chat"] for fake in fakes] == [0, 1]
@@ -0,0 +1,79 @@
+import asyncio
+import random
+
+import pytest
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.storage import NanoVectorDBStorage, QuantizedVectorDBStorage
+
+WORDS = [f"word{i}" for i in range(400)]
+TOP_K = 10
+
+
+def make_texts(num_texts: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=12)) for _ in range(num_texts)]
+
+
+DOCS = make_texts(500, seed=0)
+QUERIES = make_texts(30, seed=1)
+
+
+def make_vdb(working_dir, fake: FakeOpenAI, vector_db_storage_cls, **kwargs):
+    working_dir.mkdir()
+    rag = HyperRAG(
+        working_dir=str(working_dir),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        vector_db_storage_cls=vector_db_storage_cls,
+        vector_db_storage_cls_kwargs=kwargs,
+    )
+    # rank every vector, the recall is not cut by the threshold
+    rag.chunks_vdb.cosine_better_than_threshold = -1.0
+    return rag.chunks_vdb
+
+
+def query_results(vdb) -> list[list[dict]]:
+    async def main():
+        await vdb.upsert({f"chunk-{i}": {"content": doc} for i, doc in enumerate(DOCS)})
+        return await asyncio.gather(*[vdb.query(q, top_k=TOP_K) for q in QUERIES])
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize(
+    "precision, rescore_factor, min_recall, max_score_error",
+    [
+        ("int8", 0, 0.95, 0.05),
+        ("int8", 4, 0.99, 1e-4),
+        ("float16", 0, 0.99, 1e-2),
+        ("float16", 4, 0.99, 1e-4),
+    ],
+)
+def test_quantized_recall_of_the_float32_results(
+    tmp_path, precision, rescore_factor, min_recall, max_score_error
+):
+    fake = FakeOpenAI(embedding_dim=256)
+    exact = query_results(make_vdb(tmp_path / "float32", fake, NanoVectorDBStorage))
+    quantized = query_results(
+        make_vdb(
+            tmp_path / precision,
+            fake,
+            QuantizedVectorDBStorage,
+            precision=precision,
+            rescore_factor=rescore_factor,
+        )
+    )
+    hits = 0
+    for query, exact_result, result in zip(QUERIES, exact, quantized):
+        # a result tied with the last float32 result counts as recalled
+        kth_score = min(dp["distance"] for dp in exact_result)
+        scores = [
+            fake.embedding(DOCS[int(dp["id"].split("-")[1])]) @ fake.embedding(query)
+            for dp in result
+        ]
+        hits += sum(score >= kth_score - 1e-4 for score in scores)
+        # the rescored results have the float32 scores
+        assert all(abs(dp["distance"] - s) <= max_score_error for dp, s in zip(result, scores))
+    assert hits / (TOP_K * len(QUERIES)) >= min_recall
@@ -0,0 +1,37 @@
+import asyncio
+
+from hyperrag import HyperRAG, QueryParam
+from hyperrag.fake_openai import FakeOpenAI
+
+FIRST_DOC = "Alpha meets Beta at the Harbor."
+SECOND_DOC = "Alpha sails with Omega to the Island."
+QUERY = "Where does Alpha meet Beta?"
+
+
+def test_query_cache_is_cleared_only_by_changes(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    rag = HyperRAG(
+        working_dir=str(tmp_path),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        enable_llm_cache=False,
+        enable_query_cache=True,
+        entity_extract_max_gleaning=0,
+    )
+    param = QueryParam(mode="naive")
+
+    async def main():
+        await rag.ainsert(FIRST_DOC)
+        first = await rag.aquery(QUERY, param)
+        chats = fake.stats["chat"]
+        # an already stored doc inserts no chunks, the cached answer is kept
+        await rag.ainsert(FIRST_DOC)
+        assert await rag.aquery(QUERY, param) == first
+        assert fake.stats["chat"] == chats
+        await rag.ainsert(SECOND_DOC)
+        chats = fake.stats["chat"]
+        await rag.aquery(QUERY, param)
+        assert fake.stats["chat"] == chats + 1
+        await rag.aclose()
+
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+import asyncio
+
+from hyperrag import HyperRAG, QueryParam
+from hyperrag.fake_openai import FakeOpenAI
+
+
+def make_rag(working_dir, llm_model_func, fake: FakeOpenAI) -> HyperRAG:
+    return HyperRAG(
+        working_dir=str(working_dir),
+        llm_model_func=llm_model_func,
+        embedding_func=fake.embedding_func(),
+        enable_llm_cache=False,
+        entity_extract_max_gleaning=0,
+    )
+
+
+def stream_answer(rag: HyperRAG) -> list[dict]:
+    async def main():
+        await rag.ainsert("Alpha meets Beta and Gamma at the Harbor.")
+        return [e async for e in rag.aquery_stream("Alpha Beta", QueryParam(mode="naive"))]
+
+    return asyncio.run(main())
+
+
+def test_streamable_llm_answers_in_several_tokens(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    events = stream_answer(make_rag(tmp_path, fake.complete_func(), fake))
+    assert events[0]["type"] == "metadata"
+    tokens = [e["content"] for e in events if e["type"] == "token"]
+    assert len(tokens) > 1
+
+
+def test_not_streamable_llm_answers_in_one_token(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    complete = fake.complete_func()
+
+    async def llm_model_func(prompt, system_prompt=None, history_messages=[], **kwargs):
+        return await complete(prompt, system_prompt, history_messages, **kwargs)
+
+    events = stream_answer(make_rag(tmp_path, llm_model_func, fake))
+    tokens = [e["content"] for e in events if e["type"] == "token"]
+    assert len(tokens) == 1
+    assert len(tokens[0].split()) > 1
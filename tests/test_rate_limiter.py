@@ -0,0 +1,117 @@
+import asyncio
+import time
+
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.utils import (
+    RateLimiter,
+    acquire_rate_limit,
+    defer_rate_limit,
+    limit_async_func_call,
+    single_flight,
+)
+
+
+def make_complete(fake: FakeOpenAI, cache: dict):
+    """A llm function caching like openai_complete_if_cache, on the fake provider"""
+
+    @defer_rate_limit
+    async def complete(prompt, **kwargs):
+        if prompt in cache:
+            return cache[prompt]
+
+        async def _complete():
+            await acquire_rate_limit()
+            cache[prompt] = await fake.chat([{"role": "user", "content": prompt}])
+            return cache[prompt]
+
+        return await single_flight(("test_rate_limiter", prompt), _complete)
+
+    return complete
+
+
+def test_cache_hits_and_shared_calls_are_not_charged():
+    fake = FakeOpenAI(latency=0.01)
+    limiter = RateLimiter(8, requests_per_minute=600)
+    complete = limit_async_func_call(8, limiter)(make_complete(fake, {}))
+
+    async def main():
+        # one call in flight shared by all, then cache hits
+        await asyncio.gather(*[complete("same prompt") for _ in range(8)])
+        await asyncio.gather(*[complete("same prompt") for _ in range(8)])
+
+    asyncio.run(main())
+    assert fake.stats["chat"] == 1
+    assert limiter.stats["requests"] == 1
+
+
+def test_rate_limited_requests_are_charged_and_retried():
+    fake = FakeOpenAI(rate_429=0.3, seed=3)
+    limiter = RateLimiter(4, requests_per_minute=6000)
+    complete = limit_async_func_call(4, limiter)(make_complete(fake, {}))
+    prompts = [f"prompt {i}" for i in range(4)]
+
+    async def main():
+        await asyncio.gather(*[complete(p) for p in prompts])
+        await asyncio.gather(*[complete(p) for p in prompts])
+
+    asyncio.run(main())
+    assert fake.stats["rate_limited"] > 0
+    assert fake.stats["chat"] == len(prompts)
+    # every request reaching the provider, and only those
+    assert limiter.stats["requests"] == fake.stats["chat"] + fake.stats["rate_limited"]
+    assert limiter.stats["retries"] == fake.stats["rate_limited"]
+
+
+def test_unmarked_functions_are_charged_before_the_call():
+    fake = FakeOpenAI()
+    limiter = RateLimiter(4, requests_per_minute=600)
+
+    async def complete(prompt, **kwargs):
+        return await fake.chat([{"role": "user", "content": prompt}])
+
+    complete = limit_async_func_call(4, limiter)(complete)
+    asyncio.run(complete("a prompt"))
+    assert limiter.stats["requests"] == fake.stats["chat"] == 1
+
+
+def run_timed(complete, num_calls: int) -> float:
+    async def main():
+        start = time.monotonic()
+        await asyncio.gather(*[complete(f"prompt {i}") for i in range(num_calls)])
+        return time.monotonic() - start
+
+    return asyncio.run(main())
+
+
+def test_requests_per_minute_are_spread_after_the_burst():
+    fake = FakeOpenAI()
+    # 10 requests per second, a burst of one second
+    limiter = RateLimiter(32, requests_per_minute=600)
+    complete = limit_async_func_call(32, limiter)(make_complete(fake, {}))
+    elapsed = run_timed(complete, 20)
+    assert fake.stats["chat"] == limiter.stats["requests"] == 20
+    assert 0.9 <= elapsed < 3.0
+    assert limiter.stats["wait_seconds"] > 0
+
+
+def test_tokens_per_minute_are_spread_after_the_burst():
+    fake = FakeOpenAI()
+    # 100 tokens per second, 10 tokens per call
+    limiter = RateLimiter(32, tokens_per_minute=6000, count_tokens=lambda args, kwargs: 10)
+    complete = limit_async_func_call(32, limiter)(make_complete(fake, {}))
+    elapsed = run_timed(complete, 20)
+    assert limiter.stats["tokens"] == 200
+    assert 0.9 <= elapsed < 3.0
+
+
+def test_rate_limits_halve_the_adaptive_concurrency():
+    limiter = RateLimiter(8, adaptive_concurrency=True)
+    limiter.on_rate_limited(0, retry_after=0.01)
+    assert limiter.concurrency_limit == 4
+    # one decrease per second for the calls failing together
+    limiter.on_rate_limited(0, retry_after=0.01)
+    assert limiter.concurrency_limit == 4
+    # grown by one call per round of successful calls
+    for _ in range(5):
+        limiter.on_success(0.01)
+    assert limiter.concurrency_limit == 5
@@ -0,0 +1,71 @@
+import asyncio
+import json
+import time
+
+from hyperrag.storage import SqliteCacheKVStorage
+
+
+def make_cache(working_dir, **config) -> SqliteCacheKVStorage:
+    return SqliteCacheKVStorage(
+        namespace="llm_response_cache",
+        global_config={"working_dir": str(working_dir), **config},
+    )
+
+
+def response(size: int = 10) -> dict:
+    return {"return": "x" * size, "model": "m"}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = make_cache(tmp_path, llm_cache_max_entries=3)
+
+    async def main():
+        for i in range(3):
+            await cache.upsert({f"k{i}": response()})
+            await asyncio.sleep(0.01)
+        # k0 is used, k1 is the least recently used one
+        assert await cache.get_by_id("k0") is not None
+        await cache.upsert({"k3": response()})
+        return await cache.get_by_ids(["k0", "k1", "k2", "k3"])
+
+    assert [v is not None for v in asyncio.run(main())] == [True, False, True, True]
+
+
+def test_entries_are_evicted_beyond_the_bytes_limit(tmp_path):
+    entry_size = len(json.dumps(response(size=100)))
+    cache = make_cache(tmp_path, llm_cache_max_bytes=2 * entry_size)
+
+    async def main():
+        for i in range(4):
+            await cache.upsert({f"k{i}": response(size=100)})
+            await asyncio.sleep(0.01)
+        return await cache.all_keys(), await cache.model_stats()
+
+    keys, stats = asyncio.run(main())
+    assert sorted(keys) == ["k2", "k3"]
+    assert stats["m"] == {"entries": 2, "bytes": 2 * entry_size}
+
+
+def test_entries_expire_after_the_ttl(tmp_path):
+    cache = make_cache(tmp_path, llm_cache_ttl=0.05)
+
+    async def main():
+        await cache.upsert({"k0": response()})
+        assert await cache.get_by_id("k0") is not None
+        time.sleep(0.1)
+        assert await cache.get_by_id("k0") is None
+        assert await cache.filter_keys(["k0"]) == {"k0"}
+
+    asyncio.run(main())
+
+
+def test_the_json_cache_is_imported_once(tmp_path):
+    data = {f"k{i}": response() for i in range(3)}
+    with open(tmp_path / "kv_store_llm_response_cache.json", "w") as f:
+        json.dump(data, f)
+    cache = make_cache(tmp_path)
+    assert asyncio.run(cache.get_by_ids(list(data))) == list(data.values())
+
+    asyncio.run(cache.drop())
+    # a dropped cache stays empty, the json file is not imported again
+    assert asyncio.run(make_cache(tmp_path).all_keys()) == []
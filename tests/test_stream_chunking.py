@@ -0,0 +1,50 @@
+import asyncio
+import io
+
+import pytest
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.operate import chunking_by_token_size, chunking_by_token_size_stream
+
+WORDS = ["Alpha", "meets", "Beta", "at the", "Harbor,", "then\tsails", "to\n\nthe", "Island."]
+CONTENT = "\n  " + " ".join(WORDS[i % len(WORDS)] for i in range(600)) + " \n\n"
+
+
+@pytest.mark.parametrize("read_size", [7, 64, 65536])
+def test_stream_chunks_equal_the_batch_chunks(read_size):
+    batch_chunks = chunking_by_token_size(
+        CONTENT.strip(), overlap_token_size=16, max_token_size=64
+    )
+    stream_chunks = list(
+        chunking_by_token_size_stream(
+            io.StringIO(CONTENT), overlap_token_size=16, max_token_size=64, read_size=read_size
+        )
+    )
+    assert len(batch_chunks) > 1
+    assert stream_chunks == batch_chunks
+
+
+def test_streamed_file_inserts_the_chunks_of_the_string(tmp_path):
+    path = tmp_path / "doc.txt"
+    path.write_text(CONTENT, encoding="utf-8")
+    fake = FakeOpenAI(embedding_dim=32)
+
+    async def chunk_keys(working_dir, source):
+        working_dir.mkdir()
+        rag = HyperRAG(
+            working_dir=str(working_dir),
+            llm_model_func=fake.complete_func(),
+            embedding_func=fake.embedding_func(),
+            enable_llm_cache=False,
+            entity_extract_max_gleaning=0,
+            chunk_token_size=64,
+            chunk_overlap_token_size=16,
+            chunk_stream_read_size=64,
+        )
+        await rag.ainsert(source)
+        return set(await rag.text_chunks.all_keys())
+
+    string_keys = asyncio.run(chunk_keys(tmp_path / "string", CONTENT))
+    assert len(string_keys) > 1
+    assert asyncio.run(chunk_keys(tmp_path / "stream", path)) == string_keys
@@ -0,0 +1,42 @@
+import asyncio
+
+import pytest
+
+from hyperrag import HyperRAG
+from hyperrag.fake_openai import FakeOpenAI
+from hyperrag.operate import _entity_vdb_content
+from hyperrag.utils import compute_mdhash_id
+
+
+def test_entities_are_upserted_again_after_a_failed_vdb_write(tmp_path):
+    fake = FakeOpenAI(embedding_dim=32)
+    rag = HyperRAG(
+        working_dir=str(tmp_path),
+        llm_model_func=fake.complete_func(),
+        embedding_func=fake.embedding_func(),
+        embedding_model_name="fake",
+        enable_llm_cache=False,
+        entity_extract_max_gleaning=0,
+    )
+    doc = "Alpha meets Beta and Gamma at the Harbor."
+    upsert = rag.entities_vdb.upsert
+
+    async def failing_upsert(data):
+        raise RuntimeError("vdb write failed")
+
+    rag.entities_vdb.upsert = failing_upsert
+    with pytest.raises(RuntimeError):
+        rag.insert(doc)
+    # the hypergraph holds the merged entities, the vdb does not
+    assert "ALPHA" in asyncio.run(rag.chunk_entity_relation_hypergraph.get_all_vertices())
+    rag.entities_vdb.upsert = upsert
+    rag.insert(doc)
+
+    async def query(entity_name):
+        vertex = await rag.chunk_entity_relation_hypergraph.get_vertex(entity_name)
+        content = _entity_vdb_content(entity_name, vertex["description"])
+        return await rag.entities_vdb.query(content, top_k=1)
+
+    results = asyncio.run(query("ALPHA"))
+    assert results[0]["entity_name"] == "ALPHA"
+    assert results[0]["id"] == compute_mdhash_id("ALPHA", prefix="ent-")
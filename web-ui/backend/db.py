@@ -366,6 +366,8 @@ def update_vertex(vertex_id: str, vertex_data: dict, database=None):
         for key, value in vertex_data.items():
             if value:  # 只更新非空值
                 existing_data[key] = value
+                # 字段已修改，丢弃写入时缓存的 token 数
+                existing_data.pop(f"{key}_tokens", None)
         
         # 移除旧的vertex并添加新的
         db.remove_v(vertex_id)
@@ -401,6 +403,8 @@ def update_hyperedge(vertices: list, hyperedge_data: dict, database=None):
         for key, value in hyperedge_data.items():
             if value:  # 只更新非空值
                 existing_data[key] = value
+                # 字段已修改，丢弃写入时缓存的 token 数
+                existing_data.pop(f"{key}_tokens", None)
         
         # 移除旧的hyperedge并添加新的
         db.remove_e(edge_tuple)
@@ -1,5 +1,6 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from db import get_hypergraph, getFrequentVertices, get_vertices, get_hyperedges, get_vertice, get_vertice_neighbor, get_hyperedge_neighbor_server, add_vertex, add_hyperedge, delete_vertex, delete_hyperedge, update_vertex, update_hyperedge, get_hyperedge_detail, db_manager, clear_graph_data
 from file_manager import file_manager
 import json
@@ -24,13 +25,16 @@ if importlib.util.find_spec("hyperrag") is None:
 
 try:
     from hyperrag import HyperRAG, QueryParam
-    from hyperrag.utils import EmbeddingFunc
+    from hyperrag.utils import EmbeddingFunc, streamable
     from hyperrag.llm import openai_embedding, openai_complete_if_cache
     HYPERRAG_AVAILABLE = True
 except ImportError as e:
     print(f"HyperRAG not available: {e}")
     HYPERRAG_AVAILABLE = False
 
+    def streamable(func):
+        return func
+
 
 # 设置文件路径
 SETTINGS_FILE = "settings.json"
@@ -446,9 +450,11 @@ async def test_database_connection(db_test: DatabaseTestModel):
 hyperrag_instances = {}
 hyperrag_working_dir = "hyperrag_cache"
 
-async def get_hyperrag_llm_func(prompt, system_prompt=None, history_messages=[], **kwargs) -> str:
+@streamable
+async def get_hyperrag_llm_func(prompt, system_prompt=None, history_messages=[], **kwargs):
     """
     HyperRAG 专用的 LLM 函数，使用异步版本
+    stream=True 时返回逐个产出 token 的异步迭代器
     """
     try:
         main_logger.info(f"开始LLM调用，prompt长度: {len(prompt)} 字符")
@@ -465,6 +471,9 @@ async def get_hyperrag_llm_func(prompt, system_prompt=None, history_messages=[],
         
         main_logger.info(f"使用模型: {model_name}, API地址: {base_url}")
         
+        if kwargs.pop("stream", False):
+            # 返回异步迭代器，由调用方逐个读取 token
+            kwargs["stream"] = True
         response = await openai_complete_if_cache(
             model_name,
             prompt,
@@ -475,7 +484,10 @@ async def get_hyperrag_llm_func(prompt, system_prompt=None, history_messages=[],
             **kwargs,
         )
         
-        main_logger.info(f"LLM调用完成，响应长度: {len(response)} 字符")
+        if isinstance(response, str):
+            main_logger.info(f"LLM调用完成，响应长度: {len(response)} 字符")
+        else:
+            main_logger.info("LLM调用完成，流式返回响应")
         return response
         
     except Exception as e:
@@ -564,6 +576,9 @@ def get_or_create_hyperrag(database: str = None):
                 max_token_size=8192,
                 func=get_hyperrag_embedding_func
             ),
+            # 嵌入缓存按模型区分
+            enable_embedding_cache=True,
+            embedding_model_name=settings.get("embeddingModel", "text-embedding-3-small"),
         )
         
         main_logger.info(f"HyperRAG实例创建完成，数据库: {database}")
@@ -673,6 +688,51 @@ async def query_hyperrag(query: QueryModel):
     except Exception as e:
         return {"success": False, "message": f"Query failed: {str(e)}"}
 
+@app.post("/hyperrag/query/stream")
+async def query_hyperrag_stream(query: QueryModel):
+    """
+    流式问答查询 (Server-Sent Events)：先返回 metadata 事件 (entities / hyperedges / text_units)，
+    再逐个返回 token 事件，最后返回 done 事件，出错时返回 error 事件
+    """
+    if not HYPERRAG_AVAILABLE:
+        return {"success": False, "message": "HyperRAG is not available"}
+
+    param = QueryParam(
+        mode=query.mode,
+        top_k=query.top_k,
+        max_token_for_text_unit=query.max_token_for_text_unit,
+        max_token_for_entity_context=query.max_token_for_entity_context,
+        max_token_for_relation_context=query.max_token_for_relation_context,
+        only_need_context=query.only_need_context,
+        response_type=query.response_type,
+    )
+
+    def sse(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    async def event_stream():
+        try:
+            rag = get_or_create_hyperrag(query.database)
+            async for event in rag.aquery_stream(query.question, param):
+                event_type = event.pop("type")
+                if event_type == "metadata":
+                    event.update(
+                        mode=query.mode,
+                        question=query.question,
+                        database=query.database or "default",
+                    )
+                yield sse(event_type, event)
+            yield sse("done", {"success": True})
+        except Exception as e:
+            main_logger.error(f"流式查询失败: {str(e)}")
+            yield sse("error", {"success": False, "message": f"Query failed: {str(e)}"})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/hyperrag/status")
 async def get_hyperrag_status(database: str = None):
     """